@@ -1,5 +1,6 @@
 from solar_mapper.dataset.sentinel_2 import get_example_with_segmentation_map, load_and_get_examples_from_gem
 from solar_mapper.dataset.utils import get_global_pv_mapping_polygons, get_global_energy_monitor_polygons
+from solar_mapper.dataset.loading_profiles import get_loading_profiles
 import datetime
 
 gem_geojson = get_global_energy_monitor_polygons()
@@ -11,7 +12,9 @@ train_example, train_example_s1 = get_example_with_segmentation_map(polygons['tr
                                                   start_time=datetime.datetime(2015, 1, 1),
                                                   end_time=datetime.datetime(2018, 12, 31),
                                                   search_delta=datetime.timedelta(days=90),
-                                                  num_samples=8)
+                                                  num_samples=8,
+                                                  # load S1 backscatter directly in dB
+                                                  profiles=get_loading_profiles({"sentinel-1-rtc": {"db_scale": True}}))
 print(train_example)
 print(train_example.data_vars)
 print(train_example_s1)
@@ -33,9 +36,6 @@ plt.show()
 plt.imshow(train_example['visual'].isel(time=0,x=slice(int(non_zero_center[1]-100), int(non_zero_center[1]+100)), y=slice(int(non_zero_center[0]-100), int(non_zero_center[0]+100))))
 plt.show()
 
-def db_scale(x):
-    return 10 * np.log10(x)
-
-# This is incorrect, as the x,y coordinates are different than for the S2 data
-plt.imshow(db_scale(train_example_s1["vv"].isel(time=0,x=slice(int(non_zero_center[1]-100), int(non_zero_center[1]+100)), y=slice(int(non_zero_center[0]-100), int(non_zero_center[0]+100)))))
+# S1 is loaded on the S2 grid, so the same cutout applies
+plt.imshow((train_example_s1["vv"].isel(time=0,x=slice(int(non_zero_center[1]-100), int(non_zero_center[1]+100)), y=slice(int(non_zero_center[0]-100), int(non_zero_center[0]+100)))))
 plt.show()
@@ -0,0 +1,19 @@
+#!/bin/bash
+# Multi-GPU training with torchrun, one process per GPU
+# Run from root folder with: bash scripts/torchrun.sh <gpus per node> [hydra overrides]
+# On several nodes, run it on each with the same SOLAR_MAPPER_RUN_DIR and:
+#   NNODES=2 NODE_RANK=<0|1> MASTER_ADDR=<address of node 0> bash scripts/torchrun.sh 4
+
+NPROC_PER_NODE=${1:-1}
+shift
+
+# every rank composes its own hydra config, they share the run directory of this launch
+export SOLAR_MAPPER_RUN_DIR=${SOLAR_MAPPER_RUN_DIR:-logs/train/runs/$(date +%Y-%m-%d_%H-%M-%S)}
+
+torchrun \
+  --nproc_per_node="$NPROC_PER_NODE" \
+  --nnodes="${NNODES:-1}" \
+  --node_rank="${NODE_RANK:-0}" \
+  --master_addr="${MASTER_ADDR:-127.0.0.1}" \
+  --master_port="${MASTER_PORT:-29500}" \
+  solar_mapper/train.py trainer=torchrun "$@"
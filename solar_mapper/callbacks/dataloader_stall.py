@@ -0,0 +1,178 @@
+import os
+import time
+from typing import Any, Optional
+
+import torch
+from pytorch_lightning import Callback, LightningModule, Trainer
+
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+
+def _batch_size(batch: Any) -> int:
+    """Returns the number of examples in a (possibly nested) batch."""
+    if isinstance(batch, torch.Tensor):
+        return batch.shape[0] if batch.ndim > 0 else 1
+    if isinstance(batch, dict):
+        batch = list(batch.values())
+    if isinstance(batch, (list, tuple)):
+        for item in batch:
+            size = _batch_size(item)
+            if size:
+                return size
+    return 0
+
+
+class DataLoaderStallMonitor(Callback):
+    """Measures how long each training step waits on the dataloader versus computing.
+
+    The wait time is the gap between the end of one training batch and the start of the next,
+    which covers fetching from the dataloader workers and the host-to-device transfer. The
+    compute time is the span of the training step itself. Over every window of
+    `log_every_n_steps` steps the callback logs:
+
+    - `perf/data_wait_ms` and `perf/compute_ms`: mean per-step times
+    - `perf/idle_fraction`: share of wall time the accelerator sat waiting for input
+    - `perf/examples_per_sec`: example throughput
+
+    If the idle fraction exceeds `input_bound_threshold` the run is input-bound, and a warning is
+    emitted. With `auto_tune=True` the datamodule's `num_workers` (then `prefetch_factor`) is
+    raised at the end of the epoch. The new values only take effect when the dataloaders are
+    rebuilt, so pair it with `trainer.reload_dataloaders_every_n_epochs=1`.
+    """
+
+    def __init__(
+        self,
+        log_every_n_steps: int = 50,
+        input_bound_threshold: float = 0.3,
+        auto_tune: bool = False,
+        max_num_workers: Optional[int] = None,
+        max_prefetch_factor: int = 8,
+        sync_cuda: bool = True,
+    ):
+        """Configures the measurement windows and the input-bound response.
+
+        Args:
+            log_every_n_steps: Number of training steps aggregated into one measurement window.
+            input_bound_threshold: Idle fraction above which the run is treated as input-bound.
+            auto_tune: Whether to raise the datamodule worker/prefetch counts when input-bound.
+            max_num_workers: Upper bound for `num_workers`, defaults to the number of CPUs.
+            max_prefetch_factor: Upper bound for `prefetch_factor`.
+            sync_cuda: Synchronize CUDA before stopping the compute timer, so asynchronous
+                kernels are attributed to compute and not to the next data wait.
+        """
+        super().__init__()
+        self.log_every_n_steps = log_every_n_steps
+        self.input_bound_threshold = input_bound_threshold
+        self.auto_tune = auto_tune
+        self.max_num_workers = max_num_workers or os.cpu_count() or 1
+        self.max_prefetch_factor = max_prefetch_factor
+        self.sync_cuda = sync_cuda
+
+        self._last_batch_end: Optional[float] = None
+        self._batch_start: Optional[float] = None
+        self._reset_window()
+        self._epoch_wait = 0.0
+        self._epoch_total = 0.0
+
+    def _reset_window(self) -> None:
+        self._window_wait = 0.0
+        self._window_compute = 0.0
+        self._window_examples = 0
+        self._window_steps = 0
+
+    def _synchronize(self, pl_module: LightningModule) -> None:
+        if self.sync_cuda and pl_module.device.type == "cuda":
+            torch.cuda.synchronize(pl_module.device)
+
+    def on_train_epoch_start(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        self._reset_window()
+        self._epoch_wait = 0.0
+        self._epoch_total = 0.0
+        self._last_batch_end = time.perf_counter()
+
+    def on_train_batch_start(
+        self, trainer: Trainer, pl_module: LightningModule, batch: Any, batch_idx: int
+    ) -> None:
+        self._batch_start = time.perf_counter()
+        if self._last_batch_end is not None:
+            self._window_wait += self._batch_start - self._last_batch_end
+
+    def on_train_batch_end(
+        self,
+        trainer: Trainer,
+        pl_module: LightningModule,
+        outputs: Any,
+        batch: Any,
+        batch_idx: int,
+    ) -> None:
+        if self._batch_start is None:
+            return
+        self._synchronize(pl_module)
+        self._last_batch_end = time.perf_counter()
+        self._window_compute += self._last_batch_end - self._batch_start
+        self._window_examples += _batch_size(batch)
+        self._window_steps += 1
+
+        if self._window_steps >= self.log_every_n_steps:
+            self._flush_window(pl_module)
+
+    def on_train_epoch_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        if self._window_steps:
+            self._flush_window(pl_module)
+        self._last_batch_end = None
+        self._batch_start = None
+
+        if not self._epoch_total:
+            return
+        idle_fraction = self._epoch_wait / self._epoch_total
+        if idle_fraction > self.input_bound_threshold:
+            log.warning(
+                f"Training is input-bound: {idle_fraction:.0%} of step time was spent waiting on "
+                f"the dataloader. Consider raising `num_workers` or `prefetch_factor`."
+            )
+            if self.auto_tune:
+                self._tune_datamodule(trainer)
+
+    def _flush_window(self, pl_module: LightningModule) -> None:
+        total = self._window_wait + self._window_compute
+        metrics = {
+            "perf/data_wait_ms": 1000.0 * self._window_wait / self._window_steps,
+            "perf/compute_ms": 1000.0 * self._window_compute / self._window_steps,
+            "perf/idle_fraction": self._window_wait / total if total else 0.0,
+            "perf/examples_per_sec": self._window_examples / total if total else 0.0,
+        }
+        pl_module.log_dict(metrics, on_step=True, on_epoch=False)
+        self._epoch_wait += self._window_wait
+        self._epoch_total += total
+        self._reset_window()
+
+    def _tune_datamodule(self, trainer: Trainer) -> None:
+        """Raises worker, then prefetch, counts on the datamodule for the next reload."""
+        datamodule = trainer.datamodule
+        hparams = getattr(datamodule, "hparams", None)
+        if hparams is None or "num_workers" not in hparams:
+            log.warning("Datamodule does not expose `num_workers`, skipping auto-tuning.")
+            return
+
+        num_workers = hparams.num_workers
+        prefetch_factor = hparams.get("prefetch_factor") or 2
+        if num_workers < self.max_num_workers:
+            hparams.num_workers = min(max(1, 2 * num_workers), self.max_num_workers)
+            log.info(f"Raised datamodule `num_workers` {num_workers} -> {hparams.num_workers}")
+        elif "prefetch_factor" in hparams and prefetch_factor < self.max_prefetch_factor:
+            hparams.prefetch_factor = min(2 * prefetch_factor, self.max_prefetch_factor)
+            log.info(
+                f"Raised datamodule `prefetch_factor` {prefetch_factor} -> "
+                f"{hparams.prefetch_factor}"
+            )
+        else:
+            log.warning("Worker and prefetch counts are already at their configured maximum.")
+            return
+
+        if not trainer.reload_dataloaders_every_n_epochs:
+            log.warning(
+                "New loader settings only apply once the dataloaders are rebuilt, set "
+                "`trainer.reload_dataloaders_every_n_epochs=1` for them to take effect."
+            )
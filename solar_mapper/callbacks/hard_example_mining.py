@@ -0,0 +1,139 @@
+import glob
+import os
+from typing import Any, List, Optional
+
+import numpy as np
+import torch
+from pytorch_lightning import Callback, LightningModule, Trainer
+
+from solar_mapper.datamodules.components.mining import (
+    TABLE_DTYPE,
+    HardExampleTable,
+    merge_tables,
+    polygon_cells,
+    sampling_weights,
+    write_sampling_weights,
+)
+from solar_mapper.models.components.segmentation_loss import chip_errors
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+
+class HardExampleMining(Callback):
+    """Steers the training polygons towards those the model gets wrong.
+
+    The loss and false positive fraction of every training chip are kept on the device during
+    the epoch, and recorded into a `HardExampleTable` of each rank, `table-<rank>.npy` in the
+    datamodule's `mining_dir`, at its end. Every `every_n_epochs` epochs rank zero merges the
+    tables and writes new sampling weights, which the training dataset reads when it starts its
+    next pass, see `solar_mapper.datamodules.components.mining`.
+
+    The tables persist in `mining_dir`, so resumed or later runs continue from the recorded
+    errors. With several nodes `mining_dir` must be on a shared filesystem.
+    """
+
+    def __init__(
+        self,
+        every_n_epochs: int = 1,
+        momentum: float = 0.9,
+        false_positive_weight: float = 1.0,
+        region_weight: float = 0.5,
+        uniform: float = 0.2,
+    ):
+        """Sets how often the weights are updated and how the errors are turned into weights.
+
+        Args:
+            every_n_epochs: Number of epochs between updates of the sampling weights
+            momentum: Weight of the previous errors of a polygon when it is drawn again
+            false_positive_weight: Weight of the false positive fraction next to the loss
+            region_weight: Share of a polygon's score taken from the polygons of its 1° cell,
+                raises the weight of unseen polygons next to hard ones
+            uniform: Share of the draws that stays uniform over all polygons
+        """
+        super().__init__()
+        self.every_n_epochs = every_n_epochs
+        self.momentum = momentum
+        self.false_positive_weight = false_positive_weight
+        self.region_weight = region_weight
+        self.uniform = uniform
+
+        self.mining_dir: Optional[str] = None
+        self.table: Optional[HardExampleTable] = None
+        self.cells: Optional[np.ndarray] = None
+        self._polygons: List[torch.Tensor] = []
+        self._errors: List[torch.Tensor] = []
+
+    def setup(self, trainer: Trainer, pl_module: LightningModule, stage: Optional[str] = None):
+        if stage not in ("fit", None):
+            return
+        datamodule = trainer.datamodule
+        self.mining_dir = getattr(datamodule, "mining_dir", None)
+        if not self.mining_dir:
+            raise ValueError("Hard-example mining needs `datamodule.mining_dir`")
+        if datamodule.data_train is None:
+            datamodule.setup(stage)
+        features = datamodule.data_train.features
+        path = os.path.join(self.mining_dir, f"table-{trainer.global_rank}.npy")
+        self.table = HardExampleTable(path, len(features), momentum=self.momentum)
+        if trainer.is_global_zero:
+            self.cells = polygon_cells(features)
+        log.info(f"Recording training errors of {len(features)} polygons into <{path}>")
+
+    def on_train_batch_end(
+        self,
+        trainer: Trainer,
+        pl_module: LightningModule,
+        outputs: Any,
+        batch: Any,
+        batch_idx: int,
+    ) -> None:
+        if self.table is None or not isinstance(outputs, dict) or "logits" not in outputs:
+            return
+        loss, false_positives = chip_errors(outputs["logits"], batch["mask"])
+        # stays on the device, read once at the end of the epoch
+        self._polygons.append(batch["polygon"])
+        self._errors.append(torch.stack([loss, false_positives], 1))
+
+    def on_train_epoch_end(self, trainer: Trainer, pl_module: LightningModule) -> None:
+        if self.table is None:
+            return
+        if self._errors:
+            polygons = torch.cat(self._polygons).cpu().numpy()
+            errors = torch.cat(self._errors).cpu().numpy()
+            self._polygons, self._errors = [], []
+            # negatives, with a polygon of -1, aren't drawn by the weights
+            keep = polygons >= 0
+            self.table.record(
+                polygons[keep], errors[keep, 0], errors[keep, 1], trainer.current_epoch
+            )
+            self.table.flush()
+
+        if (trainer.current_epoch + 1) % self.every_n_epochs:
+            return
+        # every rank flushed its table before rank zero reads them
+        trainer.strategy.barrier()
+        if trainer.is_global_zero:
+            self.update_weights()
+        trainer.strategy.barrier()
+
+    def update_weights(self) -> np.ndarray:
+        """Writes the sampling weights of the tables of all ranks in `mining_dir`."""
+        paths = sorted(glob.glob(os.path.join(self.mining_dir, "table-*.npy")))
+        tables = [np.load(path, mmap_mode="r") for path in paths]
+        tables = [table for table in tables if table.dtype == TABLE_DTYPE]
+        table = merge_tables(tables)
+        weights = sampling_weights(
+            table,
+            self.cells,
+            false_positive_weight=self.false_positive_weight,
+            region_weight=self.region_weight,
+            uniform=self.uniform,
+        )
+        write_sampling_weights(self.mining_dir, weights)
+        seen = table["count"] > 0
+        log.info(
+            f"Updated the sampling weights, {seen.sum()} of {len(table)} polygons seen, "
+            f"max weight {weights.max() * len(weights):.1f}x uniform"
+        )
+        return weights
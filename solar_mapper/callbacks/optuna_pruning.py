@@ -0,0 +1,95 @@
+from typing import Any, Iterable, Optional
+
+from pytorch_lightning import Callback, LightningModule, Trainer
+
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+
+def find_running_trial(study: Any, overrides: Iterable[str]) -> Optional[Any]:
+    """Returns the running trial of `study` whose parameters are among the Hydra `overrides`.
+
+    The Optuna sweeper asks for trials in its own process and only hands each job the sampled
+    parameters as overrides, so the job finds its trial in the shared storage by them.
+    """
+    import optuna
+
+    overrides = set(overrides)
+    running = study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.RUNNING,))
+    for trial in running:
+        if {f"{name}={value}" for name, value in trial.params.items()} <= overrides:
+            return optuna.trial.Trial(study, trial._trial_id)
+    return None
+
+
+class OptunaPruning(Callback):
+    """Reports a validation metric of each trial of an Optuna sweep, and stops pruned trials.
+
+    The metric is reported to the study in `storage` after every validation epoch, where the
+    `pruner` compares it with the trials that ran, or run in parallel, before. A pruned trial
+    stops training like early stopping, instead of raising `optuna.TrialPruned`, which would end
+    the whole Hydra sweep; it returns the best metric it reached and is marked with a
+    `pruned_epoch` user attribute.
+
+    Only rank zero talks to the storage, the decision is broadcast to the other ranks.
+    """
+
+    def __init__(
+        self,
+        storage: Optional[Any],
+        study_name: Optional[str],
+        monitor: str = "val/iou",
+        pruner: Optional[Any] = None,
+    ):
+        """Sets the study the trial reports to and the pruner deciding on it.
+
+        Args:
+            storage: Storage URL, or storage, of the study, `hydra.sweeper.storage`
+            study_name: Name of the study, `hydra.sweeper.study_name`
+            monitor: Metric to report, logged by the model at the end of validation
+            pruner: Optuna pruner, e.g. `optuna.pruners.MedianPruner`, none is pruned if None
+        """
+        super().__init__()
+        self.storage = storage
+        self.study_name = study_name
+        self.monitor = monitor
+        self.pruner = pruner
+        self.trial: Optional[Any] = None
+
+    def setup(self, trainer: Trainer, pl_module: LightningModule, stage: Optional[str] = None):
+        if stage not in ("fit", None) or not trainer.is_global_zero or self.pruner is None:
+            return
+        if self.storage is None:
+            log.warning("Optuna pruning needs a persistent `hydra.sweeper.storage`, disabled")
+            return
+
+        import optuna
+        from hydra.core.hydra_config import HydraConfig
+
+        if not HydraConfig.initialized():
+            log.warning("Optuna pruning only works in jobs of a Hydra sweep, disabled")
+            return
+        study = optuna.load_study(
+            study_name=self.study_name, storage=self.storage, pruner=self.pruner
+        )
+        self.trial = find_running_trial(study, HydraConfig.get().overrides.task)
+        if self.trial is None:
+            log.warning(f"No running trial of study <{study.study_name}> matches this job")
+        else:
+            log.info(f"Reporting <{self.monitor}> to trial {self.trial.number}")
+
+    def on_validation_end(self, trainer: Trainer, pl_module: LightningModule):
+        if trainer.sanity_checking:
+            return
+        should_prune = False
+        value = trainer.callback_metrics.get(self.monitor)
+        if self.trial is not None and value is not None:
+            epoch = trainer.current_epoch
+            self.trial.report(float(value), step=epoch)
+            should_prune = self.trial.should_prune()
+            if should_prune:
+                log.info(f"Pruning trial {self.trial.number} at epoch {epoch}")
+                self.trial.set_user_attr("pruned_epoch", epoch)
+        if trainer.strategy.broadcast(should_prune):
+            trainer.should_stop = True
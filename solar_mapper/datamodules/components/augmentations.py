@@ -0,0 +1,143 @@
+"""Batched augmentation of multispectral chips on the device of the batch.
+
+DataLoader workers only load chips, the augmentations run on whole batches after they are moved
+to the accelerator (see `Sentinel2DataModule.on_after_batch_transfer`), or vectorized on the CPU
+when training on the CPU. Every sample draws its own transform, but there is no per-sample
+Python loop: the random choices are tensors and are applied with `torch.where` and gathers.
+
+Geometric transforms (flips, rotations by multiples of 90°, crops) are applied identically to
+all spatial tensors of a sample, so masks stay aligned with the imagery. Radiometric jitter
+only touches the imagery and keeps nodata pixels (0 in Sentinel-2, NaN in Sentinel-1) as they
+are.
+"""
+
+from typing import Dict, Optional, Sequence
+
+import torch
+from torch import nn
+
+
+def _where(flags: torch.Tensor, transformed: torch.Tensor, x: torch.Tensor) -> torch.Tensor:
+    return torch.where(flags.view(-1, *([1] * (x.dim() - 1))), transformed, x)
+
+
+def _band_shape(x: torch.Tensor) -> tuple:
+    # one value per sample and band, shared by the time steps of (N, T, C, H, W) sequences
+    return (x.shape[0], *[1] * (x.dim() - 4), x.shape[-3], 1, 1)
+
+
+def random_crop_indices(
+    batch_size: int, height: int, width: int, crop_size: int, device: torch.device
+):
+    """Row and column indices of a random `crop_size` window per sample, both (N, crop_size)."""
+    steps = torch.arange(crop_size, device=device)
+    top = torch.randint(0, height - crop_size + 1, (batch_size, 1), device=device)
+    left = torch.randint(0, width - crop_size + 1, (batch_size, 1), device=device)
+    return top + steps, left + steps
+
+
+def crop(x: torch.Tensor, rows: torch.Tensor, cols: torch.Tensor) -> torch.Tensor:
+    """Gathers a window per sample of (N, ..., H, W) `x`, see `random_crop_indices`."""
+    samples = torch.arange(x.shape[0], device=x.device).view(-1, 1, 1)
+    # time steps of sequences are cropped like channels
+    flat = x.reshape(x.shape[0], -1, *x.shape[-2:])
+    # advanced indices around a slice move to the front: (N, h, w, C)
+    windows = flat[samples, :, rows[:, :, None], cols[:, None, :]]
+    return windows.permute(0, 3, 1, 2).reshape(*x.shape[:-2], *windows.shape[1:3]).contiguous()
+
+
+class BatchAugmentation(nn.Module):
+    """Random flips, rotations, crops and per-band radiometric jitter of batches of chips."""
+
+    def __init__(
+        self,
+        flip: bool = True,
+        rotate: bool = True,
+        crop_size: Optional[int] = None,
+        s2_gain: float = 0.0,
+        s2_offset: float = 0.0,
+        s1_offset_db: float = 0.0,
+        spatial_keys: Sequence[str] = ("s2", "s1", "mask"),
+    ):
+        """Sets which transforms are applied and the ranges of the jitter.
+
+        Args:
+            flip: Randomly flip samples horizontally and vertically
+            rotate: Randomly rotate samples by multiples of 90°, with `flip` any of the 8
+                symmetries of the square, needs square chips
+            crop_size: Size of random square crops, no cropping if None
+            s2_gain: Maximum relative gain of each Sentinel-2 band, e.g. 0.05 for ±5%
+            s2_offset: Maximum offset added to each Sentinel-2 band, in digital numbers
+            s1_offset_db: Maximum offset added to each Sentinel-1 band, in decibels
+            spatial_keys: Keys of the (N, C, H, W) tensors of a batch that are transformed
+                geometrically, missing keys are ignored
+        """
+        super().__init__()
+        self.flip = flip
+        self.rotate = rotate
+        self.crop_size = crop_size
+        self.s2_gain = s2_gain
+        self.s2_offset = s2_offset
+        self.s1_offset_db = s1_offset_db
+        self.spatial_keys = tuple(spatial_keys)
+
+    @torch.no_grad()
+    def forward(self, batch: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+        """Augments a batch of `{"s2": int16, "s1": float16, "mask": uint8}` (N, C, H, W) tensors.
+
+        Sequences of (N, T, C, H, W) get the same transform and jitter at every time step.
+
+        Returns:
+            A new batch, tensors keep their dtype and device
+        """
+        batch = dict(batch)
+        keys = [key for key in self.spatial_keys if key in batch]
+        if keys:
+            batch.update(zip(keys, self.geometric([batch[key] for key in keys])))
+        if "s2" in batch and (self.s2_gain or self.s2_offset):
+            batch["s2"] = self.jitter_s2(batch["s2"])
+        if "s1" in batch and self.s1_offset_db:
+            batch["s1"] = self.jitter_s1(batch["s1"])
+        return batch
+
+    def geometric(self, tensors: Sequence[torch.Tensor]) -> Sequence[torch.Tensor]:
+        """Applies the same random flips, rotations and crops to each sample of `tensors`."""
+        batch_size, (height, width) = tensors[0].shape[0], tensors[0].shape[-2:]
+        if any(tuple(x.shape[-2:]) != (height, width) for x in tensors):
+            raise ValueError(f"Spatial tensors differ in size: {[x.shape for x in tensors]}")
+        device = tensors[0].device
+        tensors = list(tensors)
+
+        if self.crop_size is not None and self.crop_size < min(height, width):
+            rows, cols = random_crop_indices(batch_size, height, width, self.crop_size, device)
+            tensors = [crop(x, rows, cols) for x in tensors]
+            height = width = self.crop_size
+
+        if self.rotate:
+            if height != width:
+                raise ValueError(f"Rotations need square chips, got {height}x{width}")
+            # a transpose and the flips below compose to every rotation by a multiple of 90°
+            transpose = torch.rand(batch_size, device=device) < 0.5
+            tensors = [_where(transpose, x.transpose(-2, -1), x) for x in tensors]
+        if self.flip or self.rotate:
+            for dim in (-1, -2):
+                flipped = torch.rand(batch_size, device=device) < 0.5
+                tensors = [_where(flipped, x.flip(dim), x) for x in tensors]
+        return tensors
+
+    def jitter_s2(self, s2: torch.Tensor) -> torch.Tensor:
+        """Random per-band gain and offset of Sentinel-2 reflectances, 0 (nodata) is kept."""
+        shape = _band_shape(s2)
+        gain = 1 + self.s2_gain * (2 * torch.rand(shape, device=s2.device) - 1)
+        offset = self.s2_offset * (2 * torch.rand(shape, device=s2.device) - 1)
+        jittered = s2.float() * gain + offset
+        if not s2.is_floating_point():
+            # valid pixels must not turn into nodata
+            jittered = jittered.round().clamp(1, torch.iinfo(s2.dtype).max)
+        return torch.where(s2 == 0, s2, jittered.to(s2.dtype))
+
+    def jitter_s1(self, s1: torch.Tensor) -> torch.Tensor:
+        """Random per-band offset of Sentinel-1 backscatter in decibels, NaN stays NaN."""
+        shape = _band_shape(s1)
+        offset = self.s1_offset_db * (2 * torch.rand(shape, device=s1.device) - 1)
+        return (s1.float() + offset).to(s1.dtype)
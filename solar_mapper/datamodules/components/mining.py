@@ -0,0 +1,161 @@
+"""Hard-example mining: per-polygon training errors and the sampling weights derived from them.
+
+`HardExampleMining` (see `solar_mapper.callbacks.hard_example_mining`) records the error of every
+training chip into a `HardExampleTable`, a memory-mapped `.npy` file with one 16 byte row per
+polygon, and periodically turns the tables of all ranks into sampling weights. The training
+`Sentinel2PolygonDataset` reads the weights at the start of every pass, so remote reads go to:
+
+- polygons with a high loss
+- polygons with many false positives around them, e.g. greenhouses or rooftops in the chip
+- polygons never loaded before in regions (1° cells) whose polygons are hard, so new chips are
+  fetched next to the hard ones
+
+A share of the draws stays uniform, so easy polygons are still seen now and then.
+"""
+
+import math
+import os
+from typing import Optional, Sequence
+
+import numpy as np
+from shapely.geometry import shape
+
+TABLE_DTYPE = np.dtype(
+    [
+        ("loss", np.float32),
+        ("false_positives", np.float32),
+        ("count", np.uint32),
+        ("epoch", np.int32),
+    ]
+)
+WEIGHTS_FILE = "weights.npy"
+
+
+class HardExampleTable:
+    """Running means of the per-chip errors of each polygon, stored in a `.npy` file."""
+
+    def __init__(self, path: str, num_polygons: int, momentum: float = 0.9):
+        """Opens the table at `path`, or creates an empty one.
+
+        Args:
+            path: `.npy` file of the table, created if it doesn't exist, continued otherwise
+            num_polygons: Number of training polygons
+            momentum: Weight of the previous mean in each update, older chips fade out
+        """
+        self.path = path
+        self.momentum = momentum
+        if os.path.exists(path):
+            self.rows = np.load(path, mmap_mode="r+")
+            if self.rows.dtype != TABLE_DTYPE or len(self.rows) != num_polygons:
+                raise ValueError(f"<{path}> isn't a table of {num_polygons} polygons")
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.rows = np.lib.format.open_memmap(
+                path, mode="w+", dtype=TABLE_DTYPE, shape=(num_polygons,)
+            )
+
+    def record(
+        self,
+        polygons: np.ndarray,
+        losses: np.ndarray,
+        false_positives: np.ndarray,
+        epoch: int = 0,
+    ) -> None:
+        """Adds the errors of chips of `polygons`, the first chip of a polygon sets its mean."""
+        for polygon, loss, false_positive in zip(polygons, losses, false_positives):
+            row = self.rows[polygon]
+            weight = self.momentum if row["count"] else 0.0
+            self.rows[polygon] = (
+                weight * row["loss"] + (1 - weight) * loss,
+                weight * row["false_positives"] + (1 - weight) * false_positive,
+                row["count"] + 1,
+                epoch,
+            )
+
+    def flush(self) -> None:
+        self.rows.flush()
+
+
+def merge_tables(tables: Sequence[np.ndarray]) -> np.ndarray:
+    """Merges the tables of all ranks into one row per polygon.
+
+    Ranks usually record disjoint shares of the polygons, but after resuming with another world
+    size the tables of the earlier run overlap with the new ones. The row of the latest epoch
+    wins, rows of the same epoch are averaged, weighted by their number of chips.
+
+    Args:
+        tables: Rows of the `HardExampleTable` of each rank, of the same polygons
+
+    Returns:
+        Merged rows, with a count of 0 for polygons no rank has seen
+    """
+    merged = np.zeros(len(tables[0]), dtype=TABLE_DTYPE)
+    for table in tables:
+        seen = table["count"] > 0
+        empty = merged["count"] == 0
+        newer = seen & (empty | (table["epoch"] > merged["epoch"]))
+        same = seen & ~empty & (table["epoch"] == merged["epoch"])
+        if same.any():
+            count = merged["count"][same].astype(np.float64)
+            other = table["count"][same].astype(np.float64)
+            total = count + other
+            for key in ("loss", "false_positives"):
+                merged[key][same] = (count * merged[key][same] + other * table[key][same]) / total
+            merged["count"][same] += table["count"][same]
+        merged[newer] = table[newer]
+    return merged
+
+
+def polygon_cells(features: Sequence[dict]) -> np.ndarray:
+    """Index of the 1° cell of each polygon, the regions errors are shared in."""
+    cells = np.empty(len(features), dtype=np.int64)
+    for i, feature in enumerate(features):
+        point = shape(feature["geometry"]).representative_point()
+        cells[i] = (math.floor(point.y) + 90) * 360 + math.floor(point.x) + 180
+    return cells
+
+
+def sampling_weights(
+    table: np.ndarray,
+    cells: np.ndarray,
+    false_positive_weight: float = 1.0,
+    region_weight: float = 0.5,
+    uniform: float = 0.2,
+) -> np.ndarray:
+    """Probability of drawing each polygon, from its errors and the errors of its region.
+
+    Args:
+        table: Rows of a `HardExampleTable`, merged over ranks
+        cells: Region of each polygon, see `polygon_cells`
+        false_positive_weight: Weight of the false positive fraction next to the loss
+        region_weight: Share of the score taken from the mean score of the polygon's region
+        uniform: Share of the probability spread evenly over all polygons
+
+    Returns:
+        Probabilities summing to 1
+    """
+    seen = table["count"] > 0
+    if not seen.any():
+        return np.full(len(table), 1 / len(table))
+    score = table["loss"].astype(np.float64) + false_positive_weight * table["false_positives"]
+    # polygons never loaded count as average ones, before their region is taken into account
+    score = np.where(seen, score, score[seen].mean())
+    _, region = np.unique(cells, return_inverse=True)
+    region_score = np.bincount(region, weights=score) / np.bincount(region)
+    score = (1 - region_weight) * score + region_weight * region_score[region]
+    return (1 - uniform) * score / score.sum() + uniform / len(score)
+
+
+def write_sampling_weights(mining_dir: str, weights: np.ndarray) -> None:
+    """Replaces the weights read by the datasets, which never see a partially written file."""
+    os.makedirs(mining_dir, exist_ok=True)
+    temporary = os.path.join(mining_dir, f"{WEIGHTS_FILE}.{os.getpid()}.tmp")
+    with open(temporary, "wb") as file:
+        np.save(file, weights)
+    os.replace(temporary, os.path.join(mining_dir, WEIGHTS_FILE))
+
+
+def load_sampling_weights(mining_dir: str) -> Optional[np.ndarray]:
+    """Weights written by `write_sampling_weights`, None before the first reweighting."""
+    path = os.path.join(mining_dir, WEIGHTS_FILE)
+    return np.load(path) if os.path.exists(path) else None
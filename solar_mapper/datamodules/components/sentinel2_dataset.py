@@ -0,0 +1,689 @@
+import math
+import os
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from shapely.geometry import shape
+from torch.utils.data import IterableDataset, get_worker_info
+
+from solar_mapper.datamodules.components.mining import load_sampling_weights
+from solar_mapper.dataset.geojson_stream import iter_features
+from solar_mapper.dataset.negatives import NegativeSampler
+from solar_mapper.dataset.resilience import RemoteReadError, get_remote_io, skip_failed_example
+from solar_mapper.models.components.super_resolution import SuperResolutionStage
+from solar_mapper.preprocessing.stages import (
+    cached_polygons,
+    chip_path,
+    load_chip,
+    read_chip_manifest,
+    seed_calendar,
+)
+
+if TYPE_CHECKING:
+    # the geo stack is only imported by the processes that load chips, see `load_sample`
+    import xarray as xr
+
+METRES_PER_DEGREE = 111_320.0
+
+# Sentinel-2 reflectances are stored as uint16 but stay well below the int16 maximum, so chips are
+# handed around as int16, which torch supports everywhere, and only converted to float on device
+S2_CHIP_DTYPE = np.int16
+S1_CHIP_DTYPE = np.float16
+
+
+def chip_bbox(
+    feature: dict, chip_size: int, resolution: int = 10, margin: float = 1.5
+) -> Tuple[float, float, float, float]:
+    """Lat/Lon bounding box around the centroid of a feature that covers a chip.
+
+    Args:
+        feature: GeoJSON feature
+        chip_size: Size of the chip in pixels
+        resolution: Resolution of the chip in metres
+        margin: Factor to grow the box by, leaving room for jitter and UTM/Lat-Lon distortion
+
+    Returns:
+        Bounding box as (minx, miny, maxx, maxy)
+    """
+    centroid = shape(feature["geometry"]).centroid
+    half_size = chip_size * resolution * margin / 2
+    d_lat = half_size / METRES_PER_DEGREE
+    d_lon = half_size / (METRES_PER_DEGREE * max(math.cos(math.radians(centroid.y)), 1e-6))
+    return centroid.x - d_lon, centroid.y - d_lat, centroid.x + d_lon, centroid.y + d_lat
+
+
+def chip_window(
+    mask: np.ndarray, chip_size: int, rng: Optional[np.random.Generator] = None
+) -> Tuple[slice, slice]:
+    """Window of `chip_size` pixels centred on the mask, optionally jittered.
+
+    Args:
+        mask: Segmentation mask of the stack
+        chip_size: Size of the chip in pixels
+        rng: Random generator to jitter the centre with, no jitter if None
+
+    Returns:
+        Slices along y and x, clipped to the stack
+    """
+    height, width = mask.shape
+    nonzero = np.nonzero(mask)
+    if len(nonzero[0]):
+        centre_y, centre_x = int(np.mean(nonzero[0])), int(np.mean(nonzero[1]))
+    else:
+        centre_y, centre_x = height // 2, width // 2
+    if rng is not None:
+        centre_y += int(rng.integers(-chip_size // 4, chip_size // 4 + 1))
+        centre_x += int(rng.integers(-chip_size // 4, chip_size // 4 + 1))
+    y0 = int(np.clip(centre_y - chip_size // 2, 0, max(height - chip_size, 0)))
+    x0 = int(np.clip(centre_x - chip_size // 2, 0, max(width - chip_size, 0)))
+    return slice(y0, y0 + chip_size), slice(x0, x0 + chip_size)
+
+
+def to_chip(data: np.ndarray, chip_size: int) -> np.ndarray:
+    """Zero-pads the trailing two dimensions of `data` up to `chip_size`."""
+    pad_y, pad_x = chip_size - data.shape[-2], chip_size - data.shape[-1]
+    if pad_y or pad_x:
+        padding = [(0, 0)] * (data.ndim - 2) + [(0, pad_y), (0, pad_x)]
+        data = np.pad(data, padding)
+    return data
+
+
+def upsample_nearest(data: np.ndarray, scale: int) -> np.ndarray:
+    """Repeats each pixel of the trailing two dimensions `scale` times."""
+    return data.repeat(scale, axis=-2).repeat(scale, axis=-1)
+
+
+def stack_to_array(stack: "xr.Dataset", bands: Sequence[str], dtype: np.dtype) -> np.ndarray:
+    """Computes the first time step of `bands` as a (C, H, W) array of `dtype`."""
+    data = stack[list(bands)].isel(time=0).to_array().values
+    if np.issubdtype(dtype, np.integer):
+        data = np.minimum(data, np.iinfo(dtype).max)
+    return data.astype(dtype)
+
+
+def stack_to_chip(
+    stack: "xr.Dataset",
+    bands: Sequence[str],
+    window: Tuple[slice, slice],
+    chip_size: int,
+    dtype: np.dtype,
+) -> np.ndarray:
+    """Computes the first time step of `bands` in `window` as a (C, H, W) array of `dtype`."""
+    data = stack[list(bands)].isel(time=0, y=window[0], x=window[1]).to_array().values
+    if np.issubdtype(dtype, np.integer):
+        data = np.minimum(data, np.iinfo(dtype).max)
+    return to_chip(data.astype(dtype), chip_size)
+
+
+def stack_to_steps(
+    stack: "xr.Dataset",
+    bands: Sequence[str],
+    length: int,
+    dtype: np.dtype,
+    window: Optional[Tuple[slice, slice]] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Computes the first `length` time steps of `bands`, in `window` if given.
+
+    Returns:
+        A (t, C, H, W) array of `dtype`, t <= `length`, and the datetime64 time of each step
+    """
+    stack = stack[list(bands)].isel(time=slice(0, length))
+    if window is not None:
+        stack = stack.isel(y=window[0], x=window[1])
+    data = stack.to_array("band").transpose("time", "band", "y", "x").values
+    if np.issubdtype(dtype, np.integer):
+        data = np.minimum(data, np.iinfo(dtype).max)
+    return data.astype(dtype), stack.time.values
+
+
+def to_sequence(data: np.ndarray, length: int, chip_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Zero-pads (t, C, h, w) `data` to a (`length`, C, `chip_size`, `chip_size`) sequence.
+
+    Returns:
+        The sequence, and a boolean mask of its steps that hold data
+    """
+    steps, channels, height, width = data.shape
+    sequence = np.zeros((length, channels, chip_size, chip_size), dtype=data.dtype)
+    sequence[:steps, :, :height, :width] = data[:length]
+    valid = np.arange(length) < steps
+    return sequence, valid
+
+
+def time_deltas(times: np.ndarray, reference: np.datetime64, length: int) -> np.ndarray:
+    """Days from `reference` to each of `times`, as int16 padded with zeros to `length`."""
+    days = np.zeros(length, dtype=np.int16)
+    deltas = (times[:length] - reference) / np.timedelta64(1, "D")
+    days[: len(deltas)] = np.round(deltas)
+    return days
+
+
+def load_polygons(path: str, properties: Optional[Sequence[str]] = None) -> List[dict]:
+    """Loads the features of a GeoJSON file, local or remote, streaming it feature by feature."""
+    return list(iter_features(path, properties=properties))
+
+
+class Sentinel2PolygonDataset(IterableDataset):
+    """Streams Sentinel-2 (+Sentinel-1) chips with PV segmentation masks around polygons.
+
+    Each sample picks a random polygon, searches a random time window for imagery of it, and
+    loads only the requested bands inside a bounding box around the polygon. Samples are dicts
+    with `s2` (int16, C x H x W), `mask` (uint8, 1 x H x W), `polygon` (int64, the index of the
+    polygon) and, if `s1_bands` is not empty, `s1` (float16, C x H x W).
+
+    With a `sequence_length` T, `s2` and `s1` hold the first T acquisitions (T x C x H x W) of
+    the least cloudy scenes in the window, in time order and zero-padded when fewer are found.
+    `s2_valid` and `s1_valid` (bool, T) mark the acquisitions, `s2_days` and `s1_days` (int16, T)
+    are their days since the first Sentinel-2 one. Both collections are on the grid of the
+    Sentinel-2 chip and keep their 16 bit dtypes, so a batch is a few dense tensors.
+
+    A `negative_fraction` of the samples are random locations without PV instead, drawn by a
+    `NegativeSampler`, with all-zero masks and a `polygon` of -1. The negatives of each block
+    of `negative_block` samples share one catalog search, so they cost no more catalog calls
+    than the samples of polygons.
+
+    With a `super_resolution` stage, a `scale` times smaller area is loaded and Sentinel-2 is
+    super-resolved before the chip is cut out, so chips keep `chip_size` pixels at a finer
+    resolution. The whole loaded area goes through the stage, which caches it, so jittered
+    chips of a scene that was seen before don't recompute it.
+
+    With a `chip_cache`, samples are read from the chips `prepare.py` materialized for the same
+    polygons instead, so nothing is loaded remotely. With an `acquisition_index`, the time windows
+    are drawn from the acquisition dates its index stage found, without a catalog search per
+    polygon.
+    """
+
+    def __init__(
+        self,
+        polygons: str,
+        start_time: str,
+        end_time: str,
+        search_delta_days: int = 90,
+        bands: Sequence[str] = ("B02", "B03", "B04", "B08"),
+        s1_bands: Sequence[str] = (),
+        native_resolution: bool = True,
+        chip_size: int = 256,
+        num_samples: int = 1,
+        samples_per_epoch: int = 1000,
+        jitter: bool = True,
+        seed: Optional[int] = None,
+        profiles: Optional[Dict[str, dict]] = None,
+        super_resolution: Optional[SuperResolutionStage] = None,
+        label_store: Optional[str] = None,
+        rank: int = 0,
+        world_size: int = 1,
+        chip_cache: Optional[str] = None,
+        mining_dir: Optional[str] = None,
+        negative_fraction: float = 0.0,
+        negative_strata: Optional[str] = None,
+        negative_exclusions: Sequence[str] = (),
+        negative_block: int = 64,
+        sequence_length: Optional[int] = None,
+        acquisition_index: Optional[str] = None,
+    ):
+        """Describes what is loaded for each sample; polygons are read lazily, per process.
+
+        Args:
+            polygons: Path or URL of the GeoJSON file with the PV polygons
+            start_time: ISO date of the start of the period to sample imagery from
+            end_time: ISO date of the end of the period to sample imagery from
+            search_delta_days: Length of the time window searched for each sample
+            bands: Sentinel-2 bands to load
+            s1_bands: Sentinel-1 bands to load, no Sentinel-1 if empty
+            native_resolution: Read 20/60m bands at their native resolution and upsample them
+            chip_size: Size of the chips in pixels
+            num_samples: Maximum number of scenes loaded per collection for each sample
+            samples_per_epoch: Number of samples in one pass over the dataset
+            jitter: Randomly offset the chip around the polygon
+            seed: Seed for the sampling, random if None
+            profiles: Loading profiles, see `solar_mapper.dataset.loading_profiles`
+            super_resolution: Stage to super-resolve Sentinel-2 with before chipping
+            label_store: Path or URL of a label store (see `solar_mapper.dataset.label_store`)
+                to read masks from, instead of rasterizing the sampled polygon
+            rank: Rank of this process in distributed training
+            world_size: Number of processes in distributed training, each draws its share of
+                `samples_per_epoch` from its own share of the polygons
+            chip_cache: Output directory of `prepare.py` with chips of these polygons, only read,
+                so many runs can share it
+            mining_dir: Directory of the sampling weights of hard-example mining, see
+                `solar_mapper.datamodules.components.mining`, polygons are drawn uniformly
+                until the first weights are written
+            negative_fraction: Share of the samples at random locations without PV
+            negative_strata: GeoJSON file of the regions negatives are drawn from, e.g.
+                continents or land-cover classes, see `solar_mapper.dataset.negatives`, the 1°
+                cells of the polygons if None
+            negative_exclusions: GeoJSON files of more known PV, negatives are kept away from
+                them and from `polygons`
+            negative_block: Number of consecutive samples whose negatives are searched together
+            sequence_length: Number of time steps of each collection in sequence mode, as many
+                scenes are loaded, replacing `num_samples`, single time steps if None
+            acquisition_index: Output directory of `prepare.py` with an index of these polygons,
+                read by every worker process that loads chips remotely
+        """
+        super().__init__()
+        self.polygons = polygons
+        self.start_time = datetime.fromisoformat(start_time)
+        self.end_time = datetime.fromisoformat(end_time)
+        self.search_delta = timedelta(days=search_delta_days)
+        self.bands = list(bands)
+        self.s1_bands = list(s1_bands)
+        self.native_resolution = native_resolution
+        self.chip_size = chip_size
+        self.sequence_length = sequence_length
+        self.num_samples = sequence_length or num_samples
+        self.samples_per_epoch = samples_per_epoch
+        self.jitter = jitter
+        self.profiles = profiles
+        self.super_resolution = super_resolution
+        self.label_store = None
+        if label_store:
+            from solar_mapper.dataset.label_store import LabelStore
+
+            self.label_store = LabelStore(label_store)
+        self.rank = rank
+        self.world_size = world_size
+        self.chip_cache = chip_cache
+        self.mining_dir = mining_dir
+        self.acquisition_index = acquisition_index
+        # process whose calendar holds the index, worker processes read it themselves
+        self._indexed_pid: Optional[int] = None
+        if not 0 <= negative_fraction <= 1:
+            raise ValueError(f"`negative_fraction` must be in [0, 1], got {negative_fraction}")
+        if negative_fraction and chip_cache is not None:
+            raise ValueError("Negatives are loaded remotely, they can't be read from a chip cache")
+        self.negative_fraction = negative_fraction
+        self.negative_strata = negative_strata
+        self.negative_exclusions = list(negative_exclusions)
+        self.negative_block = negative_block
+        self._negative_sampler: Optional[NegativeSampler] = None
+        # drawn here when not given, so a checkpoint can store it
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy)
+        # epoch, consumed batches of it and their size, see `set_progress`
+        self.progress = torch.tensor([0, 0, 1]).share_memory_()
+        self._features: Optional[List[dict]] = None
+        if chip_cache is not None:
+            # chips of other polygons or settings would silently train on the wrong data
+            manifest = read_chip_manifest(chip_cache)
+            if manifest != self.chip_manifest():
+                raise ValueError(
+                    f"Chips in <{chip_cache}> were prepared with {manifest}, "
+                    f"not {self.chip_manifest()}"
+                )
+
+    @property
+    def features(self) -> List[dict]:
+        # Loaded lazily, so each worker process reads the polygons itself
+        if self._features is None:
+            self._features = load_polygons(self.polygons)
+        return self._features
+
+    @property
+    def negative_sampler(self) -> NegativeSampler:
+        # built lazily, like `features`, in each worker process
+        if self._negative_sampler is None:
+            exclusions = list(self.features)
+            for path in self.negative_exclusions:
+                exclusions.extend(load_polygons(path))
+            self._negative_sampler = NegativeSampler(
+                exclusions,
+                strata=load_polygons(self.negative_strata) if self.negative_strata else None,
+                # half the area loaded around a point by `chip_bbox`
+                exclusion_m=self.chip_size * 10 * 0.75,
+            )
+        return self._negative_sampler
+
+    @property
+    def rank_polygons(self) -> range:
+        """Indices of the polygons sampled by this rank, so ranks don't load the same scenes."""
+        if self.world_size == 1 or len(self.features) < self.world_size:
+            return range(len(self.features))
+        return range(self.rank, len(self.features), self.world_size)
+
+    @property
+    def rank_features(self) -> List[dict]:
+        """Polygons sampled by this rank."""
+        return [self.features[polygon] for polygon in self.rank_polygons]
+
+    def chip_manifest(self) -> Dict[str, Any]:
+        """Settings that determine the chips, recorded by `prepare.py` next to the chips."""
+        manifest = {
+            "polygons": self.polygons,
+            "bands": self.bands,
+            "s1_bands": self.s1_bands,
+            "chip_size": self.chip_size,
+            "scale": self.super_resolution.scale if self.super_resolution is not None else 1,
+        }
+        if self.sequence_length:
+            manifest["sequence_length"] = self.sequence_length
+        return manifest
+
+    def __len__(self) -> int:
+        # samples of this rank, lightning counts the steps of an epoch per rank; every rank gets
+        # as many, so all of them run the same number of DDP steps
+        return math.ceil(self.samples_per_epoch / self.world_size)
+
+    def load_sample(self, example: dict, rng: np.random.Generator) -> Dict[str, torch.Tensor]:
+        """Loads the chip for a single polygon, raises ValueError if no imagery was found."""
+        from solar_mapper.dataset.sentinel_2 import get_example_with_segmentation_map
+
+        scale = self.super_resolution.scale if self.super_resolution is not None else 1
+        stack_s2, stack_s1 = get_example_with_segmentation_map(
+            example,
+            self.start_time,
+            self.end_time,
+            self.search_delta,
+            self.num_samples,
+            bands=self.bands,
+            s1_bands=self.s1_bands,
+            native_resolution=self.native_resolution,
+            bbox=chip_bbox(example, self.chip_size, resolution=10 / scale),
+            profiles=self.profiles,
+            label_store=self.label_store,
+        )
+        return self._chip(stack_s2, stack_s1, rng)
+
+    def load_negative(
+        self,
+        point: dict,
+        items: list,
+        s1_items: Optional[list],
+        rng: np.random.Generator,
+    ) -> Dict[str, torch.Tensor]:
+        """Loads the chip of a location without PV from its scenes, raises ValueError if none."""
+        from solar_mapper.dataset.sentinel_2 import get_negative_example, sign_items
+
+        scale = self.super_resolution.scale if self.super_resolution is not None else 1
+        # the scenes were found for the whole block, their tokens may have expired since, or been
+        # dropped by the retry of an auth error
+        stack_s2, stack_s1 = get_negative_example(
+            sign_items(items),
+            sign_items(s1_items) if s1_items is not None else None,
+            bands=self.bands,
+            s1_bands=self.s1_bands,
+            native_resolution=self.native_resolution,
+            bbox=chip_bbox(point, self.chip_size, resolution=10 / scale),
+            profiles=self.profiles,
+        )
+        return self._chip(stack_s2, stack_s1, rng)
+
+    def _chip(
+        self, stack_s2: "xr.Dataset", stack_s1: Optional["xr.Dataset"], rng: np.random.Generator
+    ) -> Dict[str, torch.Tensor]:
+        """Cuts the chip out of the stacks, around the `segmentation_map` of the Sentinel-2 one."""
+        if self.sequence_length:
+            return self._sequence_sample(stack_s2, stack_s1, rng)
+        if self.super_resolution is not None and self.super_resolution.scale > 1:
+            return self._super_resolved_sample(stack_s2, stack_s1, rng)
+
+        mask = stack_s2["segmentation_map"].values
+        window = chip_window(mask, self.chip_size, rng if self.jitter else None)
+        sample = {
+            "s2": torch.from_numpy(
+                stack_to_chip(stack_s2, self.bands, window, self.chip_size, S2_CHIP_DTYPE)
+            ),
+            "mask": torch.from_numpy(
+                to_chip(mask[None, window[0], window[1]].astype(np.uint8), self.chip_size)
+            ),
+        }
+        if self.s1_bands:
+            sample["s1"] = torch.from_numpy(
+                stack_to_chip(stack_s1, self.s1_bands, window, self.chip_size, S1_CHIP_DTYPE)
+            )
+        return sample
+
+    def _super_resolved_sample(
+        self, stack_s2: "xr.Dataset", stack_s1: Optional["xr.Dataset"], rng: np.random.Generator
+    ) -> Dict[str, torch.Tensor]:
+        scale = self.super_resolution.scale
+        s2 = self.super_resolution(stack_to_array(stack_s2, self.bands, S2_CHIP_DTYPE)[None])[0]
+        mask = upsample_nearest(stack_s2["segmentation_map"].values.astype(np.uint8), scale)
+        window = chip_window(mask, self.chip_size, rng if self.jitter else None)
+        sample = {
+            "s2": torch.from_numpy(to_chip(s2[:, window[0], window[1]], self.chip_size)),
+            "mask": torch.from_numpy(to_chip(mask[None, window[0], window[1]], self.chip_size)),
+        }
+        if self.s1_bands:
+            s1 = upsample_nearest(stack_to_array(stack_s1, self.s1_bands, S1_CHIP_DTYPE), scale)
+            sample["s1"] = torch.from_numpy(to_chip(s1[:, window[0], window[1]], self.chip_size))
+        return sample
+
+    def _sequence_sample(
+        self, stack_s2: "xr.Dataset", stack_s1: Optional["xr.Dataset"], rng: np.random.Generator
+    ) -> Dict[str, torch.Tensor]:
+        length = self.sequence_length
+        scale = self.super_resolution.scale if self.super_resolution is not None else 1
+        mask = stack_s2["segmentation_map"].values.astype(np.uint8)
+        if scale > 1:
+            mask = upsample_nearest(mask, scale)
+        window = chip_window(mask, self.chip_size, rng if self.jitter else None)
+        sample = {
+            "mask": torch.from_numpy(to_chip(mask[None, window[0], window[1]], self.chip_size))
+        }
+
+        if scale > 1:
+            # the time steps are super-resolved as one batch
+            s2, times = stack_to_steps(stack_s2, self.bands, length, S2_CHIP_DTYPE)
+            s2 = self.super_resolution(s2)[:, :, window[0], window[1]]
+        else:
+            s2, times = stack_to_steps(stack_s2, self.bands, length, S2_CHIP_DTYPE, window)
+        collections = [("s2", s2, times)]
+        if self.s1_bands:
+            if scale > 1:
+                s1, s1_times = stack_to_steps(stack_s1, self.s1_bands, length, S1_CHIP_DTYPE)
+                s1 = upsample_nearest(s1, scale)[:, :, window[0], window[1]]
+            else:
+                s1, s1_times = stack_to_steps(
+                    stack_s1, self.s1_bands, length, S1_CHIP_DTYPE, window
+                )
+            collections.append(("s1", s1, s1_times))
+
+        for name, data, steps in collections:
+            sequence, valid = to_sequence(data, length, self.chip_size)
+            sample[name] = torch.from_numpy(sequence)
+            sample[f"{name}_valid"] = torch.from_numpy(valid)
+            sample[f"{name}_days"] = torch.from_numpy(time_deltas(steps, times[0], length))
+        return sample
+
+    def sample_rng(self, epoch: int, shard: int, index: int) -> np.random.Generator:
+        """Generator of one sample, a block of the counter-based Philox stream of the seed.
+
+        Any sample of any epoch can be drawn without drawing the ones before it, which is what
+        lets a resumed run continue exactly where it stopped.
+        """
+        return np.random.Generator(
+            np.random.Philox(key=self.seed, counter=[0, index, shard, epoch])
+        )
+
+    def set_progress(self, epoch: int, batches: int = 0, batch_size: int = 1) -> None:
+        """Sets the epoch, and the number of its batches already consumed, of the next pass.
+
+        The progress is in shared memory, so it also reaches worker processes started before,
+        like persistent workers.
+        """
+        self.progress[:] = torch.tensor([epoch, batches, batch_size])
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info else 1
+        worker_id = worker_info.id if worker_info else 0
+
+        epoch, batches, batch_size = self.progress.tolist()
+        worker_samples = [len(range(w, len(self), num_workers)) for w in range(num_workers)]
+        # continues after the batches consumed before the run was interrupted
+        worker_id, start = resume_order(worker_samples, batch_size, batches)[worker_id]
+        # every worker of every rank draws its own samples
+        shard = self.rank * num_workers + worker_id
+
+        if self.chip_cache is not None:
+            draw, polygons = self._draw_cached, self._cached_polygons()
+        else:
+            draw, polygons = self._draw, self.rank_polygons
+            self._seed_calendar()
+        cdf = None
+        weights = load_sampling_weights(self.mining_dir) if self.mining_dir else None
+        if weights is not None:
+            # read once per pass, the weights are replaced between epochs by `HardExampleMining`
+            cdf = np.cumsum(weights[np.asarray(polygons)])
+            cdf /= cdf[-1]
+
+        end = worker_samples[worker_id]
+        while start < end:
+            block = start // self.negative_block
+            rngs = [
+                self.sample_rng(epoch, shard, index)
+                for index in range(start, min((block + 1) * self.negative_block, end))
+            ]
+            negatives = self._negatives(epoch, shard, block, rngs)
+            for offset, rng in enumerate(rngs):
+                # the time window search draws from the global numpy generator
+                np.random.seed(rng.integers(2**32))
+                sample = None
+                if offset in negatives:
+                    sample = self._draw_negative(rng, *negatives[offset])
+                # negatives without imagery are replaced by a polygon
+                yield sample if sample is not None else draw(rng, polygons, cdf)
+            start += len(rngs)
+
+    def _seed_calendar(self) -> None:
+        """Adds the indexed acquisition dates of this rank's polygons to the process' calendar."""
+        if self.acquisition_index is None or self._indexed_pid == os.getpid():
+            return
+        from solar_mapper.dataset.sentinel_2 import ACQUISITION_CALENDAR
+
+        polygons = set(self.rank_polygons)
+        seed_calendar(ACQUISITION_CALENDAR, self.acquisition_index, polygons=polygons)
+        self._indexed_pid = os.getpid()
+
+    def _negatives(
+        self, epoch: int, shard: int, block: int, rngs: Sequence[np.random.Generator]
+    ) -> Dict[int, Tuple[dict, list, Optional[list]]]:
+        """Locations and scenes of the negatives among the samples of `rngs`, by position."""
+        if not self.negative_fraction:
+            return {}
+        points = {}
+        for offset, rng in enumerate(rngs):
+            if rng.random() < self.negative_fraction:
+                try:
+                    points[offset] = self.negative_sampler.draw(rng)
+                except ValueError:
+                    continue
+        if not points:
+            return {}
+
+        from solar_mapper.dataset.sentinel_2 import search_items_per_point
+
+        # one window of the block, drawn from a stream apart from the samples'
+        rng = np.random.Generator(np.random.Philox(key=self.seed, counter=[1, block, shard, epoch]))
+        span = self.end_time - self.start_time - self.search_delta
+        window_start = self.start_time + span * rng.random()
+        period = f"{window_start:%Y-%m-%d}/{window_start + self.search_delta:%Y-%m-%d}"
+        features = list(points.values())
+        try:
+            items = search_items_per_point(features, period, num_samples=self.num_samples)
+            s1_items = [None] * len(features)
+            if self.s1_bands:
+                s1_items = search_items_per_point(
+                    features, period, "sentinel-1-rtc", num_samples=self.num_samples
+                )
+        except RemoteReadError as error:
+            skip_failed_example(error)
+            return {}
+        return {
+            offset: (point, s2, s1)
+            for (offset, point), s2, s1 in zip(points.items(), items, s1_items)
+        }
+
+    def _draw_negative(
+        self, rng: np.random.Generator, point: dict, items: list, s1_items: Optional[list]
+    ) -> Optional[Dict[str, torch.Tensor]]:
+        try:
+            sample = get_remote_io().call("cog", self.load_negative, point, items, s1_items, rng)
+        except ValueError:
+            return None
+        except RemoteReadError as error:
+            skip_failed_example(error)
+            return None
+        sample["polygon"] = torch.tensor(-1)
+        return sample
+
+    @staticmethod
+    def _pick(rng: np.random.Generator, polygons: Sequence[int], cdf: Optional[np.ndarray]) -> int:
+        if cdf is None:
+            return polygons[rng.integers(len(polygons))]
+        return polygons[min(np.searchsorted(cdf, rng.random(), side="right"), len(cdf) - 1)]
+
+    def _draw(
+        self, rng: np.random.Generator, polygons: Sequence[int], cdf: Optional[np.ndarray]
+    ) -> Dict[str, torch.Tensor]:
+        while True:
+            polygon = self._pick(rng, polygons, cdf)
+            try:
+                # the chips are computed, and the COGs read, inside the call
+                sample = get_remote_io().call("cog", self.load_sample, self.features[polygon], rng)
+            except ValueError:
+                continue
+            except RemoteReadError as error:
+                skip_failed_example(error)
+                continue
+            sample["polygon"] = torch.tensor(polygon)
+            return sample
+
+    def _draw_cached(
+        self, rng: np.random.Generator, polygons: Sequence[int], cdf: Optional[np.ndarray]
+    ) -> Dict[str, torch.Tensor]:
+        polygon = self._pick(rng, polygons, cdf)
+        sample = load_chip(chip_path(self.chip_cache, polygon))
+        sample["polygon"] = torch.tensor(polygon)
+        return sample
+
+    def _cached_polygons(self) -> List[int]:
+        # polygons without a chip had no imagery when the cache was prepared
+        polygons = cached_polygons(self.chip_cache)
+        if self.world_size > 1:
+            # the same share of the polygons as `rank_polygons`
+            polygons = [p for p in polygons if p % self.world_size == self.rank] or polygons
+        if not polygons:
+            raise ValueError(f"No chips in <{self.chip_cache}>")
+        return polygons
+
+
+def resume_order(
+    worker_samples: Sequence[int], batch_size: int, batches: int
+) -> List[Tuple[int, int]]:
+    """Samples each DataLoader worker continues a pass with, after its first `batches` batches.
+
+    Every worker batches its own samples, and the DataLoader returns their batches in turn,
+    skipping workers that ran out of samples. A new DataLoader starts again with its first
+    worker, so the workers take over the samples of the workers in the order their next
+    batches were due, which keeps the order of the interrupted pass.
+
+    Args:
+        worker_samples: Number of samples of each worker in the pass
+        batch_size: Batch size of the DataLoader
+        batches: Number of batches returned before
+
+    Returns:
+        For each worker, the worker whose samples it draws and the first of them
+    """
+    num_workers = len(worker_samples)
+    remaining = [math.ceil(samples / batch_size) for samples in worker_samples]
+    consumed = [0] * num_workers
+    worker = 0
+    for _ in range(min(batches, sum(remaining))):
+        while not remaining[worker]:
+            worker = (worker + 1) % num_workers
+        consumed[worker] += 1
+        remaining[worker] -= 1
+        worker = (worker + 1) % num_workers
+    rotation = [(worker + i) % num_workers for i in range(num_workers)]
+    # finished workers go last, they only end the pass
+    order = [w for w in rotation if remaining[w]] + [w for w in rotation if not remaining[w]]
+    return [(w, min(consumed[w] * batch_size, worker_samples[w])) for w in order]
+
+
+def resolve_path(path: str, data_dir: str) -> str:
+    """Returns `path` relative to `data_dir` unless it is absolute or a URL."""
+    if "://" in path or os.path.isabs(path):
+        return path
+    return os.path.join(data_dir, path)
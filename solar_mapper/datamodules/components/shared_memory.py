@@ -0,0 +1,173 @@
+"""Shared-memory ring buffer handing batches from DataLoader workers to the training process.
+
+By default every batch collated in a worker is moved to a new shared-memory segment, whose file
+descriptors are sent to the training process, which maps it and unmaps it again once the batch
+is freed. For large multispectral chips that is several segments per batch created, mapped and
+torn down. The ring allocates its slots once, before the workers start, workers collate straight
+into a slot, and only `(slot, generation, size)` goes through the result queue.
+
+Each worker owns `slots_per_worker` slots and uses them in turn, so no locks are needed. The
+training process releases a slot `hold_batches` batches after it was yielded (Lightning holds the
+current batch and prefetches the next), and a worker only writes to a slot once its previous
+batch was released. If it wasn't, the worker falls back to the default path for that batch
+instead of waiting, so a slow consumer never deadlocks the loader.
+"""
+
+from collections import deque
+from typing import Any, Dict, Iterator, NamedTuple, Sequence, Tuple, Union
+
+import torch
+from torch.utils.data import DataLoader, default_collate, get_worker_info
+
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+# shape and dtype of each tensor of a single sample
+SampleSpec = Dict[str, Tuple[Tuple[int, ...], torch.dtype]]
+
+
+class SharedBatch(NamedTuple):
+    """Handle of a batch written to the ring."""
+
+    slot: int
+    generation: int
+    size: int
+
+
+class SharedMemoryRing:
+    """Preallocated shared-memory slots holding one collated batch each."""
+
+    def __init__(self, spec: SampleSpec, batch_size: int, num_workers: int, slots_per_worker: int):
+        """Allocates the slots of all the workers in shared memory.
+
+        Args:
+            spec: Shape and dtype of each tensor of a sample
+            batch_size: Maximum number of samples in a batch
+            num_workers: Number of DataLoader workers writing to the ring
+            slots_per_worker: Number of slots of each worker
+        """
+        self.spec = dict(spec)
+        self.batch_size = batch_size
+        self.slots_per_worker = slots_per_worker
+        num_slots = num_workers * slots_per_worker
+        self.buffers = {
+            key: torch.empty((num_slots, batch_size, *shape), dtype=dtype).share_memory_()
+            for key, (shape, dtype) in self.spec.items()
+        }
+        # generation last written by a worker and last released by the training process
+        self.written = torch.zeros(num_slots, dtype=torch.int64).share_memory_()
+        self.released = torch.zeros(num_slots, dtype=torch.int64).share_memory_()
+        # per process, each worker counts its own batches
+        self._batches = 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers.values())
+
+    def collate(self, samples: Sequence[Dict[str, torch.Tensor]]) -> Union[SharedBatch, Dict]:
+        """Collates samples into the next slot of this worker, used as `collate_fn`.
+
+        Returns:
+            The handle of the slot, or the batch collated by `default_collate` if the slot is
+            still in use
+        """
+        worker_info = get_worker_info()
+        if worker_info is None:
+            raise RuntimeError("The shared-memory ring is only written by DataLoader workers")
+        slot = worker_info.id * self.slots_per_worker + self._batches % self.slots_per_worker
+        self._batches += 1
+        if self.released[slot] < self.written[slot]:
+            log.debug(f"Slot {slot} is still in use, batch sent through the default path")
+            return default_collate(samples)
+
+        if len(samples) > self.batch_size:
+            raise ValueError(f"Batch of {len(samples)} samples, the ring holds {self.batch_size}")
+        for sample in samples:
+            if set(sample) != set(self.spec):
+                raise ValueError(f"Sample has keys {sorted(sample)}, expected {sorted(self.spec)}")
+            for key, (shape, dtype) in self.spec.items():
+                if tuple(sample[key].shape) != shape or sample[key].dtype != dtype:
+                    raise ValueError(
+                        f"'{key}' is {sample[key].dtype} {tuple(sample[key].shape)}, expected "
+                        f"{dtype} {shape}"
+                    )
+        for key, buffer in self.buffers.items():
+            torch.stack([sample[key] for sample in samples], out=buffer[slot, : len(samples)])
+        generation = int(self.written[slot]) + 1
+        self.written[slot] = generation
+        return SharedBatch(slot, generation, len(samples))
+
+    def read(self, batch: SharedBatch) -> Dict[str, torch.Tensor]:
+        """Views of a batch in its slot, valid until the slot is released."""
+        return {key: buffer[batch.slot, : batch.size] for key, buffer in self.buffers.items()}
+
+    def release(self, batch: SharedBatch) -> None:
+        self.released[batch.slot] = batch.generation
+
+    def reset(self) -> None:
+        """Releases all slots, when the batches of an earlier iteration aren't used anymore."""
+        self.released.copy_(self.written)
+
+
+class SharedMemoryDataLoader(DataLoader):
+    """DataLoader whose workers hand batches over through a `SharedMemoryRing`.
+
+    Yields views of the ring, which stay valid until `hold_batches` more batches were yielded.
+    Steps that keep batches for longer have to copy them.
+    """
+
+    def __init__(
+        self,
+        dataset: Any,
+        spec: SampleSpec,
+        batch_size: int = 1,
+        num_workers: int = 1,
+        prefetch_factor: int = 2,
+        hold_batches: int = 2,
+        **kwargs,
+    ):
+        """Allocates a ring with room for the prefetched and the held batches.
+
+        Args:
+            dataset: Dataset of dicts of tensors matching `spec`
+            spec: Shape and dtype of each tensor of a sample
+            batch_size: Number of samples per batch
+            num_workers: Number of worker processes, at least 1
+            prefetch_factor: Number of batches loaded in advance by each worker
+            hold_batches: Number of yielded batches the consumer still uses
+            kwargs: Other arguments of `DataLoader`
+        """
+        if num_workers < 1:
+            raise ValueError("The shared-memory ring needs worker processes")
+        # set by lightning when it re-creates the loader from its attributes
+        kwargs.pop("collate_fn", None)
+        self.spec = spec
+        self.hold_batches = hold_batches
+        self.ring = SharedMemoryRing(
+            spec, batch_size, num_workers, slots_per_worker=prefetch_factor + hold_batches + 1
+        )
+        super().__init__(
+            dataset,
+            batch_size=batch_size,
+            num_workers=num_workers,
+            prefetch_factor=prefetch_factor,
+            collate_fn=self.ring.collate,
+            **kwargs,
+        )
+
+    def __iter__(self) -> Iterator[Dict[str, torch.Tensor]]:
+        self.ring.reset()
+        held: "deque[SharedBatch]" = deque()
+        try:
+            for batch in super().__iter__():
+                if not isinstance(batch, SharedBatch):
+                    yield batch
+                    continue
+                held.append(batch)
+                if len(held) > self.hold_batches:
+                    self.ring.release(held.popleft())
+                yield self.ring.read(batch)
+        finally:
+            for batch in held:
+                self.ring.release(batch)
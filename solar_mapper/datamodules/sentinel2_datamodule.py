@@ -1,14 +1,57 @@
+import os
+from functools import partial
 from typing import Any, Dict, Optional, Tuple
 
+import numpy as np
 import torch
 from pytorch_lightning import LightningDataModule
-from torch.utils.data import ConcatDataset, DataLoader, Dataset, random_split
-from solar_mapper.dataset.sentinel_2 import get_training_example
-from torchvision.transforms import transforms
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+
+from solar_mapper.datamodules.components.augmentations import BatchAugmentation
+from solar_mapper.datamodules.components.sentinel2_dataset import (
+    S1_CHIP_DTYPE,
+    S2_CHIP_DTYPE,
+    Sentinel2PolygonDataset,
+    resolve_path,
+)
+from solar_mapper.datamodules.components.shared_memory import SampleSpec, SharedMemoryDataLoader
+from solar_mapper.dataset.cog import configure_cog_access
+from solar_mapper.dataset.loading_profiles import get_loading_profiles
+from solar_mapper.dataset.resilience import configure_remote_io
+from solar_mapper.models.components.super_resolution import SuperResolutionStage
+from solar_mapper.preprocessing.stages import read_chip_manifest
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+
+def _init_worker(
+    worker_id: int,
+    cog_settings: Optional[Dict[str, Any]] = None,
+    remote_io: Optional[Dict[str, Any]] = None,
+):
+    """Seeds numpy and applies the COG read and retry settings in each DataLoader worker."""
+    import dask
+
+    np.random.seed(torch.initial_seed() % 2**32)
+    configure_cog_access(cog_settings)
+    configure_remote_io(remote_io)
+    # a dask client of the main process can't be used from a forked worker, each worker computes
+    # its own chips with the local threaded scheduler
+    dask.config.set(scheduler="threads")
+
+
+def _torch_dtype(dtype: Any) -> torch.dtype:
+    return torch.from_numpy(np.empty(0, dtype=dtype)).dtype
 
 
 class Sentinel2DataModule(LightningDataModule):
-    """Example of LightningDataModule for Sentinel-2 dataset."""
+    """LightningDataModule streaming Sentinel-2 (+Sentinel-1) chips around PV polygons.
+
+    Only the configured `bands` are fetched, inside a bounding box around each polygon, and the
+    chips stay in compact dtypes (int16 for Sentinel-2, float16 for Sentinel-1, uint8 masks)
+    until they reach the model.
+    """
 
     def __init__(
         self,
@@ -16,25 +59,58 @@ class Sentinel2DataModule(LightningDataModule):
         train_polygons: str = "trn_polygons.json",
         val_polygons: str = "cv_polygons.json",
         test_polygons: str = "pred_polygons.json",
+        start_time: str = "2018-01-01",
+        end_time: str = "2023-12-31",
+        search_delta_days: int = 90,
+        bands: Tuple[str, ...] = ("B02", "B03", "B04", "B08"),
+        s1_bands: Tuple[str, ...] = (),
+        native_resolution: bool = True,
+        chip_size: int = 256,
+        train_samples_per_epoch: int = 10_000,
+        val_samples_per_epoch: int = 1_000,
         batch_size: int = 64,
         num_workers: int = 0,
         pin_memory: bool = False,
+        prefetch_factor: int = 2,
+        persistent_workers: bool = False,
+        cog_settings: Optional[Dict[str, Any]] = None,
+        loading_profiles: Optional[Dict[str, Dict[str, Any]]] = None,
+        super_resolution: Optional[SuperResolutionStage] = None,
+        label_store: Optional[str] = None,
+        remote_io: Optional[Dict[str, Any]] = None,
+        augmentation: Optional[BatchAugmentation] = None,
+        shared_memory: bool = False,
+        chip_cache: Optional[Dict[str, str]] = None,
+        mining_dir: Optional[str] = None,
+        negatives: Optional[Dict[str, Any]] = None,
+        sequence_length: Optional[int] = None,
+        acquisition_index: Optional[Dict[str, str]] = None,
     ):
         super().__init__()
 
         # this line allows to access init params with 'self.hparams' attribute
         # also ensures init params will be stored in ckpt
-        self.save_hyperparameters(logger=False)
+        self.save_hyperparameters(logger=False, ignore=["super_resolution", "augmentation"])
 
-        # data transformations
-        self.transforms = transforms.Compose(
-            [transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))]
-        )
+        # super-resolves Sentinel-2 between loading and chipping, see `SuperResolutionStage`
+        self.super_resolution = super_resolution
+        # augments whole training batches once they are on the device, see `on_after_batch_transfer`
+        self.augmentation = augmentation
+
+        # merged with the defaults and validated here, so bad settings fail at startup
+        self.loading_profiles = get_loading_profiles(loading_profiles)
+
+        # sampling weights of the training polygons, written by the `HardExampleMining` callback
+        self.mining_dir = resolve_path(mining_dir, data_dir) if mining_dir else None
 
         self.data_train: Optional[Dataset] = None
         self.data_val: Optional[Dataset] = None
         self.data_test: Optional[Dataset] = None
 
+        # position in the training data, saved in checkpoints, see `state_dict`
+        self.epoch = 0
+        self.batches = 0
+        self._resume_state: Optional[Dict[str, Any]] = None
 
     def setup(self, stage: Optional[str] = None):
         """Load data. Set variables: `self.data_train`, `self.data_val`, `self.data_test`.
@@ -42,56 +118,254 @@ class Sentinel2DataModule(LightningDataModule):
         This method is called by lightning with both `trainer.fit()` and `trainer.test()`, so be
         careful not to execute things like random split twice!
         """
-        # load and split datasets only if not loaded already
+        # coalesced range reads, block cache and connection reuse for COGs
+        configure_cog_access(self.hparams.cog_settings)
+        # retries, rate limits and circuit breakers of catalog searches and COG reads
+        configure_remote_io(self.hparams.remote_io)
 
+        # load datasets only if not loaded already
         if not self.data_train and not self.data_val and not self.data_test:
-            trainset = MNIST(self.hparams.data_dir, train=True, transform=self.transforms)
-            testset = MNIST(self.hparams.data_dir, train=False, transform=self.transforms)
-            dataset = ConcatDataset(datasets=[trainset, testset])
-            self.data_train, self.data_val, self.data_test = random_split(
-                dataset=dataset,
-                lengths=self.hparams.train_val_test_split,
-                generator=torch.Generator().manual_seed(42),
+            self.data_train = self._dataset(
+                self.hparams.train_polygons,
+                self.hparams.train_samples_per_epoch,
+                jitter=True,
+                chip_cache=self._chip_cache("train"),
+                acquisition_index=self._acquisition_index("train"),
+                mining_dir=self.mining_dir,
+                **self._negatives(),
             )
+            if self.trainer is not None and self._distributed()[1] > 1:
+                # rank zero's seed, which checkpoints save, is the seed of every rank, so resumed
+                # ranks continue their streams, `sample_rng` keeps the streams of ranks apart
+                strategy = self.trainer.strategy
+                self.data_train.seed = strategy.broadcast(self.data_train.seed, src=0)
+            # fixed seeds, so validation and testing see the same chips every epoch
+            self.data_val = self._dataset(
+                self.hparams.val_polygons,
+                self.hparams.val_samples_per_epoch,
+                seed=42,
+                chip_cache=self._chip_cache("val"),
+                acquisition_index=self._acquisition_index("val"),
+            )
+            self.data_test = self._dataset(
+                self.hparams.test_polygons,
+                self.hparams.val_samples_per_epoch,
+                seed=42,
+                chip_cache=self._chip_cache("test"),
+                acquisition_index=self._acquisition_index("test"),
+            )
+            if self._resume_state is not None:
+                self._resume(self._resume_state)
 
-    def train_dataloader(self):
-        return DataLoader(
-            dataset=self.data_train,
-            batch_size=self.hparams.batch_size,
-            num_workers=self.hparams.num_workers,
-            pin_memory=self.hparams.pin_memory,
-            shuffle=True,
+    def _dataset(
+        self,
+        polygons: str,
+        samples_per_epoch: int,
+        jitter: bool = False,
+        seed: Optional[int] = None,
+        chip_cache: Optional[str] = None,
+        mining_dir: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Sentinel2PolygonDataset:
+        rank, world_size = self._distributed()
+        return Sentinel2PolygonDataset(
+            polygons=resolve_path(polygons, self.hparams.data_dir),
+            start_time=self.hparams.start_time,
+            end_time=self.hparams.end_time,
+            search_delta_days=self.hparams.search_delta_days,
+            bands=self.hparams.bands,
+            s1_bands=self.hparams.s1_bands,
+            native_resolution=self.hparams.native_resolution,
+            chip_size=self.hparams.chip_size,
+            samples_per_epoch=samples_per_epoch,
+            jitter=jitter,
+            seed=seed,
+            profiles=self.loading_profiles,
+            super_resolution=self.super_resolution,
+            label_store=(
+                resolve_path(self.hparams.label_store, self.hparams.data_dir)
+                if self.hparams.label_store
+                else None
+            ),
+            rank=rank,
+            world_size=world_size,
+            chip_cache=chip_cache,
+            mining_dir=mining_dir,
+            sequence_length=self.hparams.sequence_length,
+            **kwargs,
         )
 
-    def val_dataloader(self):
-        return DataLoader(
-            dataset=self.data_val,
+    def _chip_cache(self, split: str) -> Optional[str]:
+        """Prepared chips of a split, `chip_cache` maps "train", "val" and "test" to them."""
+        path = (self.hparams.chip_cache or {}).get(split)
+        return resolve_path(path, self.hparams.data_dir) if path else None
+
+    def _acquisition_index(self, split: str) -> Optional[str]:
+        """Prepared index of a split, mapped by `acquisition_index` like `chip_cache`."""
+        path = (self.hparams.acquisition_index or {}).get(split)
+        return resolve_path(path, self.hparams.data_dir) if path else None
+
+    def _negatives(self) -> Dict[str, Any]:
+        """Arguments of the training dataset for drawing the locations without PV."""
+        negatives = self.hparams.negatives or {}
+        if not negatives.get("fraction"):
+            return {}
+        if self._chip_cache("train") is not None:
+            raise ValueError(
+                "Negatives are loaded remotely, they can't be mixed into the training chip cache"
+            )
+        strata = negatives.get("strata")
+        # the validation polygons are known PV too
+        exclusions = [self.hparams.val_polygons, *negatives.get("exclusions", ())]
+        return {
+            "negative_fraction": negatives["fraction"],
+            "negative_strata": resolve_path(strata, self.hparams.data_dir) if strata else None,
+            "negative_exclusions": [
+                resolve_path(path, self.hparams.data_dir) for path in exclusions
+            ],
+            "negative_block": negatives.get("block", 64),
+        }
+
+    def _distributed(self) -> Tuple[int, int]:
+        """Rank and world size of this process, from the trainer or the torchrun environment."""
+        if self.trainer is not None:
+            return self.trainer.global_rank, self.trainer.world_size
+        return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+    def sample_spec(self) -> SampleSpec:
+        """Shape and dtype of each tensor of a sample."""
+        chip = (self.hparams.chip_size, self.hparams.chip_size)
+        spec = {
+            "mask": ((1, *chip), torch.uint8),
+            "polygon": ((), torch.int64),
+        }
+        collections = [("s2", self.hparams.bands, S2_CHIP_DTYPE)]
+        if self.hparams.s1_bands:
+            collections.append(("s1", self.hparams.s1_bands, S1_CHIP_DTYPE))
+        length = self.hparams.sequence_length
+        for name, bands, dtype in collections:
+            if length:
+                spec[name] = ((length, len(bands), *chip), _torch_dtype(dtype))
+                spec[f"{name}_valid"] = ((length,), torch.bool)
+                spec[f"{name}_days"] = ((length,), torch.int16)
+            else:
+                spec[name] = ((len(bands), *chip), _torch_dtype(dtype))
+        return spec
+
+    def _dataloader(self, dataset: Dataset, shuffle: bool) -> DataLoader:
+        # `prefetch_factor` and `persistent_workers` are only valid with worker processes
+        multiprocessing = self.hparams.num_workers > 0
+        kwargs = dict(
+            dataset=dataset,
             batch_size=self.hparams.batch_size,
             num_workers=self.hparams.num_workers,
             pin_memory=self.hparams.pin_memory,
-            shuffle=False,
+            prefetch_factor=self.hparams.prefetch_factor if multiprocessing else None,
+            persistent_workers=self.hparams.persistent_workers and multiprocessing,
+            worker_init_fn=partial(
+                _init_worker,
+                cog_settings=self.hparams.cog_settings,
+                remote_io=self.hparams.remote_io,
+            ),
+            # iterable datasets sample randomly themselves
+            shuffle=shuffle and not isinstance(dataset, IterableDataset),
         )
+        if self.hparams.shared_memory and multiprocessing:
+            # workers write batches into preallocated shared memory, only indices are sent back
+            return SharedMemoryDataLoader(spec=self.sample_spec(), **kwargs)
+        return DataLoader(**kwargs)
+
+    def train_dataloader(self):
+        return self._dataloader(self.data_train, shuffle=True)
+
+    def val_dataloader(self):
+        return self._dataloader(self.data_val, shuffle=False)
 
     def test_dataloader(self):
-        return DataLoader(
-            dataset=self.data_test,
-            batch_size=self.hparams.batch_size,
-            num_workers=self.hparams.num_workers,
-            pin_memory=self.hparams.pin_memory,
-            shuffle=False,
-        )
+        return self._dataloader(self.data_test, shuffle=False)
+
+    def on_after_batch_transfer(self, batch: Dict[str, torch.Tensor], dataloader_idx: int):
+        """Augments training batches on the device they were moved to, and counts them."""
+        if self.trainer is None or not self.trainer.training:
+            return batch
+        # batches are only transferred when the step consumes them, so batches still in the
+        # prefetch queues aren't counted, and are drawn again after resuming
+        self.batches += 1
+        if self.batches >= self.trainer.num_training_batches:
+            self.epoch, self.batches = self.epoch + 1, 0
+            self.data_train.set_progress(self.epoch)
+        if self.augmentation is not None:
+            batch = self.augmentation(batch)
+        return batch
 
     def teardown(self, stage: Optional[str] = None):
         """Clean up after fit or test."""
         pass
 
-    def state_dict(self):
-        """Extra things to save to checkpoint."""
-        return {}
+    def state_dict(self) -> Dict[str, Any]:
+        """Position in the training data, so a resumed run neither replays nor skips samples.
+
+        Samples are drawn from counter-based generators keyed by the seed, epoch and position
+        (see `Sentinel2PolygonDataset.sample_rng`), so the seed and the number of consumed
+        batches are enough to continue the sample stream exactly, without drawing, loading or
+        caching the samples before. The DataLoader layout and the chip caches are stored to
+        detect resumes that can't be exact.
+        """
+        state = {
+            "epoch": self.epoch,
+            "batches": self.batches,
+            "seed": self.data_train.seed if self.data_train is not None else None,
+            "layout": self._layout(),
+            "chip_cache": self._chip_manifests(),
+            # the augmentations draw from torch's generator
+            "torch_rng_state": torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            state["cuda_rng_state"] = torch.cuda.get_rng_state_all()
+        return state
 
     def load_state_dict(self, state_dict: Dict[str, Any]):
-        """Things to do when loading checkpoint."""
-        pass
+        """Continues the training data where the checkpoint left it."""
+        self.epoch, self.batches = state_dict["epoch"], state_dict["batches"]
+        if self.data_train is None:
+            # lightning restores checkpoints after `setup`, but keep it working either way
+            self._resume_state = state_dict
+        else:
+            self._resume(state_dict)
+
+    def _resume(self, state_dict: Dict[str, Any]):
+        if state_dict["layout"] != self._layout():
+            log.warning(
+                f"Resuming with the data layout {self._layout()} instead of "
+                f"{state_dict['layout']}, samples of the interrupted epoch may repeat or be skipped"
+            )
+        if state_dict["chip_cache"] != self._chip_manifests():
+            log.warning("The chip caches changed since the checkpoint, resumed samples will differ")
+        if state_dict["seed"] is not None:
+            self.data_train.seed = state_dict["seed"]
+        self.data_train.set_progress(self.epoch, self.batches, self.hparams.batch_size)
+        # every rank has its own generator, but only rank zero's is saved
+        if self._distributed()[1] == 1:
+            torch.set_rng_state(state_dict["torch_rng_state"])
+            if "cuda_rng_state" in state_dict and torch.cuda.is_available():
+                torch.cuda.set_rng_state_all(state_dict["cuda_rng_state"])
+        self._resume_state = None
+
+    def _layout(self) -> Dict[str, int]:
+        """Settings that decide which sample a consumed batch held."""
+        return {
+            "batch_size": self.hparams.batch_size,
+            "num_workers": self.hparams.num_workers,
+            "world_size": self._distributed()[1],
+        }
+
+    def _chip_manifests(self) -> Dict[str, Any]:
+        return {
+            split: read_chip_manifest(path)
+            for split in ("train", "val", "test")
+            for path in [self._chip_cache(split)]
+            if path is not None
+        }
 
 
 if __name__ == "__main__":
@@ -100,6 +374,6 @@ if __name__ == "__main__":
     import pyrootutils
 
     root = pyrootutils.setup_root(__file__, pythonpath=True)
-    cfg = omegaconf.OmegaConf.load(root / "configs" / "datamodule" / "mnist.yaml")
+    cfg = omegaconf.OmegaConf.load(root / "configs" / "datamodule" / "sentinel2.yaml")
     cfg.data_dir = str(root / "data")
     _ = hydra.utils.instantiate(cfg)
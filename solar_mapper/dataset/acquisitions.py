@@ -0,0 +1,153 @@
+"""Per-polygon calendars of scene acquisitions, for drawing search windows that have imagery.
+
+Picking a random window of `search_delta` days often finds no usable scene, which fails the
+whole sample after its catalog searches. The calendar searches the catalog once per polygon for
+the full period, caches the acquisition dates, and draws windows around dates that have
+scenes, so every window search returns imagery. Dates found earlier, by the index stage of
+`prepare.py`, are added with `add` and answer the requests inside their period without a search.
+"""
+
+import hashlib
+import json
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from solar_mapper.dataset.resilience import get_remote_io
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+STAC_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+class AcquisitionCalendar:
+    """LRU cache of the acquisition dates of the scenes covering each polygon."""
+
+    def __init__(
+        self,
+        collection: str = "sentinel-2-l2a",
+        max_cloud_cover: Optional[float] = None,
+        max_size: int = 4096,
+    ):
+        """Sets the scenes that are counted and the size of the cache.
+
+        Args:
+            collection: STAC collection of the scenes
+            max_cloud_cover: Only count scenes with at most this `eo:cloud_cover`, all if None
+            max_size: Maximum number of polygons kept in the cache
+        """
+        self.collection = collection
+        self.max_cloud_cover = max_cloud_cover
+        self.max_size = max_size
+        self._cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        # period and dates of each geometry, added from an index, never evicted
+        self._indexed: Dict[str, Tuple[datetime, datetime, np.ndarray]] = {}
+        self.num_searches = 0
+
+    @staticmethod
+    def geometry_key(feature: dict) -> str:
+        """Key of the geometry of a GeoJSON feature, the same in every process."""
+        geometry = json.dumps(feature["geometry"], sort_keys=True).encode()
+        return hashlib.sha1(geometry).hexdigest()
+
+    def _key(self, feature: dict, start_time: datetime, end_time: datetime) -> str:
+        period = f"{start_time.isoformat()}/{end_time.isoformat()}"
+        return self.geometry_key(feature) + period
+
+    def add(self, key: str, start_time: datetime, end_time: datetime, dates: Sequence[Any]) -> None:
+        """Records acquisition dates found earlier, e.g. by `index_shard`.
+
+        Args:
+            key: `geometry_key` of the feature
+            start_time: Start of the period that was searched
+            end_time: End of the period that was searched
+            dates: Acquisition dates of the whole period, as ISO strings or `datetime64`
+        """
+        dates = np.unique(np.asarray(dates, dtype="datetime64[s]"))
+        self._indexed[key] = (start_time, end_time, dates)
+
+    def dates(
+        self, feature: dict, start_time: datetime, end_time: datetime, catalog: Any
+    ) -> np.ndarray:
+        """Sorted `datetime64[s]` (UTC) acquisition dates of the scenes covering `feature`.
+
+        Args:
+            feature: GeoJSON feature
+            start_time: Start of the period, naive datetimes are UTC
+            end_time: End of the period
+            catalog: STAC catalog to search
+        """
+        key = self._key(feature, start_time, end_time)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        indexed = self._indexed.get(self.geometry_key(feature))
+        if indexed is not None and indexed[0] <= start_time and end_time <= indexed[1]:
+            dates = indexed[2]
+            start, end = np.datetime64(start_time, "s"), np.datetime64(end_time, "s")
+            return dates[(dates >= start) & (dates <= end)]
+
+        search = catalog.search(
+            collections=[self.collection],
+            intersects=feature["geometry"],
+            datetime=f"{start_time.strftime(STAC_DATETIME_FORMAT)}/"
+            f"{end_time.strftime(STAC_DATETIME_FORMAT)}",
+        )
+        self.num_searches += 1
+        # plain dicts, building pystac items for hundreds of scenes is slower than the search
+        items = get_remote_io().call("stac", lambda: list(search.items_as_dicts()))
+        dates = []
+        for item in items:
+            properties = item["properties"]
+            cloud_cover = properties.get("eo:cloud_cover")
+            if self.max_cloud_cover is not None and cloud_cover is not None:
+                if cloud_cover > self.max_cloud_cover:
+                    continue
+            dates.append(np.datetime64(properties["datetime"].rstrip("Z")[:19], "s"))
+        dates = np.unique(np.asarray(dates, dtype="datetime64[s]"))
+        log.debug(
+            f"{len(dates)} {self.collection} acquisitions between {start_time} and {end_time}"
+        )
+
+        self._cache[key] = dates
+        if len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+        return dates
+
+    def sample_window(
+        self,
+        feature: dict,
+        start_time: datetime,
+        end_time: datetime,
+        search_delta: timedelta,
+        catalog: Any,
+        rng: Any = np.random,
+    ) -> Tuple[datetime, datetime]:
+        """Draws a window of `search_delta` inside the period that contains an acquisition.
+
+        Args:
+            feature: GeoJSON feature
+            start_time: Start of the period
+            end_time: End of the period
+            search_delta: Length of the window
+            catalog: STAC catalog to search
+            rng: Random generator, the global numpy one by default
+
+        Returns:
+            Start and end of the window
+
+        Raises:
+            ValueError: If no scene covers the feature in the period
+        """
+        dates = self.dates(feature, start_time, end_time, catalog)
+        if len(dates) == 0:
+            raise ValueError(f"No {self.collection} scenes between {start_time} and {end_time}")
+        date = dates[rng.randint(len(dates))].astype(datetime)
+        # any start that keeps the acquisition in the window, and the window in the period
+        lowest = max(start_time, date - search_delta)
+        highest = max(min(date, end_time - search_delta), lowest)
+        window_start = lowest + (highest - lowest) * rng.random()
+        return window_start, window_start + search_delta
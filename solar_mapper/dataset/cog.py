@@ -0,0 +1,139 @@
+"""GDAL and fsspec settings for reading Cloud Optimized GeoTIFFs over HTTP.
+
+`stac_load` reads every band of every scene as a set of small HTTP range requests. The defaults
+here cut the number of round-trips per example by:
+
+- merging adjacent block requests into one range (`GDAL_HTTP_MERGE_CONSECUTIVE_RANGES`)
+- reading larger blocks per request and caching them (`CPL_VSIL_CURL_CHUNK_SIZE`,
+  `CPL_VSIL_CURL_CACHE_SIZE`, `VSI_CACHE`)
+- reading the whole COG header on open instead of growing it request by request
+- multiplexing all requests to one host over a single HTTP/2 connection, so there is one
+  connection per host and it is reused across files
+- skipping directory listings and HEAD requests that COG reads never need
+"""
+import contextlib
+from typing import Any, Dict, Iterator, Optional
+
+# Settings that can be overridden from the datamodule `cog_settings` config
+DEFAULT_COG_SETTINGS: Dict[str, Any] = {
+    "merge_consecutive_ranges": True,
+    "http_multiplex": True,
+    "chunk_size_kb": 256,
+    "block_cache_mb": 256,
+    "file_cache_mb": 64,
+    "header_size_kb": 64,
+    "max_retry": 5,
+    "retry_delay": 0.5,
+    "fsspec_block_size_mb": 8,
+}
+
+
+def get_gdal_options(
+    merge_consecutive_ranges: bool = True,
+    http_multiplex: bool = True,
+    chunk_size_kb: int = 256,
+    block_cache_mb: int = 256,
+    file_cache_mb: int = 64,
+    header_size_kb: int = 64,
+    max_retry: int = 5,
+    retry_delay: float = 0.5,
+) -> Dict[str, str]:
+    """Builds the GDAL configuration options for COG access over HTTP.
+
+    Args:
+        merge_consecutive_ranges: Merge adjacent block reads into a single range request.
+        http_multiplex: Multiplex concurrent requests to one host over a single HTTP/2
+            connection.
+        chunk_size_kb: Minimum number of bytes fetched per range request.
+        block_cache_mb: Size of the process-wide cache of downloaded blocks.
+        file_cache_mb: Size of the per-file read cache.
+        header_size_kb: Number of bytes read when a file is opened, should cover the COG header.
+        max_retry: Number of retries on HTTP 429/502/503/504 errors.
+        retry_delay: Initial delay between retries in seconds.
+
+    Returns:
+        Dict of GDAL configuration options
+    """
+    return {
+        "GDAL_DISABLE_READDIR_ON_OPEN": "EMPTY_DIR",
+        "CPL_VSIL_CURL_ALLOWED_EXTENSIONS": ".tif,.tiff,.TIF,.TIFF",
+        "CPL_VSIL_CURL_USE_HEAD": "NO",
+        "GDAL_HTTP_MERGE_CONSECUTIVE_RANGES": "YES" if merge_consecutive_ranges else "NO",
+        "GDAL_HTTP_MULTIPLEX": "YES" if http_multiplex else "NO",
+        "GDAL_HTTP_VERSION": "2" if http_multiplex else "1.1",
+        "CPL_VSIL_CURL_CHUNK_SIZE": str(chunk_size_kb * 1024),
+        "CPL_VSIL_CURL_CACHE_SIZE": str(block_cache_mb * 1024 * 1024),
+        "VSI_CACHE": "TRUE",
+        "VSI_CACHE_SIZE": str(file_cache_mb * 1024 * 1024),
+        "GDAL_INGESTED_BYTES_AT_OPEN": str(header_size_kb * 1024),
+        "GDAL_HTTP_MAX_RETRY": str(max_retry),
+        "GDAL_HTTP_RETRY_DELAY": str(retry_delay),
+    }
+
+
+def _gdal_settings(settings: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    settings = {**DEFAULT_COG_SETTINGS, **(settings or {})}
+    settings.pop("fsspec_block_size_mb")
+    return settings
+
+
+def configure_cog_access(settings: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+    """Applies the COG settings to every read made by `odc.stac` in this process.
+
+    This has to be called once per process, so also from each DataLoader worker.
+
+    Args:
+        settings: Overrides for `DEFAULT_COG_SETTINGS`
+
+    Returns:
+        The GDAL configuration options that were applied
+    """
+    from odc.stac import configure_rio
+
+    options = get_gdal_options(**_gdal_settings(settings))
+    configure_rio(cloud_defaults=True, **options)
+    return options
+
+
+@contextlib.contextmanager
+def cog_env(settings: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, str]]:
+    """Context manager applying the COG settings to rasterio reads made inside it.
+
+    Args:
+        settings: Overrides for `DEFAULT_COG_SETTINGS`
+
+    Yields:
+        The GDAL configuration options in use
+    """
+    import rasterio
+
+    options = get_gdal_options(**_gdal_settings(settings))
+    with rasterio.Env(**options):
+        yield options
+
+
+def open_remote(urlpath: str, mode: str = "rb", settings: Optional[Dict[str, Any]] = None):
+    """Opens a remote file through fsspec with a block cache for random access.
+
+    fsspec keeps one filesystem instance, and so one HTTP session, per protocol and options,
+    so connections are reused across calls.
+
+    Args:
+        urlpath: fsspec URL of the file, can be a chained URL like `zip://*.geojson::https://...`
+        mode: Mode to open the file in
+        settings: Overrides for `DEFAULT_COG_SETTINGS`
+
+    Returns:
+        fsspec OpenFile
+    """
+    import fsspec
+
+    settings = {**DEFAULT_COG_SETTINGS, **(settings or {})}
+    block_size = int(settings["fsspec_block_size_mb"] * 1024 * 1024)
+    if "::" in urlpath:
+        # Chained URLs need the options addressed to the underlying protocol
+        protocol = urlpath.split("::")[-1].split("://")[0]
+        options = {protocol: {"block_size": block_size, "cache_type": "blockcache"}}
+    else:
+        options = {"block_size": block_size, "cache_type": "blockcache"}
+    return fsspec.open(urlpath, mode=mode, **options)
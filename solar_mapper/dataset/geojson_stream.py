@@ -0,0 +1,132 @@
+"""Streaming reader for large GeoJSON FeatureCollections.
+
+`geojson.load` parses a whole file into nested dicts, and rejects the NaN values written by
+some tools (e.g. the predicted set of `get_global_pv_mapping_polygons`). The reader here
+decodes one feature at a time from a fixed-size text buffer with the standard library JSON
+decoder, which accepts NaN and Infinity, so memory is bounded by the largest single feature
+whatever the size of the file.
+"""
+
+import json
+from typing import IO, Any, Dict, Iterator, Optional, Sequence, Union
+
+from solar_mapper.dataset.cog import open_remote
+
+_WHITESPACE = " \t\n\r"
+
+
+class _Reader:
+    """Text buffer over a file, refilled on demand and trimmed as it is consumed."""
+
+    def __init__(self, file: IO[str], chunk_size: int):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.file.read(self.chunk_size)
+        if isinstance(chunk, bytes):
+            chunk = chunk.decode("utf-8")
+        if not chunk:
+            self.eof = True
+            return False
+        # drop the consumed part before growing the buffer, so it stays about one feature long
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Skips whitespace and returns the next character, empty at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.fill():
+                return self.buffer[self.pos : self.pos + 1]
+
+    def expect(self, characters: str) -> str:
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Invalid GeoJSON: expected one of {characters!r}, got {character!r}")
+        self.pos += 1
+        return character
+
+    def value(self, decoder: json.JSONDecoder) -> Any:
+        """Decodes the next JSON value, reading more of the file until it is complete."""
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # a number at the end of the buffer may continue in the next chunk
+            if end == len(self.buffer) and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_features(
+    file: Union[str, IO],
+    properties: Optional[Sequence[str]] = None,
+    chunk_size: int = 1 << 20,
+) -> Iterator[Dict[str, Any]]:
+    """Yields the features of a GeoJSON FeatureCollection one at a time.
+
+    Args:
+        file: fsspec URL (see `open_remote`) or open text/binary file
+        properties: Only keep these properties of each feature (missing ones are left out), all if
+            None
+        chunk_size: Number of characters read at a time
+
+    Yields:
+        Features as dicts, NaN values are kept as float NaN
+    """
+    if isinstance(file, str):
+        with open_remote(file, mode="r").open() as opened:
+            yield from iter_features(opened, properties, chunk_size)
+        return
+
+    decoder = json.JSONDecoder()
+    reader = _Reader(file, chunk_size)
+    reader.expect("{")
+    if reader.peek() == "}":
+        return
+    while True:
+        key = reader.value(decoder)
+        reader.expect(":")
+        if key != "features":
+            # top-level members (type, name, crs, bbox) are small, they are parsed and dropped
+            reader.value(decoder)
+        elif reader.expect("[") and reader.peek() != "]":
+            while True:
+                feature = reader.value(decoder)
+                if properties is not None:
+                    values = feature.get("properties") or {}
+                    # absent properties stay absent, so `.get(name, default)` still applies
+                    feature["properties"] = {
+                        name: values[name] for name in properties if name in values
+                    }
+                yield feature
+                if reader.expect(",]") == "]":
+                    break
+        else:
+            reader.expect("]")
+        if reader.expect(",}") == "}":
+            return
+
+
+class FeatureStream:
+    """Re-iterable stream of the features of a GeoJSON file, see `iter_features`."""
+
+    def __init__(self, urlpath: str, properties: Optional[Sequence[str]] = None):
+        self.urlpath = urlpath
+        self.properties = properties
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter_features(self.urlpath, self.properties)
@@ -0,0 +1,324 @@
+"""Precomputed PV label rasters on a fixed grid per UTM zone.
+
+`make_segmentation_maps` reprojects and rasterizes the polygon of every sample again. The label
+store rasterizes all polygons once, into one Zarr array per UTM zone (EPSG 326xx/327xx) on a
+fixed 10m grid that Sentinel-2 chips line up with. The arrays are sparse, only chunks with PV
+are written, and compress to almost nothing, so a global store is small. Looking up the mask of
+a chip is then a read of the one to four chunks under it, sliced to the chip's GeoBox.
+
+Polygons are rasterized into their own zone and the neighbouring zones, since Sentinel-2 tiles
+reach across zone borders.
+
+    python -m solar_mapper.dataset.label_store polygons.geojson labels.zarr
+"""
+
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from affine import Affine
+from pyproj import Transformer
+from rasterio.crs import CRS
+from rasterio.features import rasterize
+from rasterio.warp import Resampling, reproject
+from shapely import ops
+from shapely.geometry import shape
+
+from solar_mapper.dataset.utils import get_utm_zone
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+# (x_min, y_min, x_max, y_max) of the grid of each hemisphere, covering every Sentinel-2 tile
+NORTH_EXTENT = (0, 0, 1_000_000, 9_400_000)
+SOUTH_EXTENT = (0, 1_000_000, 1_000_000, 10_000_000)
+
+
+def _zarr():
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("The label store needs `zarr>=3` installed")
+    return zarr
+
+
+def utm_epsg(zone: int, north: bool) -> int:
+    return (32600 if north else 32700) + zone
+
+
+def zone_extent(epsg: int) -> Tuple[int, int, int, int]:
+    return NORTH_EXTENT if epsg < 32700 else SOUTH_EXTENT
+
+
+def candidate_zones(lon: float, lat: float, neighbour_zones: int = 1) -> List[int]:
+    """EPSG codes of the UTM zones a polygon at (lon, lat) is rasterized into."""
+    zone = int(get_utm_zone(lat, lon))
+    zones = [
+        (zone - 1 + offset) % 60 + 1 for offset in range(-neighbour_zones, neighbour_zones + 1)
+    ]
+    # tiles on the equator belong to either hemisphere, the extents drop what falls outside
+    hemispheres = [lat >= 0] if abs(lat) > 1 else [True, False]
+    return [utm_epsg(z, north) for north in hemispheres for z in dict.fromkeys(zones)]
+
+
+def bucket_polygons(
+    features: Iterable[dict],
+    resolution: int = 10,
+    chunk_size: int = 512,
+    neighbour_zones: int = 1,
+) -> Dict[int, Dict[Tuple[int, int], list]]:
+    """Projects polygons into their UTM zones and groups them by the chunks they touch.
+
+    Args:
+        features: GeoJSON features in EPSG:4326, e.g. from `geojson_stream.iter_features`
+        resolution: Pixel size in metres
+        chunk_size: Size of the square chunks in pixels
+        neighbour_zones: Number of neighbouring UTM zones on each side polygons are added to
+
+    Returns:
+        Projected polygons per `(row, col)` chunk, per EPSG code
+    """
+    transformers: Dict[int, Transformer] = {}
+    buckets: Dict[int, Dict[Tuple[int, int], list]] = defaultdict(lambda: defaultdict(list))
+    chunk_metres = chunk_size * resolution
+    for feature in features:
+        geometry = shape(feature["geometry"])
+        if geometry.is_empty:
+            continue
+        point = geometry.representative_point()
+        for epsg in candidate_zones(point.x, point.y, neighbour_zones):
+            if epsg not in transformers:
+                transformers[epsg] = Transformer.from_crs(4326, epsg, always_xy=True)
+            projected = ops.transform(transformers[epsg].transform, geometry)
+            x_min, y_min, x_max, y_max = zone_extent(epsg)
+            minx, miny, maxx, maxy = projected.bounds
+            if maxx < x_min or minx >= x_max or maxy < y_min or miny >= y_max:
+                continue
+            for row in range(
+                int((y_max - maxy) // chunk_metres), int((y_max - miny) // chunk_metres) + 1
+            ):
+                for col in range(
+                    int((minx - x_min) // chunk_metres), int((maxx - x_min) // chunk_metres) + 1
+                ):
+                    buckets[epsg][(row, col)].append(projected)
+    return {epsg: dict(chunks) for epsg, chunks in buckets.items()}
+
+
+def write_label_chunks(array, chunks: Dict[Tuple[int, int], list]) -> int:
+    """Rasterizes the polygons of each chunk into the zone array, adding to its labels.
+
+    Each chunk is read and written once, so chunks can be spread over processes as long as
+    every chunk goes to a single one.
+
+    Args:
+        array: Zone array of the store, see `open_label_array`
+        chunks: Projected polygons per `(row, col)` chunk, from `bucket_polygons`
+
+    Returns:
+        Number of chunks with labels
+    """
+    resolution = array.attrs["resolution"]
+    chunk_size = array.chunks[0]
+    height, width = array.shape
+    x_min, y_max = array.attrs["x_min"], array.attrs["y_max"]
+    written = 0
+    for (row, col), geometries in chunks.items():
+        y0, x0 = row * chunk_size, col * chunk_size
+        if not (0 <= y0 < height and 0 <= x0 < width):
+            continue
+        y1, x1 = min(y0 + chunk_size, height), min(x0 + chunk_size, width)
+        transform = Affine(
+            resolution, 0, x_min + x0 * resolution, 0, -resolution, y_max - y0 * resolution
+        )
+        labels = rasterize(
+            geometries, out_shape=(y1 - y0, x1 - x0), transform=transform, fill=0, dtype="uint8"
+        )
+        if labels.any():
+            array[y0:y1, x0:x1] = np.maximum(array[y0:y1, x0:x1], labels)
+            written += 1
+    return written
+
+
+def open_label_group(path: str, storage_options: Optional[Dict[str, Any]] = None):
+    """Opens the Zarr group of the store for writing, creating it if needed."""
+    return _zarr().open_group(path, mode="a", storage_options=storage_options)
+
+
+def build_label_store(
+    features: Iterable[dict],
+    path: str,
+    resolution: int = 10,
+    chunk_size: int = 512,
+    neighbour_zones: int = 1,
+    storage_options: Optional[Dict[str, Any]] = None,
+) -> Dict[int, int]:
+    """Rasterizes polygons into the label store at `path`, adding to the labels already there.
+
+    Polygons are grouped by the chunks they touch, so each chunk is rasterized and written
+    once, with all of its polygons.
+
+    Args:
+        features: GeoJSON features in EPSG:4326, e.g. from `geojson_stream.iter_features`
+        path: Path or URL of the Zarr store
+        resolution: Pixel size in metres
+        chunk_size: Size of the square chunks in pixels
+        neighbour_zones: Number of neighbouring UTM zones on each side polygons are added to
+        storage_options: fsspec options of remote stores
+
+    Returns:
+        Number of written chunks per EPSG code
+    """
+    buckets = bucket_polygons(features, resolution, chunk_size, neighbour_zones)
+    group = open_label_group(path, storage_options)
+    written = {}
+    for epsg, chunks in buckets.items():
+        array = open_label_array(group, epsg, resolution, chunk_size)
+        write_label_chunks(array, chunks)
+        written[epsg] = len(chunks)
+        log.info(f"Wrote {len(chunks)} chunks of EPSG:{epsg} to <{path}>")
+    return written
+
+
+def open_label_array(group, epsg: int, resolution: int = 10, chunk_size: int = 512):
+    """Opens the array of a UTM zone in the store, creating it if needed."""
+    zarr = _zarr()
+    name = str(epsg)
+    if name in group:
+        array = group[name]
+        if array.attrs["resolution"] != resolution:
+            raise ValueError(f"The store has {array.attrs['resolution']}m labels for EPSG:{epsg}")
+        return array
+    x_min, y_min, x_max, y_max = zone_extent(epsg)
+    array = group.create_array(
+        name,
+        shape=((y_max - y_min) // resolution, (x_max - x_min) // resolution),
+        chunks=(chunk_size, chunk_size),
+        dtype="uint8",
+        fill_value=0,
+        # masks are mostly constant, bit-shuffled they compress to a few bytes per chunk
+        compressors=zarr.codecs.BloscCodec(cname="zstd", clevel=3, shuffle="bitshuffle"),
+    )
+    array.attrs.update({"epsg": epsg, "resolution": resolution, "x_min": x_min, "y_max": y_max})
+    return array
+
+
+class LabelStore:
+    """Reads PV masks for arbitrary chips from a store written by `build_label_store`."""
+
+    def __init__(self, path: str, storage_options: Optional[Dict[str, Any]] = None):
+        self.path = path
+        self.storage_options = storage_options
+        self._group = None
+        self._arrays: Dict[int, Any] = {}
+
+    @property
+    def group(self):
+        # opened lazily, so each dataloader worker opens the store itself
+        if self._group is None:
+            self._group = _zarr().open_group(
+                self.path, mode="r", storage_options=self.storage_options
+            )
+        return self._group
+
+    def _array(self, epsg: int):
+        if epsg not in self._arrays:
+            name = str(epsg)
+            self._arrays[epsg] = self.group[name] if name in self.group else None
+        return self._arrays[epsg]
+
+    def read(self, geobox) -> np.ndarray:
+        """Reads the (H, W) uint8 mask on the grid of `geobox`.
+
+        Grids aligned with the store, like those of Sentinel-2 at its resolution, are sliced
+        straight out of the store. Other grids are resampled (nearest) from it.
+
+        Args:
+            geobox: Grid with `crs`, `transform` and `shape`, e.g. `stack.odc.geobox`, in UTM
+
+        Returns:
+            The mask, zeros where the store has no labels
+        """
+        epsg = CRS.from_user_input(str(geobox.crs)).to_epsg()
+        height, width = tuple(geobox.shape)
+        array = self._array(epsg) if epsg is not None else None
+        if array is None:
+            if epsg is None or not 32601 <= epsg <= 32760:
+                raise ValueError(f"Labels are stored in UTM zones, got {geobox.crs}")
+            return np.zeros((height, width), dtype=np.uint8)
+
+        attrs = array.attrs
+        resolution = attrs["resolution"]
+        transform = geobox.transform
+        col = (transform.c - attrs["x_min"]) / resolution
+        row = (attrs["y_max"] - transform.f) / resolution
+        aligned = (
+            transform.a == resolution
+            and transform.e == -resolution
+            and transform.b == transform.d == 0
+            and col == round(col)
+            and row == round(row)
+        )
+        if aligned:
+            return self._window(array, int(row), int(col), height, width)
+
+        # read the store pixels under the geobox and resample them onto it
+        xs = [transform.c, transform.c + width * transform.a + height * transform.b]
+        ys = [transform.f, transform.f + width * transform.d + height * transform.e]
+        row0 = int(np.floor((attrs["y_max"] - max(ys)) / resolution)) - 1
+        col0 = int(np.floor((min(xs) - attrs["x_min"]) / resolution)) - 1
+        rows = int(np.ceil((max(ys) - min(ys)) / resolution)) + 3
+        cols = int(np.ceil((max(xs) - min(xs)) / resolution)) + 3
+        source = self._window(array, row0, col0, rows, cols)
+        source_transform = Affine(
+            resolution,
+            0,
+            attrs["x_min"] + col0 * resolution,
+            0,
+            -resolution,
+            attrs["y_max"] - row0 * resolution,
+        )
+        mask = np.zeros((height, width), dtype=np.uint8)
+        crs = CRS.from_epsg(epsg)
+        reproject(
+            source,
+            mask,
+            src_transform=source_transform,
+            src_crs=crs,
+            dst_transform=transform,
+            dst_crs=crs,
+            resampling=Resampling.nearest,
+        )
+        return mask
+
+    @staticmethod
+    def _window(array, row: int, col: int, height: int, width: int) -> np.ndarray:
+        """Reads a window of the array, zero-padded where it leaves the grid."""
+        total_height, total_width = array.shape
+        y0, y1 = max(row, 0), min(row + height, total_height)
+        x0, x1 = max(col, 0), min(col + width, total_width)
+        if y0 == row and x0 == col and y1 - y0 == height and x1 - x0 == width:
+            return array[y0:y1, x0:x1]
+        mask = np.zeros((height, width), dtype=np.uint8)
+        if y1 > y0 and x1 > x0:
+            mask[y0 - row : y1 - row, x0 - col : x1 - col] = array[y0:y1, x0:x1]
+        return mask
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from solar_mapper.dataset.geojson_stream import iter_features
+
+    parser = argparse.ArgumentParser(description="Rasterizes PV polygons into a label store")
+    parser.add_argument("polygons", nargs="+", help="GeoJSON files or URLs of PV polygons")
+    parser.add_argument("store", help="Path or URL of the Zarr store")
+    parser.add_argument("--resolution", type=int, default=10)
+    parser.add_argument("--chunk-size", type=int, default=512)
+    args = parser.parse_args()
+    for polygons in args.polygons:
+        build_label_store(
+            iter_features(polygons, properties=[]),
+            args.store,
+            resolution=args.resolution,
+            chunk_size=args.chunk_size,
+        )
@@ -0,0 +1,162 @@
+from copy import deepcopy
+from typing import TYPE_CHECKING, Any, Dict, Mapping, Optional
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import xarray as xr
+
+# Per-collection settings for loading STAC items with odc-stac:
+# - assets: stored data type and nodata value per asset, "*" applies to all other assets
+# - resampling: resampling method per asset, "*" applies to all other assets
+# - chunks: dask chunking of the loaded stack
+# - db_scale: convert backscatter to decibels, as float16, while loading
+LOADING_PROFILES: Dict[str, Dict[str, Any]] = {
+    "sentinel-2-l2a": {
+        "assets": {
+            "*": {"data_type": "uint16", "nodata": 0},
+            "SCL": {"data_type": "uint8", "nodata": 0},
+            "visual": {"data_type": "uint8", "nodata": 0},
+        },
+        "resampling": {"*": "nearest"},
+        "chunks": {"x": 1024, "y": 1024},
+        "db_scale": False,
+    },
+    "sentinel-1-rtc": {
+        "assets": {
+            "*": {"data_type": "float32", "nodata": 0},
+        },
+        "resampling": {"*": "nearest"},
+        "chunks": {"x": 1024, "y": 1024},
+        "db_scale": False,
+    },
+}
+
+RESAMPLING_METHODS = (
+    "nearest",
+    "bilinear",
+    "cubic",
+    "cubic_spline",
+    "lanczos",
+    "average",
+    "mode",
+    "min",
+    "max",
+    "med",
+    "q1",
+    "q3",
+    "sum",
+    "rms",
+)
+
+
+def validate_loading_profile(collection: str, profile: Dict[str, Any]) -> None:
+    """
+    Check a loading profile for mistakes that odc-stac would otherwise silently ignore
+
+    Args:
+        collection: Name of the collection the profile is for
+        profile: Loading profile
+
+    Raises:
+        ValueError: If the profile has unknown keys, data types, nodata values that the data type
+            cannot hold, unknown resampling methods or invalid chunk sizes
+    """
+    unknown = set(profile) - set(LOADING_PROFILES["sentinel-2-l2a"])
+    if unknown:
+        raise ValueError(
+            f"Unknown keys {sorted(unknown)} in the loading profile of {collection}, "
+            f"collections can't be nested inside each other"
+        )
+    for asset, asset_cfg in profile.get("assets", {}).items():
+        unknown = set(asset_cfg) - {"data_type", "nodata"}
+        if unknown:
+            raise ValueError(f"Unknown keys {sorted(unknown)} for asset {asset} of {collection}")
+        try:
+            dtype = np.dtype(asset_cfg["data_type"])
+        except TypeError:
+            raise ValueError(
+                f"Invalid data type {asset_cfg['data_type']} for asset {asset} of {collection}"
+            )
+        nodata = asset_cfg.get("nodata")
+        if nodata is not None and np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            if not (info.min <= nodata <= info.max) or nodata != int(nodata):
+                raise ValueError(
+                    f"nodata {nodata} can't be stored as {dtype} for asset {asset} of {collection}"
+                )
+    for asset, method in profile.get("resampling", {}).items():
+        if method not in RESAMPLING_METHODS:
+            raise ValueError(
+                f"Unknown resampling method {method} for asset {asset} of {collection}"
+            )
+    for dim, size in profile.get("chunks", {}).items():
+        valid_size = size == "auto" or (isinstance(size, int) and size > 0)
+        if dim not in ("x", "y", "time") or not valid_size:
+            raise ValueError(
+                f"Invalid chunk size {dim}={size} in the loading profile of {collection}"
+            )
+
+
+def _to_dict(value: Any) -> Any:
+    # Hydra passes nested DictConfigs, odc-stac expects plain dicts
+    if isinstance(value, Mapping):
+        return {key: _to_dict(item) for key, item in value.items()}
+    return value
+
+
+def get_loading_profiles(
+    overrides: Optional[Dict[str, Dict[str, Any]]] = None,
+) -> Dict[str, Dict[str, Any]]:
+    """
+    Merge overrides into the default loading profiles and validate the result
+
+    Args:
+        overrides: Per-collection overrides, merged one level deep into the defaults
+
+    Returns:
+        Validated loading profiles
+    """
+    profiles = deepcopy(LOADING_PROFILES)
+    for collection, override in _to_dict(overrides or {}).items():
+        profile = profiles.setdefault(collection, {})
+        for key, value in override.items():
+            if isinstance(value, dict) and isinstance(profile.get(key), dict):
+                profile[key] = {**profile[key], **value}
+            else:
+                profile[key] = value
+    for collection, profile in profiles.items():
+        validate_loading_profile(collection, profile)
+    return profiles
+
+
+def get_stac_cfg(profiles: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Build the odc-stac configuration from the loading profiles
+
+    Every collection is a top level key, the original configuration nested Sentinel-1 inside
+    Sentinel-2 so its data types were never applied.
+    """
+    stac_cfg: Dict[str, Any] = {
+        collection: {"assets": deepcopy(profile.get("assets", {}))}
+        for collection, profile in profiles.items()
+    }
+    stac_cfg["*"] = {"warnings": "ignore"}
+    return stac_cfg
+
+
+def db_scale(stack: "xr.Dataset", dtype: str = "float16") -> "xr.Dataset":
+    """
+    Convert backscatter to decibels
+
+    For dask-backed stacks this is added to the loading graph, so it runs per chunk right after
+    the read instead of as a separate pass over the full array. Nodata (non-positive) values
+    become NaN.
+    """
+
+    def to_db(data_array: "xr.DataArray") -> "xr.DataArray":
+        positive = data_array > 0
+        decibels = 10 * np.log10(data_array.where(positive))
+        return decibels.astype(dtype).assign_attrs(data_array.attrs, units="dB", nodata=np.nan)
+
+    return stack.map(to_db, keep_attrs=False)
@@ -0,0 +1,98 @@
+"""Random locations without PV, for training chips with all-zero masks.
+
+Locations are stratified: a stratum is drawn first, by the `weight` property of its feature
+(1 if missing), then a uniform point inside it. Strata are polygons such as continents or
+land-cover classes, a cheap way to keep the points on land, in every climate and on surfaces
+that look like PV, without reading a land-cover raster per point. Without strata, the 1° cells
+of the known PV polygons are used, so negatives come from the surroundings of PV.
+
+A point is rejected when the area loaded around it intersects a known PV polygon, found with a
+spatial index query, so no imagery is loaded for points that can't be negatives. The imagery
+of many accepted points is found with one catalog search, see
+`solar_mapper.dataset.sentinel_2.search_items_per_point`.
+"""
+
+import math
+from typing import List, Optional, Sequence
+
+import numpy as np
+import shapely
+from shapely.geometry import box, shape
+from shapely.strtree import STRtree
+
+METRES_PER_DEGREE = 111_320.0
+
+
+def cell_strata(features: Sequence[dict]) -> List[dict]:
+    """The 1° cells that contain `features`, as equally weighted strata."""
+    points = [shape(feature["geometry"]).representative_point() for feature in features]
+    cells = sorted({(math.floor(point.x), math.floor(point.y)) for point in points})
+    return [
+        {"type": "Feature", "properties": {}, "geometry": box(x, y, x + 1, y + 1).__geo_interface__}
+        for x, y in cells
+    ]
+
+
+class NegativeSampler:
+    """Draws points away from known PV, stratified by region."""
+
+    def __init__(
+        self,
+        exclusions: Sequence[dict],
+        strata: Optional[Sequence[dict]] = None,
+        exclusion_m: float = 2_000.0,
+        max_attempts: int = 1_000,
+    ):
+        """Indexes the known PV and the strata the points are drawn from.
+
+        Args:
+            exclusions: GeoJSON features of the known PV, no point is drawn near them
+            strata: GeoJSON features of the regions to draw from, with an optional `weight`
+                property, the 1° cells of `exclusions` if None
+            exclusion_m: Half size of the square around each point that must not touch PV, at
+                least half the size of the area loaded for a chip
+            max_attempts: Points tried before a stratum is given up on
+        """
+        if strata is None:
+            strata = cell_strata(exclusions)
+        if not strata:
+            raise ValueError("Negatives need strata, or known PV to take them from")
+        self.tree = STRtree([shape(feature["geometry"]) for feature in exclusions])
+        self.strata = np.array([shape(feature["geometry"]) for feature in strata])
+        shapely.prepare(self.strata)
+        self.bounds = shapely.bounds(self.strata)
+        weights = np.array(
+            [(feature.get("properties") or {}).get("weight", 1.0) for feature in strata],
+            dtype=np.float64,
+        )
+        self.weights = weights / weights.sum()
+        self.exclusion_m = exclusion_m
+        self.max_attempts = max_attempts
+
+    def exclusion_box(self, x: float, y: float) -> shapely.Polygon:
+        """Square of `exclusion_m` around a Lat/Lon point."""
+        d_lat = self.exclusion_m / METRES_PER_DEGREE
+        d_lon = self.exclusion_m / (METRES_PER_DEGREE * max(math.cos(math.radians(y)), 1e-6))
+        return box(x - d_lon, y - d_lat, x + d_lon, y + d_lat)
+
+    def is_negative(self, x: float, y: float) -> bool:
+        """Whether no known PV is near the point."""
+        return not len(self.tree.query(self.exclusion_box(x, y), predicate="intersects"))
+
+    def draw(self, rng: np.random.Generator) -> dict:
+        """Draws a point feature, with the index of its stratum as property.
+
+        Raises:
+            ValueError: If no point of the drawn stratum is away from known PV
+        """
+        stratum = int(rng.choice(len(self.strata), p=self.weights))
+        minx, miny, maxx, maxy = self.bounds[stratum]
+        for _ in range(self.max_attempts):
+            x, y = rng.uniform(minx, maxx), rng.uniform(miny, maxy)
+            if shapely.contains_xy(self.strata[stratum], x, y) and self.is_negative(x, y):
+                return {
+                    "type": "Feature",
+                    "properties": {"stratum": stratum},
+                    "geometry": {"type": "Point", "coordinates": [x, y]},
+                }
+        raise ValueError(f"No location without PV found in stratum {stratum}")
@@ -0,0 +1,367 @@
+"""Retries, rate limiting and circuit breaking for remote reads, with failure accounting.
+
+Catalog searches and COG reads from Planetary Computer fail transiently (HTTP 429/5xx,
+timeouts, dropped connections) and SAS tokens of signed items expire during long runs. Every
+remote call made through `RemoteIO.call`:
+
+- waits for a token of the per-host rate limiter, so workers stay under the service limits
+- is retried on transient errors with jittered exponential backoff, which keeps workers that
+  failed together from retrying together
+- refreshes the SAS tokens and is retried once on HTTP 403
+- is rejected straight away while the circuit breaker of its host is open, after
+  `failure_threshold` consecutive failures, until `reset_timeout` has passed and a probe call
+  succeeds
+
+Calls that still fail raise `RemoteReadError`, which sampling loops treat as a skipped example
+(see `skip_failed_example`) instead of crashing the worker. All of it is counted in
+`RemoteIO.metrics` and logged every `log_interval` seconds by each process.
+"""
+
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Optional, TypeVar
+
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+T = TypeVar("T")
+
+DEFAULT_REMOTE_IO_SETTINGS: Dict[str, Any] = {
+    "max_attempts": 5,
+    "base_delay": 0.5,
+    "max_delay": 30.0,
+    "failure_threshold": 10,
+    "reset_timeout": 60.0,
+    # requests per second per host, unlimited if missing
+    "rate_limits": {"stac": 10.0},
+    "log_interval": 300.0,
+}
+
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+_STATUS_PATTERN = re.compile(r"(?:HTTP (?:response |status )?code:?|status[ =:]+)\s*(\d{3})", re.I)
+_TRANSIENT_MESSAGES = (
+    "timed out",
+    "timeout",
+    "connection reset",
+    "connection aborted",
+    "temporarily unavailable",
+    "remote end closed",
+    "broken pipe",
+)
+
+
+class RemoteReadError(IOError):
+    """A remote call failed for good, after its retries."""
+
+
+class CircuitOpenError(RemoteReadError):
+    """A call was rejected because the circuit breaker of its host is open."""
+
+    def __init__(self, host: str, retry_after: float):
+        super().__init__(f"Circuit of <{host}> is open, retry in {retry_after:.1f}s")
+        self.host = host
+        self.retry_after = retry_after
+
+
+def status_code(error: BaseException) -> Optional[int]:
+    """HTTP status code of an error of requests, aiohttp, pystac-client or GDAL, if any."""
+    for attribute in ("status_code", "status"):
+        code = getattr(error, attribute, None)
+        if isinstance(code, int):
+            return code
+    response = getattr(error, "response", None)
+    code = getattr(response, "status_code", None)
+    if isinstance(code, int):
+        return code
+    # GDAL/rasterio only report the status in the message
+    match = _STATUS_PATTERN.search(str(error))
+    return int(match.group(1)) if match else None
+
+
+def is_auth_error(error: BaseException) -> bool:
+    """Whether the error looks like an expired SAS token."""
+    return status_code(error) == 403
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a retry of the call that raised `error` may succeed."""
+    code = status_code(error)
+    if code is not None:
+        return code in TRANSIENT_STATUS_CODES
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    message = str(error).lower()
+    return any(text in message for text in _TRANSIENT_MESSAGES)
+
+
+def refresh_sas_tokens() -> None:
+    """Drops the cached Planetary Computer SAS tokens, so items are signed with new ones."""
+    try:
+        from planetary_computer import sas
+    except ImportError:
+        return
+    sas.TOKEN_CACHE.clear()
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` calls per second, with bursts of up to `burst` calls."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1.0)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Takes a token, sleeping until one is available, and returns the time slept."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class CircuitBreaker:
+    """Stops the calls to a host that keeps failing.
+
+    Opens after `failure_threshold` consecutive failures, lets a probe through after
+    `reset_timeout` seconds and closes again once a call succeeds.
+    """
+
+    def __init__(self, failure_threshold: int = 10, reset_timeout: float = 60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half-open" if self.retry_after() == 0 else "open"
+
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0)
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if self.retry_after() > 0:
+                return False
+            # half-open: one probe at a time, the others wait for the next timeout
+            self.opened_at = time.monotonic()
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self) -> bool:
+        """Counts a failure and returns whether it opened the circuit."""
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                opened = self.opened_at is None
+                self.opened_at = time.monotonic()
+                return opened
+            return False
+
+
+class RemoteIOMetrics:
+    """Per-host counters of remote calls, retries and failures."""
+
+    COUNTERS = (
+        "calls",
+        "successes",
+        "retries",
+        "failures",
+        "token_refreshes",
+        "circuit_opened",
+        "circuit_rejected",
+    )
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: dict.fromkeys(self.COUNTERS + ("backoff_seconds", "throttled_seconds"), 0.0)
+        )
+
+    def add(self, host: str, name: str, value: float = 1) -> None:
+        with self.lock:
+            self.counters[host][name] += value
+
+    def snapshot(self) -> Dict[str, float]:
+        """Flat `<host>/<counter>` dict of the counters."""
+        with self.lock:
+            return {
+                f"{host}/{name}": value
+                for host, counters in self.counters.items()
+                for name, value in counters.items()
+            }
+
+
+class RemoteIO:
+    """Runs remote calls with rate limiting, retries and a circuit breaker per host."""
+
+    def __init__(
+        self,
+        max_attempts: int = 5,
+        base_delay: float = 0.5,
+        max_delay: float = 30.0,
+        failure_threshold: int = 10,
+        reset_timeout: float = 60.0,
+        rate_limits: Optional[Dict[str, float]] = None,
+        log_interval: float = 300.0,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        """Sets the retry policy, the circuit breakers and the rate limits of the hosts.
+
+        Args:
+            max_attempts: Number of attempts of a call on transient errors
+            base_delay: Backoff before the first retry, doubled on every retry, in seconds
+            max_delay: Upper bound of the backoff in seconds
+            failure_threshold: Consecutive failures of a host that open its circuit
+            reset_timeout: Seconds an open circuit rejects calls before letting a probe through
+            rate_limits: Calls per second per host
+            log_interval: Seconds between logged summaries of the metrics, never if 0
+            sleep: Function sleeping between retries
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.log_interval = log_interval
+        self.sleep = sleep
+        self.limiters = {
+            host: RateLimiter(rate) for host, rate in (rate_limits or {}).items() if rate
+        }
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.metrics = RemoteIOMetrics()
+        self._last_log = time.monotonic()
+
+    def breaker(self, host: str) -> CircuitBreaker:
+        if host not in self.breakers:
+            self.breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+        return self.breakers[host]
+
+    def backoff(self, attempt: int) -> float:
+        """Full-jitter exponential backoff before retry `attempt` (from 1)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, host: str, function: Callable[..., T], *args, **kwargs) -> T:
+        """Calls `function(*args, **kwargs)` against `host`.
+
+        Args:
+            host: Name of the remote the call goes to, e.g. "stac" or "cog"
+            function: Function making the remote call
+            *args: Positional arguments of `function`
+            **kwargs: Keyword arguments of `function`
+
+        Returns:
+            The result of `function`
+
+        Raises:
+            CircuitOpenError: If the circuit of `host` is open
+            RemoteReadError: If the call still failed after its retries, from the last error
+        """
+        breaker = self.breaker(host)
+        refreshed = False
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                self.metrics.add(host, "circuit_rejected")
+                raise CircuitOpenError(host, breaker.retry_after())
+            if host in self.limiters:
+                self.metrics.add(host, "throttled_seconds", self.limiters[host].acquire())
+            self.metrics.add(host, "calls")
+            attempt += 1
+            try:
+                result = function(*args, **kwargs)
+            except RemoteReadError:
+                # a nested call already went through its retries
+                raise
+            except Exception as error:
+                if is_auth_error(error) and not refreshed:
+                    # expired SAS token, the retried call signs the items again
+                    refreshed = True
+                    refresh_sas_tokens()
+                    self.metrics.add(host, "token_refreshes")
+                    attempt -= 1
+                    continue
+                if not is_transient(error):
+                    raise
+                if breaker.record_failure():
+                    self.metrics.add(host, "circuit_opened")
+                    log.warning(f"Circuit of <{host}> opened after repeated failures: {error}")
+                if attempt >= self.max_attempts:
+                    self.metrics.add(host, "failures")
+                    self._maybe_log()
+                    raise RemoteReadError(f"<{host}> failed {attempt} times: {error}") from error
+                delay = self.backoff(attempt)
+                self.metrics.add(host, "retries")
+                self.metrics.add(host, "backoff_seconds", delay)
+                self.sleep(delay)
+                continue
+            breaker.record_success()
+            self.metrics.add(host, "successes")
+            self._maybe_log()
+            return result
+
+    def _maybe_log(self) -> None:
+        if self.log_interval and time.monotonic() - self._last_log > self.log_interval:
+            self._last_log = time.monotonic()
+            metrics = {key: round(value, 1) for key, value in self.metrics.snapshot().items()}
+            log.info(f"Remote I/O: {metrics}")
+
+
+_REMOTE_IO = RemoteIO(**DEFAULT_REMOTE_IO_SETTINGS)
+
+
+def configure_remote_io(settings: Optional[Dict[str, Any]] = None) -> RemoteIO:
+    """Replaces the `RemoteIO` of this process, has to be called in each DataLoader worker too.
+
+    Args:
+        settings: Overrides for `DEFAULT_REMOTE_IO_SETTINGS`
+
+    Returns:
+        The new `RemoteIO`
+    """
+    global _REMOTE_IO
+    settings = {**DEFAULT_REMOTE_IO_SETTINGS, **(settings or {})}
+    unknown = set(settings) - set(DEFAULT_REMOTE_IO_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown remote I/O settings: {sorted(unknown)}")
+    _REMOTE_IO = RemoteIO(**settings)
+    return _REMOTE_IO
+
+
+def get_remote_io() -> RemoteIO:
+    """The `RemoteIO` of this process."""
+    return _REMOTE_IO
+
+
+def skip_failed_example(error: RemoteReadError, max_wait: float = 60.0) -> None:
+    """Handles a remote failure of a sampling loop that moves on to the next example.
+
+    While a circuit is open, waits for it with jitter, so workers neither spin through examples
+    that can't load nor come back all at once.
+    """
+    if isinstance(error, CircuitOpenError):
+        time.sleep(min(error.retry_after, max_wait) * random.uniform(1.0, 1.5))
+    else:
+        log.debug(f"Skipping example: {error}")
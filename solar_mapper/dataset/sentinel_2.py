@@ -2,31 +2,33 @@ import geojson
 import pystac_client
 import planetary_computer
 from datetime import datetime, timedelta
-from odc.stac import stac_load
+from odc.geo.geobox import GeoBox
+from odc.geo.xr import xr_coords
+from odc.stac import output_geobox, parse_items, stac_load
+from typing import Dict, List, Optional, Sequence, Tuple
 import xarray as xr
 import numpy as np
 from rasterio.crs import CRS
 from rasterio.features import rasterize, warp
-import fsspec
 import pandas as pd
 from copy import deepcopy
+from shapely.geometry import MultiPoint, mapping, shape
+from shapely.strtree import STRtree
+from urllib.parse import urlsplit, urlunsplit
 
-# Configuration for ODC-STAC
-cfg = {
-    "sentinel-2-l2a": {
-        "assets": {
-            "*": {"data_type": "uint16", "nodata": 0},
-            "SCL": {"data_type": "uint8", "nodata": 0},
-            "visual": {"data_type": "uint8", "nodata": 0},
-        },
-        "sentinel-1-rtc": {
-            "assets": {
-                "*": {"data_type": "float32", "nodata": 0},
-            },
-        }
-    },
-    "*": {"warnings": "ignore"},
-}
+from solar_mapper.dataset.acquisitions import STAC_DATETIME_FORMAT, AcquisitionCalendar
+from solar_mapper.dataset.geojson_stream import iter_features
+from solar_mapper.dataset.label_store import LabelStore
+from solar_mapper.dataset.resilience import RemoteReadError, get_remote_io, skip_failed_example
+from solar_mapper.dataset.loading_profiles import (
+    LOADING_PROFILES,
+    db_scale,
+    get_loading_profiles,
+    get_stac_cfg,
+)
+
+# Configuration for ODC-STAC, the default profiles are validated on import
+cfg = get_stac_cfg(get_loading_profiles())
 
 
 def get_catalog() -> pystac_client.Client:
@@ -36,55 +38,350 @@ def get_catalog() -> pystac_client.Client:
     )
 
 
-def get_area_of_interest(feature, time_period: str = "2023-04-01/2023-08-01", num_samples=100, sortby_clouds=True,
-                         catalog=get_catalog()) -> xr.Dataset:
+_DEFAULT_CATALOG: Optional[pystac_client.Client] = None
+
+
+def default_catalog() -> pystac_client.Client:
+    """The Planetary Computer catalog of this process, opened on first use.
+
+    Importing this module stays offline, so DDP ranks and DataLoader workers only connect when
+    they search.
+    """
+    global _DEFAULT_CATALOG
+    if _DEFAULT_CATALOG is None:
+        _DEFAULT_CATALOG = get_catalog()
+    return _DEFAULT_CATALOG
+
+
+def __getattr__(name: str):
+    # `DEFAULT_CATALOG` used to be opened on import
+    if name == "DEFAULT_CATALOG":
+        return default_catalog()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Acquisition dates of the polygons sampled so far, each worker process keeps its own
+ACQUISITION_CALENDAR = AcquisitionCalendar()
+
+
+# Native ground sampling distance, in metres, of the Sentinel-2 L2A bands
+S2_BAND_RESOLUTION = {
+    "B01": 60,
+    "B02": 10,
+    "B03": 10,
+    "B04": 10,
+    "B05": 20,
+    "B06": 20,
+    "B07": 20,
+    "B08": 10,
+    "B8A": 20,
+    "B09": 60,
+    "B11": 20,
+    "B12": 20,
+    "SCL": 20,
+    "AOT": 10,
+    "WVP": 10,
+    "visual": 10,
+}
+
+
+def _upsample(data_array: xr.DataArray, geobox: GeoBox, factor: int) -> xr.DataArray:
+    """
+    Nearest-neighbour upsample a band loaded on a coarser, aligned grid onto `geobox`
+
+    The repeat is lazy for dask arrays, so the band is only held at its native resolution
+    until a chunk of it is computed.
+    """
+    height, width = geobox.shape
+    data = np.repeat(np.repeat(data_array.data, factor, axis=-2), factor, axis=-1)
+    return xr.DataArray(
+        data[..., :height, :width],
+        dims=data_array.dims,
+        coords={"time": data_array.time, **xr_coords(geobox, crs_coord_name="spatial_ref")},
+        attrs=data_array.attrs,
+    )
+
+
+def load_s2_bands(
+    items: list,
+    bands: Optional[Sequence[str]] = None,
+    resolution: int = 10,
+    native_resolution: bool = False,
+    chunks: Optional[Dict[str, int]] = None,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    profiles: Optional[Dict[str, dict]] = None,
+) -> xr.Dataset:
+    """
+    Load Sentinel-2 bands onto a common UTM grid
+
+    Args:
+        items: STAC items to load
+        bands: Assets to load, all of them if None
+        resolution: Output resolution in metres
+        native_resolution: Read bands coarser than `resolution` on their native 20/60m grid and
+            upsample them on the fly, instead of resampling them to `resolution` while reading
+        chunks: Dask chunking of the output, defaults to the chunking of the loading profile
+        bbox: Lat/Lon bounding box (minx, miny, maxx, maxy) to load, the full scenes if None
+        profiles: Loading profiles, see `solar_mapper.dataset.loading_profiles`
+
+    Returns:
+        xarray dataset of the bands, all on the `resolution` grid
+    """
+    profiles = profiles or LOADING_PROFILES
+    profile = profiles["sentinel-2-l2a"]
+    stac_cfg = get_stac_cfg(profiles)
+    chunks = chunks or profile["chunks"]
+    resampling = profile["resampling"]
+    if bands is None or not native_resolution:
+        return stac_load(
+            items,
+            bands=bands,
+            chunks=chunks,
+            stac_cfg=stac_cfg,
+            crs="utm",
+            resolution=resolution,
+            bbox=bbox,
+            resampling=resampling,
+        )
+    geobox = output_geobox(
+        list(parse_items(items, cfg=stac_cfg)),
+        bands=bands,
+        crs="utm",
+        resolution=resolution,
+        bbox=bbox,
+    )
+    # Group bands by how much coarser than the output grid they are stored
+    groups: Dict[int, List[str]] = {}
+    for band in bands:
+        factor = max(S2_BAND_RESOLUTION.get(band, resolution) // resolution, 1)
+        groups.setdefault(factor, []).append(band)
+    data_vars = {}
+    for factor, group_bands in groups.items():
+        group = stac_load(
+            items,
+            bands=group_bands,
+            chunks=chunks,
+            stac_cfg=stac_cfg,
+            geobox=geobox.zoom_out(factor),
+            resampling=resampling,
+        )
+        for band in group_bands:
+            data_vars[band] = group[band] if factor == 1 else _upsample(group[band], geobox, factor)
+    return xr.Dataset({band: data_vars[band] for band in bands})
+
+
+def search_items(catalog: pystac_client.Client, **params) -> list:
+    """
+    Run a catalog search and list its items, retrying transient failures
+
+    Args:
+        catalog: STAC catalog to search
+        params: passed on to `catalog.search`
+
+    Returns:
+        The items of all pages of the search
+    """
+    return get_remote_io().call(
+        "stac", lambda: [item for page in catalog.search(**params).pages() for item in page])
+
+
+def get_area_of_interest(
+    feature,
+    time_period: str = "2023-04-01/2023-08-01",
+    num_samples=100,
+    sortby_clouds=True,
+    catalog=None,
+    bands: Optional[Sequence[str]] = None,
+    s1_bands: Optional[Sequence[str]] = None,
+    native_resolution: bool = False,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    profiles: Optional[Dict[str, dict]] = None,
+) -> xr.Dataset:
+    """
+    Load the Sentinel-2 and Sentinel-1 stacks covering a feature
+
+    Args:
+        feature: GeoJSON feature to search for imagery of
+        time_period: Period to search, as "start/end"
+        num_samples: Maximum number of scenes to load per collection
+        sortby_clouds: Whether to prefer the least cloudy Sentinel-2 scenes
+        catalog: STAC catalog to search, the Planetary Computer one if None
+        bands: Sentinel-2 assets to load, all of them if None
+        s1_bands: Sentinel-1 assets to load, all of them if None and no Sentinel-1 if empty
+        native_resolution: Read 20/60m Sentinel-2 bands at their native resolution and
+            upsample them on the fly
+        bbox: Lat/Lon bounding box (minx, miny, maxx, maxy) to load, the full scenes if None
+        profiles: Loading profiles, see `solar_mapper.dataset.loading_profiles`
+
+    Returns:
+        Sentinel-2 stack, and Sentinel-1 stack on the same grid (None if no S1 bands requested)
+    """
     ## returns the coords in the GeoJSON
-    resolution = 10
-    area_of_interest = feature['geometry']
+    profiles = profiles or LOADING_PROFILES
+    catalog = catalog or default_catalog()
+    area_of_interest = feature["geometry"]
     ## Search sentinel 2 catalog
-    items = catalog.search(
+    all_items = search_items(
+        catalog,
         collections=["sentinel-2-l2a"],
         intersects=area_of_interest,
         datetime=time_period,
         sortby="eo:cloud_cover" if sortby_clouds else None,
-    ).pages()
-    all_items = [item for page in items for item in page]
-    all_items = all_items[:num_samples]  # Limit to max_images
-    stack = stac_load(
-        all_items,
-        chunks={"x": 1024, "y": 1024},
-        stac_cfg=cfg,
-        # crs="EPSG:4326",
-        # resolution=0.00009009
-        crs="utm",
-        resolution=resolution,
     )
+    all_items = all_items[:num_samples]  # Limit to max_images
+    if s1_bands is not None and len(s1_bands) == 0:
+        return load_stacks(
+            all_items,
+            None,
+            bands=bands,
+            s1_bands=s1_bands,
+            native_resolution=native_resolution,
+            bbox=bbox,
+            profiles=profiles,
+        )
     ## Search Sentinel-1 catalog
-    items = catalog.search(
+    s1_items = search_items(
+        catalog,
         collections=["sentinel-1-rtc"],
         intersects=area_of_interest,
         datetime=time_period,
-        sortby="datetime"
-    ).pages()
-    all_items = [item for page in items for item in page]
-    all_items = all_items[:num_samples]  # Limit to max_images
-    stack_s1 = stac_load(
+        sortby="datetime",
+    )
+    s1_items = s1_items[:num_samples]  # Limit to max_images
+    return load_stacks(
         all_items,
-        chunks={"x": 1024, "y": 1024},
-        stac_cfg=cfg,
-        # crs="EPSG:4326",
-        # resolution=0.00009009
-        crs="utm",
+        s1_items,
+        bands=bands,
+        s1_bands=s1_bands,
+        native_resolution=native_resolution,
+        bbox=bbox,
+        profiles=profiles,
+    )
+
+
+def load_stacks(
+    items: list,
+    s1_items: Optional[list] = None,
+    bands: Optional[Sequence[str]] = None,
+    s1_bands: Optional[Sequence[str]] = None,
+    native_resolution: bool = False,
+    bbox: Optional[Tuple[float, float, float, float]] = None,
+    profiles: Optional[Dict[str, dict]] = None,
+) -> Tuple[xr.Dataset, Optional[xr.Dataset]]:
+    """
+    Load the Sentinel-2 stack of `items`, and the Sentinel-1 stack of `s1_items` on its grid
+
+    Args:
+        items: Sentinel-2 STAC items
+        s1_items: Sentinel-1 STAC items, no Sentinel-1 if None
+        bands: Sentinel-2 assets to load, all of them if None
+        s1_bands: Sentinel-1 assets to load, all of them if None
+        native_resolution: Read 20/60m Sentinel-2 bands at their native resolution and
+            upsample them on the fly
+        bbox: Lat/Lon bounding box (minx, miny, maxx, maxy) to load, the full scenes if None
+        profiles: Loading profiles, see `solar_mapper.dataset.loading_profiles`
+
+    Returns:
+        Sentinel-2 stack, and Sentinel-1 stack on the same grid (None if `s1_items` is None)
+    """
+    resolution = 10
+    profiles = profiles or LOADING_PROFILES
+    stack = load_s2_bands(
+        items,
+        bands=bands,
         resolution=resolution,
+        native_resolution=native_resolution,
+        bbox=bbox,
+        profiles=profiles,
     )
     # Always check that the time is in order
     stack = stack.sortby("time", ascending=True)
+    if s1_items is None:
+        return stack, None
+    # Load onto the Sentinel-2 grid, so the two stacks line up pixel for pixel
+    profile_s1 = profiles["sentinel-1-rtc"]
+    stack_s1 = stac_load(
+        s1_items,
+        bands=s1_bands,
+        chunks=profile_s1["chunks"],
+        stac_cfg=get_stac_cfg(profiles),
+        geobox=stack.odc.geobox,
+        resampling=profile_s1["resampling"],
+    )
+    if profile_s1["db_scale"]:
+        stack_s1 = db_scale(stack_s1)
     stack_s1 = stack_s1.sortby("time", ascending=True)
-    # Merge the two stacks
 
     return stack, stack_s1
 
 
+def search_items_per_point(
+    points: Sequence[dict],
+    time_period: str,
+    collection: str = "sentinel-2-l2a",
+    num_samples: int = 1,
+    catalog=None,
+    max_cloud_cover: Optional[float] = None,
+) -> List[list]:
+    """
+    Find the scenes of many points with one catalog search
+
+    Args:
+        points: GeoJSON features of the points
+        time_period: Period to search, as "start/end"
+        collection: STAC collection to search
+        num_samples: Maximum number of scenes kept per point
+        catalog: STAC catalog to search, the Planetary Computer one if None
+        max_cloud_cover: Only Sentinel-2 scenes with at most this `eo:cloud_cover`, all if None
+
+    Returns:
+        The scenes covering each point, the least cloudy (Sentinel-2) or earliest (Sentinel-1)
+        first, empty for points without any
+    """
+    catalog = catalog or default_catalog()
+    geometries = [shape(point['geometry']) for point in points]
+    params = dict(
+        collections=[collection], intersects=mapping(MultiPoint(geometries)), datetime=time_period
+    )
+    if collection == "sentinel-2-l2a":
+        params["sortby"] = "eo:cloud_cover"
+        if max_cloud_cover is not None:
+            params["query"] = {"eo:cloud_cover": {"lte": max_cloud_cover}}
+    else:
+        params["sortby"] = "datetime"
+    items = search_items(catalog, **params)
+    # Split the scenes by footprint, keeping the order of the search
+    footprints = [shape(item.geometry) for item in items]
+    point_index, item_index = STRtree(footprints).query(geometries, predicate="intersects")
+    per_point = [[] for _ in points]
+    for point, item in sorted(zip(point_index.tolist(), item_index.tolist())):
+        if len(per_point[point]) < num_samples:
+            per_point[point].append(items[item])
+    return per_point
+
+
+def sign_items(items: Sequence) -> list:
+    """
+    Sign copies of the scenes again, with the SAS tokens currently cached
+
+    Scenes held on to after their search keep the tokens they were signed with, which expire.
+
+    Args:
+        items: Signed STAC items, e.g. from `search_items_per_point`
+
+    Returns:
+        The items with new tokens in the hrefs of their assets
+    """
+    signed = []
+    for item in items:
+        item = item.clone()
+        for asset in item.assets.values():
+            # signing leaves hrefs that already carry a token as they are
+            asset.href = urlunsplit(urlsplit(asset.href)._replace(query=""))
+        signed.append(planetary_computer.sign(item, copy=False))
+    return signed
+
+
 def make_segmentation_maps(pv_site: geojson.GeoJSON, stack: xr.Dataset, epsg: int= 4326) -> xr.Dataset:
     """
     Convert GeoJSON PV Site polygons to segmentation maps
@@ -116,8 +413,9 @@ def make_segmentation_maps(pv_site: geojson.GeoJSON, stack: xr.Dataset, epsg: in
         y_coord = np.abs(y_coords - coord[1]).argmin()
         x_coord = np.abs(x_coords - coord[0]).argmin()
         coords[i] = [int(x_coord), int(y_coord)]
-    pv_site['geometry']['coordinates'] = [coords]
-    output = rasterize(shapes=[pv_site['geometry']], out_shape=out_shape, fill=0, default_value=1)
+    # Rasterize a copy, so the example can be sampled again
+    pixel_geometry = {"type": pv_site["geometry"]["type"], "coordinates": [coords]}
+    output = rasterize(shapes=[pixel_geometry], out_shape=out_shape, fill=0, default_value=1)
     # Add the segmentation map to the stack
     stack['segmentation_map'] = xr.DataArray(output, dims=['y', 'x'])
     return stack
@@ -125,7 +423,9 @@ def make_segmentation_maps(pv_site: geojson.GeoJSON, stack: xr.Dataset, epsg: in
 
 def randomly_sample_from_valid_times(example: dict, start_time: datetime, end_time: datetime,
                                      search_delta: timedelta = timedelta(days=90), num_samples: int = 1,
-                                     date_property_name: str = 'Date') -> xr.Dataset:
+                                     date_property_name: str = 'Date',
+                                     calendar: Optional[AcquisitionCalendar] = ACQUISITION_CALENDAR,
+                                     **kwargs) -> xr.Dataset:
     """
     Randomly sample a time period from the valid times of an example
 
@@ -135,21 +435,32 @@ def randomly_sample_from_valid_times(example: dict, start_time: datetime, end_ti
         end_time: datetime of the end period to search from
         search_delta: length of the time period to search
         num_samples: number of samples to take
+        calendar: cache of the acquisitions of each example, windows are drawn around dates with
+            scenes, so they always find imagery. Any window of the period if None
+        kwargs: passed on to `get_area_of_interest`
 
     Returns:
         Image stack from that period, with at most num_samples
     """
     # Pick a random time period within start_time and end_time, and after 'Date' field in example['properties']
     # If no 'Date' field, use start_time
-    print(example)
     date_time: str = example['properties'].get('Date', start_time.strftime("%Y-%m-%d %H:%M:%S"))
     example_date: datetime = datetime.strptime(date_time, "%Y-%m-%d %H:%M:%S")
     start_time = max(start_time, example_date)
     end_time = max(end_time, example_date + search_delta)
-    search_start_time = start_time + (end_time - start_time - search_delta) * np.random.random()
-    search_period = search_start_time.strftime("%Y-%m-%d") + "/" + (search_start_time + search_delta).strftime(
-        "%Y-%m-%d")
-    stack = get_area_of_interest(example, time_period=search_period, num_samples=num_samples)
+    if calendar is not None:
+        # One search of the whole period per example, then only windows with scenes
+        search_start_time, search_end_time = calendar.sample_window(
+            example, start_time, end_time, search_delta, kwargs.get('catalog') or default_catalog())
+        search_period = (search_start_time.strftime(STAC_DATETIME_FORMAT) + "/"
+                         + search_end_time.strftime(STAC_DATETIME_FORMAT))
+    else:
+        search_start_time = start_time + (end_time - start_time - search_delta) * np.random.random()
+        search_period = search_start_time.strftime("%Y-%m-%d") + "/" + (search_start_time + search_delta).strftime(
+            "%Y-%m-%d")
+    stack = get_area_of_interest(
+        example, time_period=search_period, num_samples=num_samples, **kwargs
+    )
     return stack
 
 
@@ -172,30 +483,83 @@ def get_training_example(examples: list, start_time: datetime, end_time: datetim
     return randomly_sample_from_valid_times(example, start_time, end_time, search_delta, num_samples)
 
 
-def get_example_with_segmentation_map(example: geojson.GeoJSON, start_time: datetime, end_time: datetime,
-                                      search_delta: timedelta, num_samples: int = 1) -> xr.Dataset:
-    stack_s2, stack_s1 = randomly_sample_from_valid_times(example, start_time, end_time, search_delta, num_samples)
-    stack_s2 = make_segmentation_maps(example, stack_s2)
-    stack_s1 = make_segmentation_maps(example, stack_s1, epsg=32617)
+def get_example_with_segmentation_map(
+    example: geojson.GeoJSON,
+    start_time: datetime,
+    end_time: datetime,
+    search_delta: timedelta,
+    num_samples: int = 1,
+    label_store: Optional[LabelStore] = None,
+    **kwargs,
+) -> xr.Dataset:
+    stack_s2, stack_s1 = randomly_sample_from_valid_times(
+        example, start_time, end_time, search_delta, num_samples, **kwargs
+    )
+    if label_store is not None:
+        # Precomputed labels of every polygon, sliced to the grid of the stack
+        stack_s2['segmentation_map'] = xr.DataArray(label_store.read(stack_s2.odc.geobox), dims=['y', 'x'])
+    else:
+        stack_s2 = make_segmentation_maps(example, stack_s2)
+    if stack_s1 is not None:
+        # Sentinel-1 is loaded on the Sentinel-2 grid, so the mask is shared
+        stack_s1["segmentation_map"] = stack_s2["segmentation_map"]
     return stack_s2, stack_s1
 
 
-def get_example_without_segmentation_map(example: geojson.GeoJSON, start_time: datetime, end_time: datetime,
-                                         search_delta: timedelta, num_samples: int = 1) -> xr.Dataset:
-    stack = randomly_sample_from_valid_times(example, start_time, end_time, search_delta, num_samples)
+def get_example_without_segmentation_map(
+    example: geojson.GeoJSON,
+    start_time: datetime,
+    end_time: datetime,
+    search_delta: timedelta,
+    num_samples: int = 1,
+    **kwargs,
+) -> xr.Dataset:
+    stack = randomly_sample_from_valid_times(
+        example, start_time, end_time, search_delta, num_samples, **kwargs
+    )
     return stack
 
 
+def get_negative_example(
+    items: list, s1_items: Optional[list] = None, **kwargs
+) -> Tuple[xr.Dataset, Optional[xr.Dataset]]:
+    """
+    Load the stacks of a location without PV, with an all-zero segmentation map
+
+    Args:
+        items: Sentinel-2 scenes of the location, e.g. from `search_items_per_point`
+        s1_items: Sentinel-1 scenes of the location, no Sentinel-1 if None
+        kwargs: passed on to `load_stacks`, with the `bbox` of the location
+
+    Returns:
+        Sentinel-2 stack, and Sentinel-1 stack on the same grid, both with a `segmentation_map`
+    """
+    if not items:
+        raise ValueError("No Sentinel-2 scenes of the location")
+    if s1_items is not None and not s1_items:
+        raise ValueError("No Sentinel-1 scenes of the location")
+    stack_s2, stack_s1 = load_stacks(items, s1_items, **kwargs)
+    stack_s2['segmentation_map'] = xr.DataArray(np.zeros(stack_s2.odc.geobox.shape, dtype=np.uint8),
+                                                dims=['y', 'x'])
+    if stack_s1 is not None:
+        stack_s1['segmentation_map'] = stack_s2['segmentation_map']
+    return stack_s2, stack_s1
+
+
 def load_and_get_examples_from_geojson(geojson_file: str, start_time: datetime, end_time: datetime,
-                                       search_delta: timedelta = timedelta(days=90), num_samples: int = 1):
-    polygons = geojson.load(fsspec.open(geojson_file).open())
+                                       search_delta: timedelta = timedelta(days=90), num_samples: int = 1,
+                                       properties: Optional[Sequence[str]] = ("Date",)):
+    # Stream the file, keeping only the properties used for sampling
+    polygons = list(iter_features(geojson_file, properties=properties))
     while True:
-        example = polygons['features'][np.random.randint(len(polygons['features']))]
+        example = polygons[np.random.randint(len(polygons))]
         try:
             stack = get_example_with_segmentation_map(example, start_time, end_time, search_delta, num_samples)
             yield stack
         except ValueError:
             continue
+        except RemoteReadError as error:
+            skip_failed_example(error)
 
 
 def load_and_get_examples_from_gem(gem_geojson: geojson.GeoJSON, start_time: datetime, end_time: datetime,
@@ -208,6 +572,8 @@ def load_and_get_examples_from_gem(gem_geojson: geojson.GeoJSON, start_time: dat
             yield stack
         except ValueError:
             continue
+        except RemoteReadError as error:
+            skip_failed_example(error)
 
 
 def filter_gem_examples(gem_geojson: geojson.GeoJSON, start_time: datetime, end_time: datetime) -> geojson.GeoJSON:
@@ -220,4 +586,3 @@ def filter_gem_examples(gem_geojson: geojson.GeoJSON, start_time: datetime, end_
             filtered_examples.append(example)
     filtered_geojson['features'] = filtered_examples
     return filtered_geojson
-
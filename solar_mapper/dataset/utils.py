@@ -1,21 +1,22 @@
 import requests, json, os, logging, math, geojson
-import fsspec
+from solar_mapper.dataset.cog import open_remote
+from solar_mapper.dataset.geojson_stream import FeatureStream
 
 
 def get_global_pv_mapping_polygons():
     """
     Returns a list of polygons that represent the global PV mapping
     """
-    cv_polygons = geojson.load(fsspec.open("https://zenodo.org/record/5005868/files/cv_polygons.geojson").open())
-    trn_polygons = geojson.load(fsspec.open("https://zenodo.org/record/5005868/files/trn_polygons.geojson").open())
-    test_polygons = geojson.load(fsspec.open("https://zenodo.org/record/5005868/files/test_polygons.geojson").open())
-    predicted_polygons = None #geojson.load(fsspec.open("https://zenodo.org/record/5005868/files/predicted_set.geojson").open())
-    # Predicted set throws an error when opening with geoJSON, about NaN not being valid JSON.
+    cv_polygons = geojson.load(open_remote("https://zenodo.org/record/5005868/files/cv_polygons.geojson").open())
+    trn_polygons = geojson.load(open_remote("https://zenodo.org/record/5005868/files/trn_polygons.geojson").open())
+    test_polygons = geojson.load(open_remote("https://zenodo.org/record/5005868/files/test_polygons.geojson").open())
+    # The predicted set is large and contains NaN values that geojson rejects, so it is streamed
+    predicted_polygons = FeatureStream("https://zenodo.org/record/5005868/files/predicted_set.geojson")
     return {"cv": cv_polygons, "train": trn_polygons, "test": test_polygons, "predicted": predicted_polygons}
 
 
 def get_global_energy_monitor_polygons():
-    solar_plants = geojson.load(fsspec.open("zip://*.geojson::https://globalenergymonitor.org/wp-content/uploads/2023/01/Global-Solar-Power-Tracker-January-2023-GIS.zip").open())
+    solar_plants = geojson.load(open_remote("zip://*.geojson::https://globalenergymonitor.org/wp-content/uploads/2023/01/Global-Solar-Power-Tracker-January-2023-GIS.zip").open())
     return solar_plants
 
 
@@ -0,0 +1,221 @@
+"""Matching of detected PV polygons to Global Energy Monitor plants and capacity estimation.
+
+Polygons are matched to the nearest GEM plant with a bulk k-nearest-neighbour query on a KD-tree
+of unit vectors, then the candidate distances are refined with vectorized geodesic distances on
+the WGS84 ellipsoid, so the whole tracker is matched in seconds. Matched plants give the
+capacity per area of each region (e.g. country), which estimates the capacity of every polygon.
+"""
+
+from typing import Any, List, Optional, Tuple
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Geod
+from scipy.spatial import cKDTree
+
+from solar_mapper.evaluation.polygon_metrics import EQUAL_AREA_CRS, to_geodataframe
+
+WGS84 = Geod(ellps="WGS84")
+# mean earth radius, converts geodesic distances to chord lengths on the unit sphere
+EARTH_RADIUS_M = 6_371_008.8
+
+CAPACITY_COLUMN = "Capacity (MW)"
+START_YEAR_COLUMN = "Start year"
+RETIRED_YEAR_COLUMN = "Retired year"
+
+
+def geodesic_distance(
+    lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray
+) -> np.ndarray:
+    """Geodesic distances in meters between arrays of points on the WGS84 ellipsoid.
+
+    Vectorized replacement of `solar_mapper.dataset.utils.V_inv`, which returns kilometers for
+    a single pair of points.
+    """
+    _, _, distance = WGS84.inv(
+        np.asarray(lon1, dtype=float),
+        np.asarray(lat1, dtype=float),
+        np.asarray(lon2, dtype=float),
+        np.asarray(lat2, dtype=float),
+    )
+    return np.asarray(distance)
+
+
+def unit_vectors(lat: np.ndarray, lon: np.ndarray) -> np.ndarray:
+    """Converts latitudes and longitudes in degrees to (N, 3) unit vectors."""
+    lat, lon = np.radians(lat), np.radians(lon)
+    cos_lat = np.cos(lat)
+    return np.stack([cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)], axis=-1)
+
+
+def operating_plants(gem: gpd.GeoDataFrame, start_year: int, end_year: int) -> gpd.GeoDataFrame:
+    """Plants started before `end_year` and not retired before `start_year`.
+
+    Vectorized equivalent of `solar_mapper.dataset.sentinel_2.filter_gem_examples`.
+    """
+    started = pd.to_numeric(gem[START_YEAR_COLUMN], errors="coerce")
+    retired = pd.to_numeric(
+        gem.get(RETIRED_YEAR_COLUMN, pd.Series(index=gem.index)), errors="coerce"
+    )
+    operating = (started < end_year) & (retired.isna() | (retired > start_year))
+    return gem[operating.to_numpy()]
+
+
+def match_to_gem(
+    polygons: gpd.GeoDataFrame, gem: gpd.GeoDataFrame, max_distance_m: float = 2000.0, k: int = 4
+) -> pd.DataFrame:
+    """Matches each polygon to the nearest GEM plant within `max_distance_m`.
+
+    Distances are measured from a point on the surface of each polygon, several polygons can
+    match the same plant, e.g. the arrays of one solar farm.
+
+    Args:
+        polygons: Detected polygons
+        gem: GEM plants as points
+        max_distance_m: Maximum geodesic distance of a match
+        k: Number of nearest candidates refined with geodesic distances
+
+    Returns:
+        For each matched polygon (indexed like `polygons`), the index of its plant in `gem`
+        (`gem_index`) and the distance to it (`distance_m`)
+    """
+    polygon_points = shapely.point_on_surface(np.asarray(polygons.to_crs("EPSG:4326").geometry))
+    polygon_xy = shapely.get_coordinates(polygon_points)
+    gem_xy = shapely.get_coordinates(np.asarray(gem.to_crs("EPSG:4326").geometry))
+    if len(polygon_xy) == 0 or len(gem_xy) == 0:
+        return pd.DataFrame({"gem_index": [], "distance_m": []}, index=polygons.index[:0])
+
+    k = min(k, len(gem_xy))
+    tree = cKDTree(unit_vectors(gem_xy[:, 1], gem_xy[:, 0]))
+    # the ellipsoid differs from the sphere by well under 1%, the bound is loosened for it
+    chord = 2 * np.sin(min(np.pi, 1.01 * max_distance_m / EARTH_RADIUS_M) / 2)
+    _, candidates = tree.query(
+        unit_vectors(polygon_xy[:, 1], polygon_xy[:, 0]), k=k, distance_upper_bound=chord
+    )
+    candidates = candidates.reshape(len(polygon_xy), k)
+    # missing neighbours are returned as len(gem_xy)
+    found = candidates < len(gem_xy)
+    rows, columns = np.nonzero(found)
+    plants = candidates[rows, columns]
+    distances = np.full(candidates.shape, np.inf)
+    distances[rows, columns] = geodesic_distance(
+        polygon_xy[rows, 1], polygon_xy[rows, 0], gem_xy[plants, 1], gem_xy[plants, 0]
+    )
+
+    nearest = distances.argmin(axis=1)
+    distance = distances[np.arange(len(distances)), nearest]
+    matched = distance <= max_distance_m
+    return pd.DataFrame(
+        {
+            "gem_index": gem.index.to_numpy()[candidates[matched, nearest[matched]]],
+            "distance_m": distance[matched],
+        },
+        index=polygons.index[matched],
+    )
+
+
+def fit_capacity_density(
+    areas_m2: pd.Series,
+    matches: pd.DataFrame,
+    gem: pd.DataFrame,
+    regions: Optional[pd.Series] = None,
+    min_plants: int = 10,
+    capacity_column: str = CAPACITY_COLUMN,
+) -> pd.Series:
+    """Fits the capacity per area (MW/km²) of each region from polygons matched to GEM plants.
+
+    The density of a region is the median over its plants of the plant capacity divided by the
+    area of the polygons matched to it, robust to plants only partly detected. Regions with
+    fewer than `min_plants` matched plants use the global density.
+
+    Args:
+        areas_m2: Areas of the polygons
+        matches: Output of `match_to_gem`
+        gem: GEM plants with their capacity
+        regions: Region of each polygon, a single global density if None
+        min_plants: Minimum number of matched plants of a region
+        capacity_column: Column of `gem` with the capacity in MW
+
+    Returns:
+        MW/km² per region, with the global density under the key `"global"`
+    """
+    matched = pd.DataFrame(
+        {
+            "gem_index": matches.gem_index,
+            "area_km2": areas_m2.loc[matches.index] / 1e6,
+            "region": "global" if regions is None else regions.loc[matches.index],
+        }
+    )
+    plants = matched.groupby("gem_index").agg(
+        area_km2=("area_km2", "sum"), region=("region", "first")
+    )
+    plants["capacity_mw"] = pd.to_numeric(gem.loc[plants.index, capacity_column], errors="coerce")
+    plants = plants[(plants.capacity_mw > 0) & (plants.area_km2 > 0)]
+    plants["density"] = plants.capacity_mw / plants.area_km2
+
+    densities = plants.groupby("region").density.agg(["median", "size"])
+    densities = densities.loc[densities["size"] >= min_plants, "median"]
+    densities["global"] = plants.density.median() if len(plants) else np.nan
+    return densities
+
+
+def estimate_capacity(
+    areas_m2: pd.Series, densities: pd.Series, regions: Optional[pd.Series] = None
+) -> pd.Series:
+    """Estimates the capacity in MW of polygons from the densities of `fit_capacity_density`."""
+    if regions is None:
+        density = pd.Series(densities["global"], index=areas_m2.index)
+    else:
+        density = regions.map(densities).fillna(densities["global"])
+    return areas_m2 / 1e6 * density
+
+
+def capacity_table(
+    polygons: Any,
+    gem: Any,
+    region_column: Optional[str] = None,
+    max_distance_m: float = 2000.0,
+    min_plants: int = 10,
+    years: Optional[Tuple[int, int]] = None,
+    capacity_column: str = CAPACITY_COLUMN,
+    gem_columns: Optional[List[str]] = None,
+) -> gpd.GeoDataFrame:
+    """Joins detected polygons with their GEM plants and estimates their capacity.
+
+    Args:
+        polygons: Detected polygons, see `to_geodataframe`
+        gem: GEM plants, e.g. `get_global_energy_monitor_polygons()`
+        region_column: Column of `polygons` with their region (e.g. country, see
+            `solar_mapper.evaluation.polygon_metrics.assign_regions`), densities are fitted per
+            region if given
+        max_distance_m: Maximum geodesic distance of a match
+        min_plants: Minimum number of matched plants to fit the density of a region
+        years: `(start_year, end_year)`, only match plants operating in between
+        capacity_column: Column of `gem` with the capacity in MW
+        gem_columns: Columns of `gem` added to matched polygons, defaults to all
+
+    Returns:
+        `polygons` with `area_m2`, `estimated_capacity_mw`, and for matched polygons
+        `gem_index`, `distance_m` and the `gem_columns` (prefixed with `gem_`)
+    """
+    polygons = to_geodataframe(polygons)
+    gem = to_geodataframe(gem)
+    if years is not None:
+        gem = operating_plants(gem, *years)
+
+    areas = pd.Series(
+        shapely.area(np.asarray(polygons.to_crs(EQUAL_AREA_CRS).geometry)), index=polygons.index
+    )
+    matches = match_to_gem(polygons, gem, max_distance_m)
+    regions = polygons[region_column] if region_column else None
+    densities = fit_capacity_density(areas, matches, gem, regions, min_plants, capacity_column)
+
+    table = polygons.copy()
+    table["area_m2"] = areas
+    table["estimated_capacity_mw"] = estimate_capacity(areas, densities, regions)
+    gem_columns = [c for c in (gem_columns or gem.columns) if c != gem.geometry.name]
+    attributes = gem.loc[matches.gem_index, gem_columns].add_prefix("gem_")
+    attributes.index = matches.index
+    return table.join(matches).join(attributes)
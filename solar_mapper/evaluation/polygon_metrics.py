@@ -0,0 +1,245 @@
+"""Object-level evaluation of predicted PV polygons against reference inventories.
+
+Predicted polygons are matched one-to-one to reference polygons (e.g.
+`get_global_pv_mapping_polygons()["test"]`) by IoU, or to reference points (e.g. the Global
+Energy Monitor plants of `get_global_energy_monitor_polygons()`) by containment. Candidate pairs
+come from a spatial index query, and intersections are computed only for them with vectorized
+shapely operations, so millions of polygons take minutes rather than the hours of an all-pairs
+comparison.
+
+    python -m solar_mapper.evaluation.polygon_metrics predicted.parquet reference.geojson
+"""
+
+from typing import Any, Dict, NamedTuple, Optional, Tuple, Union
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.strtree import STRtree
+
+# equal-area CRS, areas and IoU are computed in it
+EQUAL_AREA_CRS = "EPSG:6933"
+
+
+def to_geodataframe(polygons: Any, crs: Any = "EPSG:4326") -> gpd.GeoDataFrame:
+    """Reads a path, GeoJSON FeatureCollection or GeoDataFrame into a GeoDataFrame."""
+    if isinstance(polygons, gpd.GeoDataFrame):
+        return polygons
+    if isinstance(polygons, str):
+        if polygons.endswith(".parquet"):
+            return gpd.read_parquet(polygons)
+        return gpd.read_file(polygons)
+    return gpd.GeoDataFrame.from_features(polygons, crs=crs)
+
+
+class Matches(NamedTuple):
+    """One-to-one matches between predicted and reference geometries."""
+
+    pred_index: np.ndarray
+    ref_index: np.ndarray
+    iou: np.ndarray
+    # area of each predicted polygon covered by reference polygons, matched or not
+    pred_overlap: np.ndarray
+
+
+def match_polygons(
+    predicted: np.ndarray, reference: np.ndarray, iou_threshold: float = 0.5
+) -> Matches:
+    """Matches predicted to reference geometries one-to-one, greedily by decreasing IoU.
+
+    Reference points are matched to the predicted polygons containing them, with an IoU of NaN.
+
+    Args:
+        predicted: Array of predicted polygons, in an equal-area CRS
+        reference: Array of reference polygons or points, in the same CRS
+        iou_threshold: Minimum IoU of a polygon match
+
+    Returns:
+        The matches
+    """
+    pred_index, ref_index = STRtree(reference).query(predicted, predicate="intersects")
+    points = shapely.get_type_id(reference[ref_index]) == shapely.GeometryType.POINT
+    intersections = np.zeros(len(pred_index))
+    intersections[~points] = shapely.area(
+        shapely.intersection(predicted[pred_index[~points]], reference[ref_index[~points]])
+    )
+    unions = shapely.area(predicted[pred_index]) + shapely.area(reference[ref_index])
+    unions -= intersections
+    ious = np.divide(intersections, unions, out=np.zeros_like(unions), where=unions > 0)
+    ious[points] = np.nan
+    pred_overlap = np.bincount(pred_index, weights=intersections, minlength=len(predicted))
+
+    keep = points | (ious >= iou_threshold)
+    # NaN (points) sort last, after every polygon match
+    order = np.flatnonzero(keep)[np.argsort(-ious[keep], kind="stable")]
+    # only pairs above the threshold are left, usually about one per polygon
+    pred_used, ref_used = set(), set()
+    selected = []
+    for i, p, r in zip(order.tolist(), pred_index[order].tolist(), ref_index[order].tolist()):
+        if p not in pred_used and r not in ref_used:
+            pred_used.add(p)
+            ref_used.add(r)
+            selected.append(i)
+    selected = np.asarray(selected, dtype=int)
+    return Matches(pred_index[selected], ref_index[selected], ious[selected], pred_overlap)
+
+
+def _metrics(
+    predicted: pd.DataFrame, reference: pd.DataFrame, matches: pd.DataFrame
+) -> pd.DataFrame:
+    """Computes the metrics per `group` of the per-polygon and per-match tables."""
+    pred = predicted.groupby("group").agg(
+        num_predicted=("area", "size"),
+        true_positives=("matched", "sum"),
+        predicted_area=("area", "sum"),
+        overlap_area=("overlap", "sum"),
+    )
+    ref = reference.groupby("group").agg(
+        num_reference=("area", "size"), detected=("matched", "sum"), reference_area=("area", "sum")
+    )
+    matches = matches.assign(abs_area_error=matches.area_error.abs())
+    per_match = matches.groupby("group").agg(
+        mean_iou=("iou", "mean"),
+        mean_area_error=("area_error", "mean"),
+        median_abs_area_error=("abs_area_error", "median"),
+    )
+    metrics = pred.join(ref, how="outer").join(per_match, how="left")
+    counts = ["num_predicted", "true_positives", "num_reference", "detected"]
+    areas = ["predicted_area", "overlap_area", "reference_area"]
+    metrics[counts + areas] = metrics[counts + areas].fillna(0)
+    metrics[counts] = metrics[counts].astype(np.int64)
+
+    metrics["precision"] = metrics.true_positives / metrics.num_predicted.replace(0, np.nan)
+    metrics["recall"] = metrics.detected / metrics.num_reference.replace(0, np.nan)
+    metrics["f1"] = 2 * metrics.precision * metrics.recall / (metrics.precision + metrics.recall)
+    union = metrics.predicted_area + metrics.reference_area - metrics.overlap_area
+    metrics["area_iou"] = metrics.overlap_area / union.replace(0, np.nan)
+    metrics["predicted_area_km2"] = metrics.predicted_area / 1e6
+    metrics["reference_area_km2"] = metrics.reference_area / 1e6
+    columns = ["num_predicted", "num_reference", "precision", "recall", "f1", "mean_iou"]
+    columns += ["area_iou", "mean_area_error", "median_abs_area_error"]
+    return metrics[columns + ["predicted_area_km2", "reference_area_km2"]]
+
+
+def evaluate_polygons(
+    predicted: Any,
+    reference: Any,
+    iou_threshold: float = 0.5,
+    group_by: Optional[str] = None,
+    tile_size_m: Optional[float] = None,
+) -> Tuple[Dict[str, float], Optional[pd.DataFrame]]:
+    """Computes object-level precision/recall/F1, IoU and area errors of predicted polygons.
+
+    Precision is the fraction of predicted polygons matched to a reference, recall the fraction
+    of references matched. `area_iou` compares the total predicted and reference areas,
+    regardless of matching, and area errors are those of matched polygons, relative to the
+    reference area. IoUs and area errors are NaN for point references.
+
+    Args:
+        predicted: Predicted polygons, see `to_geodataframe`
+        reference: Reference polygons or points, see `to_geodataframe`
+        iou_threshold: Minimum IoU of a polygon match
+        group_by: Column present in both inventories to break the metrics down by, e.g. the
+            country (see `assign_regions`)
+        tile_size_m: Break the metrics down by square tiles of this size instead
+
+    Returns:
+        The overall metrics and, if `group_by` or `tile_size_m` is given, the metrics per group
+    """
+    predicted = to_geodataframe(predicted).to_crs(EQUAL_AREA_CRS)
+    reference = to_geodataframe(reference).to_crs(EQUAL_AREA_CRS)
+    pred_geometries = np.asarray(predicted.geometry)
+    ref_geometries = np.asarray(reference.geometry)
+    matches = match_polygons(pred_geometries, ref_geometries, iou_threshold)
+
+    pred = pd.DataFrame(
+        {"area": shapely.area(pred_geometries), "overlap": matches.pred_overlap, "matched": False}
+    )
+    pred.loc[matches.pred_index, "matched"] = True
+    ref = pd.DataFrame({"area": shapely.area(ref_geometries), "matched": False})
+    ref.loc[matches.ref_index, "matched"] = True
+    matched_ref_area = ref.area.to_numpy()[matches.ref_index]
+    area_error = pred.area.to_numpy()[matches.pred_index] - matched_ref_area
+    area_error /= np.where(matched_ref_area > 0, matched_ref_area, np.nan)
+    pairs = pd.DataFrame({"iou": matches.iou, "area_error": area_error})
+
+    summary = _metrics(pred.assign(group=0), ref.assign(group=0), pairs.assign(group=0))
+    summary = summary.iloc[0].to_dict() if len(summary) else {}
+    if group_by is None and tile_size_m is None:
+        return summary, None
+
+    if tile_size_m is not None:
+        pred["group"] = _tile_keys(pred_geometries, tile_size_m)
+        ref["group"] = _tile_keys(ref_geometries, tile_size_m)
+    else:
+        pred["group"] = predicted[group_by].to_numpy()
+        ref["group"] = reference[group_by].to_numpy()
+    # matches count for the precision in the group of the predicted polygon, and for the recall
+    # in the group of the reference
+    pairs["group"] = pred.group.to_numpy()[matches.pred_index]
+    return summary, _metrics(pred, ref, pairs)
+
+
+def _tile_keys(geometries: np.ndarray, tile_size_m: float) -> np.ndarray:
+    points = shapely.point_on_surface(geometries)
+    tiles = pd.DataFrame(np.floor(shapely.get_coordinates(points) / tile_size_m).astype(np.int64))
+    return (tiles[0].astype(str) + "_" + tiles[1].astype(str)).to_numpy()
+
+
+def assign_regions(
+    polygons: gpd.GeoDataFrame,
+    regions: Union[str, gpd.GeoDataFrame],
+    column: str,
+    name: Optional[str] = None,
+) -> gpd.GeoDataFrame:
+    """Adds the `column` of the region (e.g. country) each polygon lies in to `polygons`.
+
+    Each polygon gets the region containing a point on its surface, so polygons crossing a
+    border are counted once. Polygons outside every region get NaN.
+
+    Args:
+        polygons: Polygons or points
+        regions: Region polygons, or a path to them
+        column: Column of `regions` with the region name
+        name: Name of the added column, defaults to `column`
+
+    Returns:
+        A copy of `polygons` with the region column
+    """
+    regions = to_geodataframe(regions)[[column, "geometry"]].to_crs(polygons.crs)
+    points = gpd.GeoDataFrame(geometry=polygons.geometry.representative_point(), crs=polygons.crs)
+    joined = gpd.sjoin(points, regions, how="left", predicate="within")
+    # points on shared borders can fall within several regions, keep the first
+    joined = joined[~joined.index.duplicated(keep="first")]
+    polygons = polygons.copy()
+    polygons[name or column] = joined[column].reindex(polygons.index).to_numpy()
+    return polygons
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("predicted", help="Predicted polygons (GeoParquet/GeoJSON)")
+    parser.add_argument("reference", help="Reference polygons or points")
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--regions", help="Region polygons to break the metrics down by")
+    parser.add_argument("--region-column", default="name")
+    parser.add_argument("--tile-size-m", type=float)
+    args = parser.parse_args()
+
+    predicted = to_geodataframe(args.predicted)
+    reference = to_geodataframe(args.reference)
+    group_by = None
+    if args.regions:
+        predicted = assign_regions(predicted, args.regions, args.region_column, "region")
+        reference = assign_regions(reference, args.regions, args.region_column, "region")
+        group_by = "region"
+    summary, groups = evaluate_polygons(
+        predicted, reference, args.iou_threshold, group_by, args.tile_size_m
+    )
+    for key, value in summary.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+    if groups is not None:
+        print(groups.to_string())
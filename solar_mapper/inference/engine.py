@@ -0,0 +1,180 @@
+"""Batched CPU inference over streams of tiles.
+
+Loading tiles (STAC reads, decoding) is I/O bound and runs in a thread pool, ahead of the
+network, while inference runs batched in the calling thread with a fixed number of intra-op
+threads. One engine per process with `intra_op_threads` set to the cores it may use scales
+across a CPU fleet without oversubscription.
+"""
+
+import itertools
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+import numpy as np
+import torch
+from torch import nn
+
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+Tile = TypeVar("Tile")
+
+
+class CPUInferenceEngine:
+    """Runs an exported (TorchScript/ONNX) or eager segmentation model over tiles.
+
+    Inputs are float32 (C, H, W) arrays of raw stacked bands, see
+    `solar_mapper.inference.export.Segmenter`, outputs are (1, H, W) probabilities.
+    """
+
+    def __init__(
+        self,
+        model_path: Optional[str] = None,
+        model: Optional[nn.Module] = None,
+        batch_size: int = 16,
+        intra_op_threads: Optional[int] = None,
+        io_threads: int = 4,
+        prefetch_batches: int = 2,
+        quantize: bool = False,
+    ):
+        """Loads the model and sets the thread counts of inference.
+
+        Args:
+            model_path: Path of a TorchScript (`.pt`/`.ts`) or ONNX (`.onnx`) model
+            model: Eager model, used instead of `model_path`
+            batch_size: Number of tiles per forward pass
+            intra_op_threads: Threads used inside each operator, defaults to all cores
+            io_threads: Threads loading tiles
+            prefetch_batches: Number of batches loaded ahead of inference
+            quantize: Dynamically quantize the convolutions of an ONNX model to int8, into a new
+                file next to the original
+
+        Raises:
+            ValueError: If `quantize` is set for a TorchScript or eager model, PyTorch has no
+                dynamically quantized convolutions
+        """
+        if (model_path is None) == (model is None):
+            raise ValueError("Pass either `model_path` or `model`")
+        onnx = model_path is not None and model_path.endswith(".onnx")
+        if quantize and not onnx:
+            raise ValueError(
+                "int8 quantization needs an ONNX model, export it with `export.py` and quantize "
+                "it with `quantize_onnx`"
+            )
+        self.batch_size = batch_size
+        self.intra_op_threads = intra_op_threads or os.cpu_count() or 1
+        self.io_threads = io_threads
+        self.prefetch_batches = prefetch_batches
+
+        if onnx:
+            self._session = self._onnx_session(model_path, quantize)
+            self._module = None
+        else:
+            torch.set_num_threads(self.intra_op_threads)
+            self._session = None
+            self._module = torch.jit.load(model_path) if model is None else model.eval()
+
+    def _onnx_session(self, model_path: str, quantize: bool):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("Running ONNX models needs `onnxruntime` installed")
+
+        if quantize:
+            from solar_mapper.inference.export import quantize_onnx
+
+            model_path = quantize_onnx(model_path)
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = self.intra_op_threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        return onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+
+    def predict_batch(self, batch: np.ndarray) -> np.ndarray:
+        """Predicts a (N, C, H, W) float32 batch."""
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+        if self._session is not None:
+            return self._session.run(None, {self._session.get_inputs()[0].name: batch})[0]
+        with torch.inference_mode():
+            inputs = torch.from_numpy(batch).contiguous(memory_format=torch.channels_last)
+            return self._module(inputs).float().numpy()
+
+    def _flush(
+        self, tiles: List[Tile], arrays: List[np.ndarray]
+    ) -> Iterator[Tuple[Tile, np.ndarray]]:
+        predictions = self.predict_batch(np.stack(arrays))
+        yield from zip(tiles, predictions)
+        tiles.clear()
+        arrays.clear()
+
+    def run(
+        self, tiles: Iterable[Tile], load: Callable[[Tile], np.ndarray]
+    ) -> Iterator[Tuple[Tile, np.ndarray]]:
+        """Loads and predicts tiles, yielding `(tile, prediction)` in the order of `tiles`.
+
+        Args:
+            tiles: Tile identifiers, e.g. bounding boxes, consumed lazily
+            load: Function loading the (C, H, W) input of a tile, called in the I/O threads
+
+        Yields:
+            Each tile with its (1, H, W) prediction, consecutive tiles of the same shape are
+            batched together
+        """
+        tiles = iter(tiles)
+        max_pending = self.batch_size * self.prefetch_batches
+        batch_tiles: List[Tile] = []
+        batch_arrays: List[np.ndarray] = []
+        with ThreadPoolExecutor(self.io_threads, thread_name_prefix="tile-io") as pool:
+            pending = deque(
+                (tile, pool.submit(load, tile)) for tile in itertools.islice(tiles, max_pending)
+            )
+            while pending:
+                tile, future = pending.popleft()
+                array = future.result()
+                for next_tile in itertools.islice(tiles, 1):
+                    pending.append((next_tile, pool.submit(load, next_tile)))
+                if batch_arrays and array.shape != batch_arrays[0].shape:
+                    yield from self._flush(batch_tiles, batch_arrays)
+                batch_tiles.append(tile)
+                batch_arrays.append(array)
+                if len(batch_arrays) == self.batch_size:
+                    yield from self._flush(batch_tiles, batch_arrays)
+            if batch_arrays:
+                yield from self._flush(batch_tiles, batch_arrays)
+
+    def benchmark(
+        self, in_channels: int, tile_size: int = 256, num_tiles: int = 64, warmup: int = 1
+    ) -> Dict[str, float]:
+        """Measures throughput on random tiles.
+
+        Args:
+            in_channels: Number of input bands
+            tile_size: Size of the tiles in pixels
+            num_tiles: Number of timed tiles
+            warmup: Number of untimed batches run first
+
+        Returns:
+            Tiles per second, and tiles per hour per core of `intra_op_threads`
+        """
+        rng = np.random.default_rng(0)
+        tile = rng.uniform(0, 3000, (in_channels, tile_size, tile_size)).astype(np.float32)
+        for _ in range(warmup):
+            self.predict_batch(np.stack([tile] * self.batch_size))
+        start = time.perf_counter()
+        for _ in self.run(range(num_tiles), lambda _: tile):
+            pass
+        tiles_per_sec = num_tiles / (time.perf_counter() - start)
+        metrics = {
+            "tiles_per_sec": tiles_per_sec,
+            "tiles_per_hour_per_core": tiles_per_sec * 3600 / self.intra_op_threads,
+        }
+        log.info(
+            f"{tile_size}px tiles: {metrics['tiles_per_sec']:.2f}/sec, "
+            f"{metrics['tiles_per_hour_per_core']:.0f}/hour/core "
+            f"({self.intra_op_threads} intra-op threads)"
+        )
+        return metrics
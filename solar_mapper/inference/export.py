@@ -0,0 +1,124 @@
+"""Export of trained segmentation models for CPU map production.
+
+The exported model takes the raw stacked bands, Sentinel-2 digital numbers followed by
+Sentinel-1 dB (NaN for nodata), as float32 (N, C, H, W) and returns PV probabilities
+(N, 1, H, W), so inference code needs no knowledge of the training normalization.
+"""
+
+import inspect
+from typing import Optional
+
+import torch
+from omegaconf import DictConfig
+from torch import nn
+
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+
+class Segmenter(nn.Module):
+    """Segmentation network with the input scaling and output sigmoid baked in."""
+
+    def __init__(self, net: nn.Module, num_s2_bands: int, s2_scale: float, s1_scale: float):
+        super().__init__()
+        self.net = net
+        self.num_s2_bands = num_s2_bands
+        self.s2_scale = s2_scale
+        self.s1_scale = s1_scale
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        s2 = x[:, : self.num_s2_bands] * self.s2_scale
+        s1 = x[:, self.num_s2_bands :]
+        # isnan/where instead of nan_to_num, which not every exporter supports
+        s1 = torch.where(torch.isnan(s1), torch.zeros_like(s1), s1) * self.s1_scale
+        return torch.sigmoid(self.net(torch.cat([s2, s1], dim=1)))
+
+
+def load_segmenter(model_cfg: DictConfig, ckpt_path: str, num_s2_bands: int) -> Segmenter:
+    """Instantiates the model from its config and loads the weights of a Lightning checkpoint.
+
+    Args:
+        model_cfg: Config of the `SegmentationLitModule`
+        ckpt_path: Path of the checkpoint
+        num_s2_bands: Number of Sentinel-2 bands at the start of the input
+
+    Returns:
+        The network wrapped as `Segmenter`, in eval mode
+    """
+    import hydra
+
+    model = hydra.utils.instantiate(model_cfg)
+    state_dict = torch.load(ckpt_path, map_location="cpu", weights_only=False)["state_dict"]
+    # checkpoints of compiled networks prefix the weights with the wrapper attribute
+    state_dict = {key.replace("_orig_mod.", ""): value for key, value in state_dict.items()}
+    model.load_state_dict(state_dict)
+    segmenter = Segmenter(model.net, num_s2_bands, model.hparams.s2_scale, model.hparams.s1_scale)
+    return segmenter.eval()
+
+
+def export_torchscript(model: nn.Module, path: str, example: torch.Tensor) -> str:
+    """Traces `model` on `example`, freezes it for inference and saves it to `path`."""
+    with torch.no_grad():
+        traced = torch.jit.trace(model.eval(), example)
+        # optimize_for_inference is left out, its graphs can't always be loaded again
+        frozen = torch.jit.freeze(traced)
+    frozen.save(path)
+    log.info(f"Exported TorchScript model to <{path}>")
+    return path
+
+
+def export_onnx(model: nn.Module, path: str, example: torch.Tensor, opset: int = 17) -> str:
+    """Exports `model` to ONNX with dynamic batch size and tile size.
+
+    Args:
+        model: Model to export
+        path: Path of the ONNX file
+        example: Example input
+        opset: ONNX opset version
+
+    Returns:
+        The path of the ONNX file
+    """
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # the TorchScript-based exporter handles the dynamic tile size without extra packages
+        kwargs["dynamo"] = False
+    dynamic_axes = {0: "batch", 2: "height", 3: "width"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model.eval(),
+            (example,),
+            path,
+            input_names=["bands"],
+            output_names=["probability"],
+            dynamic_axes={"bands": dynamic_axes, "probability": dynamic_axes},
+            opset_version=opset,
+            **kwargs,
+        )
+    log.info(f"Exported ONNX model to <{path}>")
+    return path
+
+
+def quantize_onnx(path: str, quantized_path: Optional[str] = None) -> str:
+    """Dynamically quantizes the weights of an ONNX model to int8.
+
+    Convolutions become `ConvInteger` with activations quantized at runtime, which onnxruntime
+    runs with int8 kernels on CPU.
+
+    Args:
+        path: Path of the ONNX model
+        quantized_path: Path of the quantized model, defaults to `<path>.int8.onnx`
+
+    Returns:
+        The path of the quantized model
+    """
+    try:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+    except ImportError:
+        raise ImportError("int8 quantization of ONNX models needs `onnxruntime` installed")
+
+    quantized_path = quantized_path or path.replace(".onnx", ".int8.onnx")
+    quantize_dynamic(path, quantized_path, weight_type=QuantType.QInt8)
+    log.info(f"Quantized ONNX model to <{quantized_path}>")
+    return quantized_path
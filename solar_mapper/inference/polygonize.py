@@ -0,0 +1,415 @@
+"""Streaming polygonization of prediction rasters into a PV polygon inventory.
+
+Prediction tiles on a regular grid are thresholded, split into connected components and traced
+into polygons with `rasterio.features.shapes`. Polygons that don't touch the tile border are
+final and are simplified, filtered by area and written straight away. Polygons touching the
+border wait for the neighbouring tiles on those sides, are merged with the polygons they touch
+there, and are written once every tile they could extend into has been seen.
+
+Only this frontier of border polygons, and the indices of tiles whose neighbours are not all
+done yet, are kept in memory, so memory stays flat however large the mapped area is. Border
+polygons are indexed by the pixel edges (4-connectivity) or corners (8-connectivity) they have
+on the tile border, so a polygon finds the ones it joins without scanning the frontier, and
+polygons only join across tiles where their pixels would be connected inside a tile. Tiles can
+come in any order, tiles that never come (e.g. ocean) only delay polygons next to them until
+`close`.
+"""
+
+import json
+from typing import Any, Dict, Iterable, List, NamedTuple, Set, Tuple
+
+import numpy as np
+from affine import Affine
+from pyproj import CRS, Transformer
+from rasterio.features import shapes
+from scipy import ndimage
+from shapely import ops
+from shapely.geometry import MultiPolygon, Polygon, mapping, shape
+
+TileKey = Tuple[str, int, int]
+# pixel edge ("h"/"v") or corner ("p") on a tile border, in pixels of the grid of the CRS
+BorderCell = Tuple[str, int, int]
+
+
+class GridTile(NamedTuple):
+    """Position of a prediction tile on the grid of its CRS."""
+
+    row: int
+    col: int
+    transform: Affine
+    crs: Any
+
+
+class Component(NamedTuple):
+    """Connected component of a tile, with the grid offsets of the neighbours it touches."""
+
+    geometry: Polygon
+    pixel_count: int
+    probability_sum: float
+    sides: Set[Tuple[int, int]]
+    border: Set[BorderCell]
+
+
+def _border_cells(
+    labels: np.ndarray, transform: Affine, connectivity: int
+) -> Dict[int, Set[BorderCell]]:
+    """Border cells of each label, the same in the tiles on both sides of a border.
+
+    Pixels of neighbouring tiles are connected where they share an edge, or with 8-connectivity
+    also a corner, so components connect across tiles where their border cells match.
+    """
+    height, width = labels.shape
+    # pixel boundaries on the grid of the CRS, rounded off the floating point error of transforms
+    xs = np.rint((transform.c + transform.a * np.arange(width + 1)) / abs(transform.a))
+    ys = np.rint((transform.f + transform.e * np.arange(height + 1)) / abs(transform.e))
+    xs, ys = xs.astype(np.int64).tolist(), ys.astype(np.int64).tolist()
+
+    cells: Dict[int, Set[BorderCell]] = {}
+    # labels along each border, the boundaries along it and its position across it
+    borders = [
+        (labels[0], xs, ys[0], True),
+        (labels[-1], xs, ys[-1], True),
+        (labels[:, 0], ys, xs[0], False),
+        (labels[:, -1], ys, xs[-1], False),
+    ]
+    for edge, along, across, horizontal in borders:
+        for index in np.flatnonzero(edge):
+            start, end = sorted((along[index], along[index + 1]))
+            if horizontal:
+                corners, edge_cell = [(start, across), (end, across)], ("h", start, across)
+            else:
+                corners, edge_cell = [(across, start), (across, end)], ("v", across, start)
+            if connectivity == 8:
+                new = {("p", x, y) for x, y in corners}
+            else:
+                new = {edge_cell}
+            cells.setdefault(int(edge[index]), set()).update(new)
+    return cells
+
+
+def polygonize_tile(
+    probs: np.ndarray, transform: Affine, threshold: float = 0.5, connectivity: int = 8
+) -> List[Component]:
+    """Polygonizes the connected components of a thresholded (H, W) probability tile.
+
+    Args:
+        probs: PV probabilities
+        transform: Affine transform of the tile
+        threshold: Probability above which pixels count as PV
+        connectivity: 4 or 8 connectivity of the components
+
+    Returns:
+        One `Component` per connected component
+    """
+    mask = probs >= threshold
+    structure = np.ones((3, 3)) if connectivity == 8 else None
+    labels, num_labels = ndimage.label(mask, structure=structure)
+    if num_labels == 0:
+        return []
+
+    pixel_counts = np.bincount(labels.ravel(), minlength=num_labels + 1)
+    probability_sums = np.bincount(labels.ravel(), weights=probs.ravel(), minlength=num_labels + 1)
+
+    sides: Dict[int, Set[Tuple[int, int]]] = {label: set() for label in range(1, num_labels + 1)}
+    edges = {(-1, 0): labels[0], (1, 0): labels[-1], (0, -1): labels[:, 0], (0, 1): labels[:, -1]}
+    if connectivity == 8:
+        corners = {(-1, -1): labels[0, :1], (-1, 1): labels[0, -1:]}
+        corners.update({(1, -1): labels[-1, :1], (1, 1): labels[-1, -1:]})
+        edges.update(corners)
+    for offset, edge in edges.items():
+        for label in np.unique(edge[edge > 0]):
+            sides[label].add(offset)
+    border = _border_cells(labels, transform, connectivity)
+
+    parts: Dict[int, List[Polygon]] = {}
+    for geometry, label in shapes(
+        labels.astype(np.int32), mask=mask, connectivity=connectivity, transform=transform
+    ):
+        parts.setdefault(int(label), []).append(shape(geometry))
+
+    return [
+        Component(
+            geometry=polygons[0] if len(polygons) == 1 else ops.unary_union(polygons),
+            pixel_count=int(pixel_counts[label]),
+            probability_sum=float(probability_sums[label]),
+            sides=sides[label],
+            border=border.get(label, set()),
+        )
+        for label, polygons in parts.items()
+    ]
+
+
+class GeoJSONWriter:
+    """Writes polygons to a GeoJSON FeatureCollection one feature at a time."""
+
+    def __init__(self, path: str):
+        self.file = open(path, "w")
+        self.file.write('{"type": "FeatureCollection", "features": [\n')
+        self.first = True
+
+    def write(self, geometry: Polygon, properties: Dict[str, Any]) -> None:
+        feature = {"type": "Feature", "properties": properties, "geometry": mapping(geometry)}
+        self.file.write(("" if self.first else ",\n") + json.dumps(feature))
+        self.first = False
+
+    def close(self) -> None:
+        self.file.write("\n]}\n")
+        self.file.close()
+
+
+class GeoParquetWriter:
+    """Writes polygons to GeoParquet in row groups of `row_group_size` features."""
+
+    def __init__(self, path: str, crs: Any = "EPSG:4326", row_group_size: int = 10_000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing GeoParquet needs `pyarrow` installed")
+
+        self.pa = pa
+        self.row_group_size = row_group_size
+        self.rows: List[Dict[str, Any]] = []
+        self.geometry_types: Set[str] = set()
+        self.schema = pa.schema(
+            [
+                ("id", pa.int64()),
+                ("area_m2", pa.float64()),
+                ("mean_probability", pa.float32()),
+                ("geometry", pa.binary()),
+            ]
+        )
+        self.crs = CRS.from_user_input(crs).to_json_dict()
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write(self, geometry: Polygon, properties: Dict[str, Any]) -> None:
+        self.geometry_types.add(geometry.geom_type)
+        self.rows.append({**properties, "geometry": geometry.wkb})
+        if len(self.rows) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.rows:
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self) -> None:
+        self._flush()
+        geo = {
+            "version": "1.0.0",
+            "primary_column": "geometry",
+            "columns": {
+                "geometry": {
+                    "encoding": "WKB",
+                    "geometry_types": sorted(self.geometry_types),
+                    "crs": self.crs,
+                }
+            },
+        }
+        # the geometry types are only known at the end, so the metadata is written with the footer
+        self.writer.add_key_value_metadata({"geo": json.dumps(geo)})
+        self.writer.close()
+
+
+def open_writer(path: str, crs: Any = "EPSG:4326"):
+    """Opens a GeoParquet (`.parquet`) or GeoJSON writer for `path`.
+
+    GeoJSON has no CRS, `crs` should be EPSG:4326 for it.
+    """
+    if path.endswith(".parquet"):
+        return GeoParquetWriter(path, crs)
+    return GeoJSONWriter(path)
+
+
+class StreamingPolygonizer:
+    """Turns prediction tiles into PV polygons, merging them across tile borders."""
+
+    def __init__(
+        self,
+        writer,
+        threshold: float = 0.5,
+        min_area_m2: float = 200.0,
+        simplify_tolerance: float = 5.0,
+        connectivity: int = 8,
+        output_crs: Any = "EPSG:4326",
+    ):
+        """Sets up the thresholds and the frontier of polygons waiting for tiles.
+
+        Args:
+            writer: Writer with `write(geometry, properties)` and `close()`
+            threshold: Probability above which pixels count as PV
+            min_area_m2: Polygons smaller than this are dropped, after merging across tiles
+            simplify_tolerance: Tolerance of the polygon simplification, in units of the tile CRS
+            connectivity: 4 or 8 connectivity of PV pixels
+            output_crs: CRS of the written polygons
+        """
+        self.writer = writer
+        self.threshold = threshold
+        self.min_area_m2 = min_area_m2
+        self.simplify_tolerance = simplify_tolerance
+        self.connectivity = connectivity
+        self.output_crs = CRS.from_user_input(output_crs)
+        self.num_written = 0
+        self._transformers: Dict[str, Transformer] = {}
+        # done tiles with their number of done neighbours
+        self._done: Dict[TileKey, int] = {}
+        # polygons touching the border of a tile that isn't done, by id, indexed by their border
+        # cells and by the tiles they wait for
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._by_cell: Dict[Tuple[str, BorderCell], int] = {}
+        self._by_tile: Dict[TileKey, Set[int]] = {}
+        self._next_id = 0
+
+    @property
+    def num_pending(self) -> int:
+        return len(self._pending)
+
+    @property
+    def num_tracked_tiles(self) -> int:
+        return len(self._done)
+
+    def add_tile(self, probs: np.ndarray, tile: GridTile) -> None:
+        """Polygonizes an (H, W) or (1, H, W) probability tile."""
+        crs = CRS.from_user_input(tile.crs).to_string()
+        key = (crs, tile.row, tile.col)
+        self._mark_done(key)
+        touched = self._by_tile.pop(key, set())
+        for pending in touched:
+            self._pending[pending]["waiting"].discard(key)
+
+        for component in polygonize_tile(
+            np.squeeze(probs, axis=0) if probs.ndim == 3 else probs,
+            tile.transform,
+            self.threshold,
+            self.connectivity,
+        ):
+            waiting = {(crs, tile.row + dr, tile.col + dc) for dr, dc in component.sides}
+            polygon = {
+                "geometry": component.geometry,
+                "crs": crs,
+                "pixel_count": component.pixel_count,
+                "probability_sum": component.probability_sum,
+                "waiting": waiting - self._done.keys(),
+                "border": {(crs, cell) for cell in component.border},
+            }
+            # tile transforms may differ by floating point error along shared borders
+            touched.add(self._add(polygon, tolerance=1e-3 * abs(tile.transform.a)))
+
+        # only polygons of this tile, or waiting for it, can be complete now
+        for pending in touched:
+            if pending in self._pending and not self._pending[pending]["waiting"]:
+                self._finalize(self._remove(pending))
+        self._prune(key)
+
+    def _neighbours(self, key: TileKey) -> List[TileKey]:
+        crs, row, col = key
+        return [(crs, row + dr, col + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dr or dc]
+
+    def _mark_done(self, key: TileKey) -> None:
+        done_neighbours = [
+            neighbour for neighbour in self._neighbours(key) if neighbour in self._done
+        ]
+        for neighbour in done_neighbours:
+            self._done[neighbour] += 1
+        self._done[key] = len(done_neighbours)
+
+    def _prune(self, key: TileKey) -> None:
+        # a tile whose neighbours are all done can't be touched by new polygons any more
+        for candidate in [key] + self._neighbours(key):
+            if self._done.get(candidate) == 8:
+                del self._done[candidate]
+
+    def _add(self, polygon: Dict[str, Any], tolerance: float) -> int:
+        """Merges a polygon with the pending ones it connects to and returns its id."""
+        # border cells are shared by the pixels on both sides of a border only
+        touching = {self._by_cell[cell] for cell in polygon["border"] if cell in self._by_cell}
+        if touching:
+            geometries = [polygon["geometry"]]
+            for pending in map(self._remove, touching):
+                polygon["pixel_count"] += pending["pixel_count"]
+                polygon["probability_sum"] += pending["probability_sum"]
+                polygon["waiting"] |= pending["waiting"]
+                polygon["border"] |= pending["border"]
+                geometries.append(ops.snap(pending["geometry"], polygon["geometry"], tolerance))
+            polygon["geometry"] = ops.unary_union(geometries)
+
+        polygon_id = self._next_id
+        self._next_id += 1
+        self._pending[polygon_id] = polygon
+        for cell in polygon["border"]:
+            self._by_cell[cell] = polygon_id
+        for tile in polygon["waiting"]:
+            self._by_tile.setdefault(tile, set()).add(polygon_id)
+        return polygon_id
+
+    def _remove(self, polygon_id: int) -> Dict[str, Any]:
+        polygon = self._pending.pop(polygon_id)
+        for cell in polygon["border"]:
+            if self._by_cell.get(cell) == polygon_id:
+                del self._by_cell[cell]
+        for tile in polygon["waiting"]:
+            waiting = self._by_tile.get(tile)
+            if waiting is not None:
+                waiting.discard(polygon_id)
+                if not waiting:
+                    del self._by_tile[tile]
+        return polygon
+
+    def _transformer(self, crs: str) -> Transformer:
+        if crs not in self._transformers:
+            self._transformers[crs] = Transformer.from_crs(crs, self.output_crs, always_xy=True)
+        return self._transformers[crs]
+
+    def _finalize(self, polygon: Dict[str, Any]) -> None:
+        geometry = polygon["geometry"]
+        area = geometry.area
+        if area < self.min_area_m2:
+            return
+        geometry = geometry.simplify(self.simplify_tolerance, preserve_topology=True)
+        geometry = ops.transform(self._transformer(polygon["crs"]).transform, geometry)
+        if isinstance(geometry, MultiPolygon) and len(geometry.geoms) == 1:
+            geometry = geometry.geoms[0]
+        self.writer.write(
+            geometry,
+            {
+                "id": self.num_written,
+                "area_m2": float(area),
+                "mean_probability": polygon["probability_sum"] / polygon["pixel_count"],
+            },
+        )
+        self.num_written += 1
+
+    def close(self) -> None:
+        """Writes the polygons still waiting for tiles that never came and closes the writer."""
+        for pending in self._pending.values():
+            self._finalize(pending)
+        self._pending, self._by_cell, self._by_tile = {}, {}, {}
+        self.writer.close()
+
+
+def polygonize_predictions(
+    predictions: Iterable[Tuple[GridTile, np.ndarray]],
+    path: str,
+    output_crs: Any = "EPSG:4326",
+    **kwargs,
+) -> int:
+    """Polygonizes a stream of `(tile, probabilities)`, e.g. from `CPUInferenceEngine.run`.
+
+    Args:
+        predictions: Tiles with their predictions
+        path: Output file, GeoParquet if it ends with `.parquet`, otherwise GeoJSON
+        output_crs: CRS of the written polygons
+        **kwargs: Arguments of `StreamingPolygonizer`
+
+    Returns:
+        Number of polygons written
+    """
+    polygonizer = StreamingPolygonizer(
+        open_writer(path, output_crs), output_crs=output_crs, **kwargs
+    )
+    try:
+        for tile, probs in predictions:
+            polygonizer.add_tile(probs, tile)
+    finally:
+        polygonizer.close()
+    return polygonizer.num_written
@@ -0,0 +1,84 @@
+"""Throughput benchmark of segmentation networks in chips per second.
+
+Runs on whatever device is given, so CPU numbers can be compared with GPU runs and between
+memory formats and precisions:
+
+    python -m solar_mapper.models.benchmark
+"""
+import contextlib
+import time
+from typing import Optional
+
+import torch
+from torch import nn
+
+
+def measure_throughput(
+    net: nn.Module,
+    in_channels: int,
+    chip_size: int = 256,
+    batch_size: int = 8,
+    steps: int = 10,
+    warmup: int = 2,
+    device: str = "cpu",
+    channels_last: bool = True,
+    dtype: Optional[torch.dtype] = None,
+    train: bool = False,
+) -> float:
+    """Measures how many chips per second `net` processes.
+
+    Args:
+        net: Segmentation network
+        in_channels: Number of input bands
+        chip_size: Size of the chips in pixels
+        batch_size: Number of chips per batch
+        steps: Number of timed batches
+        warmup: Number of untimed batches run first, covers lazy initialization and compilation
+        device: Device to run on
+        channels_last: Use the channels-last memory format
+        dtype: Autocast dtype (e.g. `torch.bfloat16`), full precision if None
+        train: Time forward and backward passes instead of inference
+
+    Returns:
+        Chips per second
+    """
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    net = net.to(device=device, memory_format=memory_format).train(train)
+    x = torch.randn(batch_size, in_channels, chip_size, chip_size, device=device)
+    x = x.contiguous(memory_format=memory_format)
+    autocast = (
+        torch.autocast(device_type=torch.device(device).type, dtype=dtype)
+        if dtype is not None
+        else contextlib.nullcontext()
+    )
+
+    def step():
+        with autocast, torch.set_grad_enabled(train):
+            out = net(x)
+        if train:
+            out.float().mean().backward()
+
+    for _ in range(warmup):
+        step()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    return steps * batch_size / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    import hydra
+    import omegaconf
+    import pyrootutils
+
+    root = pyrootutils.setup_root(__file__, pythonpath=True)
+    cfg = omegaconf.OmegaConf.load(root / "configs" / "model" / "segmentation.yaml")
+    net = hydra.utils.instantiate(cfg.net)
+    in_channels = cfg.net.encoder.in_channels
+    for train in (False, True):
+        chips_per_sec = measure_throughput(net, in_channels, train=train)
+        print(f"{'train' if train else 'inference'} on cpu: {chips_per_sec:.1f} chips/sec")
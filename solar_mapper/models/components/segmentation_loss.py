@@ -0,0 +1,72 @@
+from typing import Tuple
+
+import torch
+import torch.nn.functional as F
+from torchmetrics import Metric
+
+
+def bce_dice_loss(
+    logits: torch.Tensor, target: torch.Tensor, dice_weight: float = 1.0, smooth: float = 1.0
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Binary cross-entropy plus soft dice loss, and the confusion counts of the thresholded logits.
+
+    Loss and counts come out of one pass over the logits and stay on their device, so nothing
+    is synchronized with the host per step. The loss is computed in float32 even under autocast.
+
+    Args:
+        logits: Predicted logits, N x 1 x H x W
+        target: Binary mask of the same shape
+        dice_weight: Weight of the dice term
+        smooth: Additive smoothing of the dice ratio, keeps empty masks finite
+
+    Returns:
+        The loss and a tensor with the true positive, false positive and false negative counts
+    """
+    logits = logits.float()
+    target = target.float()
+    bce = F.binary_cross_entropy_with_logits(logits, target)
+    probs = torch.sigmoid(logits)
+    intersection = (probs * target).sum()
+    dice = 1 - (2 * intersection + smooth) / (probs.sum() + target.sum() + smooth)
+
+    with torch.no_grad():
+        # logit > 0 is probability > 0.5, without a second sigmoid
+        pred = (logits > 0).float()
+        tp = (pred * target).sum()
+        counts = torch.stack([tp, pred.sum() - tp, target.sum() - tp])
+    return bce + dice_weight * dice, counts
+
+
+@torch.no_grad()
+def chip_errors(logits: torch.Tensor, target: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Binary cross-entropy and false positive fraction of each chip, see `HardExampleMining`.
+
+    Args:
+        logits: Predicted logits, N x 1 x H x W
+        target: Binary mask of the same shape
+
+    Returns:
+        Two tensors of N values on the device of `logits`
+    """
+    logits = logits.float().flatten(1)
+    target = target.float().flatten(1)
+    bce = F.binary_cross_entropy_with_logits(logits, target, reduction="none").mean(1)
+    false_positives = ((logits > 0) & (target == 0)).float().mean(1)
+    return bce, false_positives
+
+
+class IoUFromCounts(Metric):
+    """Pixel IoU of the positive class, accumulated from `bce_dice_loss` confusion counts."""
+
+    full_state_update = False
+
+    def __init__(self):
+        super().__init__()
+        self.add_state("counts", default=torch.zeros(3, dtype=torch.long), dist_reduce_fx="sum")
+
+    def update(self, counts: torch.Tensor) -> None:
+        self.counts += counts.long()
+
+    def compute(self) -> torch.Tensor:
+        tp, fp, fn = self.counts
+        return tp.float() / (tp + fp + fn).clamp(min=1).float()
@@ -0,0 +1,218 @@
+"""Super-resolution of Sentinel-2 imagery before segmentation.
+
+`SuperResolutionStage` wraps any network mapping (N, C, h, w) to (N, C, h * scale, w * scale),
+such as a WorldStrat model, and takes care of:
+
+- tiling large inputs with overlap, and blending the overlapping outputs
+- batching the tiles of one or more inputs through the network
+- caching outputs by a hash of the input and the network weights, in memory and optionally on
+  disk, so repeated epochs and inference passes over the same imagery never recompute them
+
+`ReferenceSRNet` is a small CPU-runnable network with the same interface, for tests and as a
+starting point for training.
+"""
+
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+from typing import List, Optional
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+class ReferenceSRNet(nn.Module):
+    """Bicubic upsampling plus a residual predicted at low resolution and pixel shuffled."""
+
+    def __init__(self, in_channels: int, scale: int = 2, hidden_channels: int = 32):
+        super().__init__()
+        self.scale = scale
+        self.body = nn.Sequential(
+            nn.Conv2d(in_channels, hidden_channels, 3, padding=1),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(hidden_channels, in_channels * scale**2, 3, padding=1),
+            nn.PixelShuffle(scale),
+        )
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        upsampled = F.interpolate(x, scale_factor=self.scale, mode="bicubic", align_corners=False)
+        return upsampled + self.body(x)
+
+
+def tile_starts(size: int, tile_size: int, overlap: int) -> List[int]:
+    """Start offsets of tiles covering `size` pixels, the last tile ends at the edge."""
+    if size <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    starts = list(range(0, size - tile_size, stride))
+    return starts + [size - tile_size]
+
+
+def blend_weights(tile_size: int, overlap: int) -> np.ndarray:
+    """Weights ramping up over `overlap` pixels from each tile edge, for blending tiles."""
+    ramp = np.minimum(np.arange(tile_size) + 1, np.arange(tile_size)[::-1] + 1)
+    ramp = np.minimum(ramp, max(overlap, 1)).astype(np.float32)
+    return np.outer(ramp, ramp)
+
+
+class SuperResolutionStage:
+    """Batched, tiled and cached super-resolution of image chips.
+
+    Inputs and outputs are numpy arrays of shape (N, C, H, W) in the dtype the chips are stored
+    in, outputs are `scale` times larger along H and W.
+    """
+
+    def __init__(
+        self,
+        net: nn.Module,
+        scale: int = 2,
+        tile_size: int = 128,
+        overlap: int = 16,
+        batch_size: int = 8,
+        input_scale: float = 1e-4,
+        checkpoint_path: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        memory_cache_size: int = 64,
+        device: str = "cpu",
+    ):
+        """Wraps `net`, loading its weights from `checkpoint_path` if given.
+
+        Args:
+            net: Network mapping (N, C, h, w) to (N, C, h * scale, w * scale)
+            scale: Upsampling factor of the network
+            tile_size: Size of the input tiles in pixels
+            overlap: Overlap between neighbouring input tiles in pixels
+            batch_size: Number of tiles run through the network at once
+            input_scale: Factor converting stored values to network inputs, e.g. S2 digital
+                numbers to reflectances
+            checkpoint_path: State dict loaded into `net`
+            cache_dir: Directory to cache outputs in across processes and runs, memory only if None
+            memory_cache_size: Number of outputs kept in memory
+            device: Device to run the network on
+        """
+        if not 0 <= overlap < tile_size:
+            raise ValueError(f"Overlap {overlap} must be smaller than the tile size {tile_size}")
+        self.net = net
+        if checkpoint_path is not None:
+            self.net.load_state_dict(torch.load(checkpoint_path, map_location="cpu"))
+        self.net = self.net.to(device).eval()
+        self.scale = scale
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.batch_size = batch_size
+        self.input_scale = input_scale
+        self.cache_dir = cache_dir
+        self.memory_cache_size = memory_cache_size
+        self.device = device
+        self._memory_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._weights = blend_weights(tile_size * scale, overlap * scale)
+        self.model_hash = self._model_hash()
+
+    def _model_hash(self) -> str:
+        # outputs depend on the weights and the tiling, not just the input
+        digest = hashlib.sha1()
+        for name, tensor in sorted(self.net.state_dict().items()):
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().numpy().tobytes())
+        digest.update(f"{self.scale}/{self.tile_size}/{self.overlap}/{self.input_scale}".encode())
+        return digest.hexdigest()
+
+    def cache_key(self, chip: np.ndarray) -> str:
+        """Hash of a single (C, H, W) input and the network."""
+        digest = hashlib.sha1(self.model_hash.encode())
+        digest.update(f"{chip.shape}/{chip.dtype}".encode())
+        digest.update(np.ascontiguousarray(chip).tobytes())
+        return digest.hexdigest()
+
+    def _cache_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def _cache_get(self, key: str) -> Optional[np.ndarray]:
+        if key in self._memory_cache:
+            self._memory_cache.move_to_end(key)
+            return self._memory_cache[key]
+        if self.cache_dir is not None and os.path.exists(self._cache_path(key)):
+            output = np.load(self._cache_path(key))
+            self._memory_put(key, output)
+            return output
+        return None
+
+    def _memory_put(self, key: str, output: np.ndarray) -> None:
+        self._memory_cache[key] = output
+        while len(self._memory_cache) > self.memory_cache_size:
+            self._memory_cache.popitem(last=False)
+
+    def _cache_put(self, key: str, output: np.ndarray) -> None:
+        self._memory_put(key, output)
+        if self.cache_dir is not None:
+            path = self._cache_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written to a temporary file and renamed, so other workers never read partial files
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(path), suffix=".npy", delete=False
+            ) as file:
+                np.save(file, output)
+            os.replace(file.name, path)
+
+    @torch.no_grad()
+    def _run(self, tiles: np.ndarray) -> np.ndarray:
+        outputs = []
+        for start in range(0, len(tiles), self.batch_size):
+            batch = torch.from_numpy(tiles[start : start + self.batch_size]).to(self.device)
+            outputs.append(self.net(batch.float() * self.input_scale).float().cpu().numpy())
+        return np.concatenate(outputs) / self.input_scale
+
+    def _super_resolve(self, chips: List[np.ndarray]) -> List[np.ndarray]:
+        # tiles of all chips go through the network together, then are blended back per chip
+        tiles, placements = [], []
+        for index, chip in enumerate(chips):
+            _, height, width = chip.shape
+            padded = np.pad(
+                chip,
+                [(0, 0), (0, max(self.tile_size - height, 0)), (0, max(self.tile_size - width, 0))],
+                mode="reflect" if min(height, width) > 1 else "edge",
+            )
+            for y in tile_starts(padded.shape[1], self.tile_size, self.overlap):
+                for x in tile_starts(padded.shape[2], self.tile_size, self.overlap):
+                    tiles.append(padded[:, y : y + self.tile_size, x : x + self.tile_size])
+                    placements.append((index, y * self.scale, x * self.scale))
+        outputs = self._run(np.stack(tiles))
+
+        size = self.tile_size * self.scale
+        results = []
+        for index, chip in enumerate(chips):
+            channels, height, width = chip.shape
+            padded_shape = (
+                max(height, self.tile_size) * self.scale,
+                max(width, self.tile_size) * self.scale,
+            )
+            total = np.zeros((channels, *padded_shape), dtype=np.float32)
+            weight = np.zeros(padded_shape, dtype=np.float32)
+            for output, (tile_index, y, x) in zip(outputs, placements):
+                if tile_index == index:
+                    total[:, y : y + size, x : x + size] += output * self._weights
+                    weight[y : y + size, x : x + size] += self._weights
+            result = (total / weight)[:, : height * self.scale, : width * self.scale]
+            results.append(self._to_dtype(result, chip.dtype))
+        return results
+
+    @staticmethod
+    def _to_dtype(data: np.ndarray, dtype: np.dtype) -> np.ndarray:
+        if np.issubdtype(dtype, np.integer):
+            info = np.iinfo(dtype)
+            data = np.clip(np.rint(data), info.min, info.max)
+        return data.astype(dtype)
+
+    def __call__(self, chips: np.ndarray) -> np.ndarray:
+        """Super-resolves a batch of (N, C, H, W) chips, reusing cached outputs."""
+        keys = [self.cache_key(chip) for chip in chips]
+        results = [self._cache_get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            for i, output in zip(missing, self._super_resolve([chips[i] for i in missing])):
+                self._cache_put(keys[i], output)
+                results[i] = output
+        return np.stack(results)
@@ -0,0 +1,121 @@
+from typing import List, Optional, Sequence
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+class ConvBlock(nn.Sequential):
+    """Two 3x3 convolutions, each followed by batch norm and ReLU."""
+
+    def __init__(self, in_channels: int, out_channels: int):
+        super().__init__(
+            nn.Conv2d(in_channels, out_channels, 3, padding=1, bias=False),
+            nn.BatchNorm2d(out_channels),
+            nn.ReLU(inplace=True),
+            nn.Conv2d(out_channels, out_channels, 3, padding=1, bias=False),
+            nn.BatchNorm2d(out_channels),
+            nn.ReLU(inplace=True),
+        )
+
+
+class ConvEncoder(nn.Module):
+    """Plain U-Net encoder, halving the resolution between stages.
+
+    Returns one feature map per stage, the first at the input resolution.
+    """
+
+    def __init__(self, in_channels: int, widths: Sequence[int] = (32, 64, 128, 256)):
+        super().__init__()
+        self.out_channels = list(widths)
+        self.stages = nn.ModuleList()
+        for i, width in enumerate(widths):
+            block = ConvBlock(in_channels if i == 0 else widths[i - 1], width)
+            self.stages.append(block if i == 0 else nn.Sequential(nn.MaxPool2d(2), block))
+
+    def forward(self, x: torch.Tensor) -> List[torch.Tensor]:
+        features = []
+        for stage in self.stages:
+            x = stage(x)
+            features.append(x)
+        return features
+
+
+class ResNetEncoder(nn.Module):
+    """torchvision ResNet as U-Net encoder, with the stem adapted to `in_channels`.
+
+    Returns the feature maps at strides 2, 4, 8, 16 and 32.
+    """
+
+    def __init__(self, in_channels: int, name: str = "resnet18"):
+        super().__init__()
+        import torchvision
+
+        resnet = getattr(torchvision.models, name)(weights=None)
+        resnet.conv1 = nn.Conv2d(in_channels, 64, 7, stride=2, padding=3, bias=False)
+        self.stem = nn.Sequential(resnet.conv1, resnet.bn1, resnet.relu)
+        self.pool = resnet.maxpool
+        self.layers = nn.ModuleList([resnet.layer1, resnet.layer2, resnet.layer3, resnet.layer4])
+        expansion = resnet.layer1[0].expansion
+        self.out_channels = [64] + [width * expansion for width in (64, 128, 256, 512)]
+
+    def forward(self, x: torch.Tensor) -> List[torch.Tensor]:
+        x = self.stem(x)
+        features = [x]
+        x = self.pool(x)
+        for layer in self.layers:
+            x = layer(x)
+            features.append(x)
+        return features
+
+
+class UNet(nn.Module):
+    """U-Net decoder on top of a pluggable encoder.
+
+    The encoder returns a list of feature maps from fine to coarse and has an `out_channels`
+    attribute with their channel counts. Each decoder stage upsamples to the size of the next
+    finer feature map, so encoders with any strides work, and the logits are upsampled to the
+    input size if the finest feature map is smaller.
+    """
+
+    def __init__(
+        self,
+        encoder: nn.Module,
+        num_classes: int = 1,
+        decoder_channels: Optional[Sequence[int]] = None,
+    ):
+        """Builds the decoder stages for the feature maps of `encoder`.
+
+        Args:
+            encoder: Encoder returning a list of feature maps, fine to coarse
+            num_classes: Number of output channels
+            decoder_channels: Channels of the decoder stages, coarse to fine, defaults to the
+                channels of the matching encoder feature maps
+        """
+        super().__init__()
+        self.encoder = encoder
+        skip_channels = list(encoder.out_channels[:-1])[::-1]
+        decoder_channels = list(decoder_channels or skip_channels)
+        if len(decoder_channels) != len(skip_channels):
+            raise ValueError(
+                f"Expected {len(skip_channels)} decoder channels, got {len(decoder_channels)}"
+            )
+
+        self.decoder = nn.ModuleList()
+        channels = encoder.out_channels[-1]
+        for skip, out_channels in zip(skip_channels, decoder_channels):
+            self.decoder.append(ConvBlock(channels + skip, out_channels))
+            channels = out_channels
+        self.head = nn.Conv2d(channels, num_classes, 1)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        size = x.shape[-2:]
+        features = self.encoder(x)
+        x = features[-1]
+        for block, skip in zip(self.decoder, features[-2::-1]):
+            x = F.interpolate(x, size=skip.shape[-2:], mode="bilinear", align_corners=False)
+            x = block(torch.cat([x, skip], dim=1))
+        x = self.head(x)
+        if x.shape[-2:] != size:
+            x = F.interpolate(x, size=size, mode="bilinear", align_corners=False)
+        return x
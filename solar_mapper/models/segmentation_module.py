@@ -0,0 +1,161 @@
+from typing import Any, Dict, Optional
+
+import torch
+from pytorch_lightning import LightningModule
+from torchmetrics import MaxMetric, MeanMetric
+
+from solar_mapper.models.components.segmentation_loss import IoUFromCounts, bce_dice_loss
+
+
+class SegmentationLitModule(LightningModule):
+    """LightningModule for PV segmentation of Sentinel-2 (+Sentinel-1) chips.
+
+    Batches are the dicts of `Sentinel2PolygonDataset`: `s2` (int16), optional `s1` (float16 dB)
+    and `mask` (uint8). They are converted to float on the device and stacked into one input.
+
+    Fast paths:
+        - `channels_last`: NHWC weights and inputs, which convolutions run faster in on GPUs with
+          tensor cores and with oneDNN on CPU
+        - mixed precision: set `trainer.precision` (e.g. `bf16-mixed`), the loss is computed in
+          float32 regardless
+        - `compile`: wraps the network with `torch.compile` when fitting
+        - loss and IoU counts are computed together on the device, without per-step host syncs
+    """
+
+    def __init__(
+        self,
+        net: torch.nn.Module,
+        optimizer: torch.optim.Optimizer,
+        scheduler: Optional[torch.optim.lr_scheduler._LRScheduler] = None,
+        dice_weight: float = 1.0,
+        s2_scale: float = 1e-4,
+        s1_scale: float = 0.1,
+        channels_last: bool = True,
+        compile: bool = False,
+    ):
+        """Stores the network and the hyperparameters of the optimization.
+
+        Args:
+            net: Segmentation network with one output channel
+            optimizer: Partially instantiated optimizer
+            scheduler: Partially instantiated learning rate scheduler
+            dice_weight: Weight of the dice term in the loss
+            s2_scale: Factor converting Sentinel-2 digital numbers to reflectances
+            s1_scale: Factor applied to the Sentinel-1 backscatter in dB
+            channels_last: Use the channels-last memory format
+            compile: Compile the network with `torch.compile` for training
+        """
+        super().__init__()
+
+        # this line allows to access init params with 'self.hparams' attribute
+        # also ensures init params will be stored in ckpt
+        self.save_hyperparameters(logger=False, ignore=["net"])
+
+        self.net = net
+        if channels_last:
+            self.net = self.net.to(memory_format=torch.channels_last)
+
+        # metric objects for calculating and averaging IoU across batches
+        self.train_iou = IoUFromCounts()
+        self.val_iou = IoUFromCounts()
+        self.test_iou = IoUFromCounts()
+
+        # for averaging loss across batches
+        self.train_loss = MeanMetric()
+        self.val_loss = MeanMetric()
+        self.test_loss = MeanMetric()
+
+        # for tracking best so far validation IoU
+        self.val_iou_best = MaxMetric()
+
+    def inputs(self, batch: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """Stacks the bands of a batch into the float network input."""
+        x = batch["s2"].float() * self.hparams.s2_scale
+        if "s1" in batch:
+            s1 = torch.nan_to_num(batch["s1"].float(), nan=0.0) * self.hparams.s1_scale
+            x = torch.cat([x, s1], dim=1)
+        if self.hparams.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.net(x)
+
+    def on_train_start(self):
+        # by default lightning executes validation step sanity checks before training starts,
+        # so we need to make sure val_iou_best doesn't store IoU from these checks
+        self.val_iou_best.reset()
+
+    def model_step(self, batch: Dict[str, torch.Tensor]):
+        logits = self.forward(self.inputs(batch))
+        loss, counts = bce_dice_loss(logits, batch["mask"], dice_weight=self.hparams.dice_weight)
+        return loss, counts, logits
+
+    def training_step(self, batch: Dict[str, torch.Tensor], batch_idx: int):
+        loss, counts, logits = self.model_step(batch)
+
+        # update and log metrics
+        self.train_loss(loss)
+        self.train_iou(counts)
+        self.log("train/loss", self.train_loss, on_step=False, on_epoch=True, prog_bar=True)
+        self.log("train/iou", self.train_iou, on_step=False, on_epoch=True, prog_bar=True)
+
+        # per-chip errors are computed from these by callbacks, e.g. `HardExampleMining`
+        return {"loss": loss, "logits": logits.detach()}
+
+    def validation_step(self, batch: Dict[str, torch.Tensor], batch_idx: int):
+        loss, counts, _ = self.model_step(batch)
+
+        # update and log metrics
+        self.val_loss(loss)
+        self.val_iou(counts)
+        self.log("val/loss", self.val_loss, on_step=False, on_epoch=True, prog_bar=True)
+        self.log("val/iou", self.val_iou, on_step=False, on_epoch=True, prog_bar=True)
+
+        return {"loss": loss}
+
+    def on_validation_epoch_end(self):
+        iou = self.val_iou.compute()  # get current val IoU
+        self.val_iou_best(iou)  # update best so far val IoU
+        # log `val_iou_best` as a value through `.compute()` method, instead of as a metric object
+        # otherwise metric would be reset by lightning after each epoch
+        self.log("val/iou_best", self.val_iou_best.compute(), prog_bar=True)
+
+    def test_step(self, batch: Dict[str, torch.Tensor], batch_idx: int):
+        loss, counts, _ = self.model_step(batch)
+
+        # update and log metrics
+        self.test_loss(loss)
+        self.test_iou(counts)
+        self.log("test/loss", self.test_loss, on_step=False, on_epoch=True)
+        self.log("test/iou", self.test_iou, on_step=False, on_epoch=True)
+
+        return {"loss": loss}
+
+    def predict_step(self, batch: Dict[str, torch.Tensor], batch_idx: int, dataloader_idx: int = 0):
+        """Returns the PV probability of each pixel."""
+        return torch.sigmoid(self.forward(self.inputs(batch)).float())
+
+    def setup(self, stage: Optional[str] = None):
+        if self.hparams.compile and stage == "fit":
+            self.net = torch.compile(self.net)
+
+    def configure_optimizers(self) -> Dict[str, Any]:
+        """Choose what optimizers and learning-rate schedulers to use in your optimization.
+
+        Examples:
+            https://pytorch-lightning.readthedocs.io/en/latest/common/lightning_module.html#configure-optimizers
+        """
+        optimizer = self.hparams.optimizer(params=self.parameters())
+        if self.hparams.scheduler is not None:
+            scheduler = self.hparams.scheduler(optimizer=optimizer)
+            return {
+                "optimizer": optimizer,
+                "lr_scheduler": {
+                    "scheduler": scheduler,
+                    "monitor": "val/loss",
+                    "interval": "epoch",
+                    "frequency": 1,
+                },
+            }
+        return {"optimizer": optimizer}
@@ -0,0 +1,129 @@
+"""Launchers running a function over preprocessing tasks, e.g. polygon shards, in parallel.
+
+All launchers share `map(function, tasks)`, which returns the results in the order of the
+tasks, so a stage runs the same way whether its shards go to local processes, joblib or Ray.
+Functions and tasks have to be picklable, i.e. module-level functions or `functools.partial`s
+of them.
+"""
+
+import multiprocessing
+import os
+from typing import Any, Callable, List, Optional, Sequence
+
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+
+class Launcher:
+    """Runs tasks one after the other in this process, useful for debugging."""
+
+    @property
+    def num_workers(self) -> int:
+        return 1
+
+    def map(self, function: Callable[[Any], Any], tasks: Sequence[Any]) -> List[Any]:
+        results = []
+        for i, task in enumerate(tasks):
+            results.append(function(task))
+            log.debug(f"Finished task {i + 1}/{len(tasks)}")
+        return results
+
+
+class MultiprocessingLauncher(Launcher):
+    """Runs tasks on a pool of local processes of the standard library."""
+
+    def __init__(
+        self,
+        processes: Optional[int] = None,
+        start_method: str = "spawn",
+        maxtasksperchild: Optional[int] = None,
+    ):
+        """Sets the size of the pool and how its processes are started.
+
+        Args:
+            processes: Number of processes, all cores if None
+            start_method: "spawn" or "forkserver" keep GDAL and dask threads out of the workers,
+                "fork" starts faster
+            maxtasksperchild: Restart workers after this many tasks, frees leaked memory
+        """
+        self.processes = processes
+        self.start_method = start_method
+        self.maxtasksperchild = maxtasksperchild
+
+    @property
+    def num_workers(self) -> int:
+        return self.processes or os.cpu_count() or 1
+
+    def map(self, function: Callable[[Any], Any], tasks: Sequence[Any]) -> List[Any]:
+        context = multiprocessing.get_context(self.start_method)
+        processes = min(self.num_workers, max(len(tasks), 1))
+        with context.Pool(processes, maxtasksperchild=self.maxtasksperchild) as pool:
+            # one task at a time, shards take long enough to hide the round trips
+            return pool.map(function, tasks, chunksize=1)
+
+
+class JoblibLauncher(Launcher):
+    """Runs tasks with joblib, on its loky process pool by default."""
+
+    def __init__(self, n_jobs: int = -1, backend: str = "loky", verbose: int = 0):
+        """Sets the number of workers and the joblib backend running them.
+
+        Args:
+            n_jobs: Number of workers, -1 for all cores
+            backend: joblib backend, e.g. "loky" or "multiprocessing"
+            verbose: joblib progress messages
+        """
+        self.n_jobs = n_jobs
+        self.backend = backend
+        self.verbose = verbose
+
+    @property
+    def num_workers(self) -> int:
+        return self.n_jobs if self.n_jobs > 0 else (os.cpu_count() or 1)
+
+    def map(self, function: Callable[[Any], Any], tasks: Sequence[Any]) -> List[Any]:
+        try:
+            from joblib import Parallel, delayed
+        except ImportError:
+            raise ImportError("The joblib launcher needs `joblib` installed")
+        parallel = Parallel(n_jobs=self.n_jobs, backend=self.backend, verbose=self.verbose)
+        return parallel(delayed(function)(task) for task in tasks)
+
+
+def _call(function: Callable[[Any], Any], task: Any) -> Any:
+    return function(task)
+
+
+class RayLauncher(Launcher):
+    """Runs tasks on a local Ray instance, or a Ray cluster at `address`."""
+
+    def __init__(
+        self, address: Optional[str] = None, num_cpus: Optional[int] = None, cpus_per_task: int = 1
+    ):
+        """Sets the Ray instance to connect to and the CPUs of each task.
+
+        Args:
+            address: Address of a running Ray cluster, starts a local one if None
+            num_cpus: Number of CPUs of the local instance, all cores if None
+            cpus_per_task: CPUs reserved for each task
+        """
+        self.address = address
+        self.num_cpus = num_cpus
+        self.cpus_per_task = cpus_per_task
+
+    @property
+    def num_workers(self) -> int:
+        return (self.num_cpus or os.cpu_count() or 1) // self.cpus_per_task
+
+    def map(self, function: Callable[[Any], Any], tasks: Sequence[Any]) -> List[Any]:
+        try:
+            import ray
+        except ImportError:
+            raise ImportError("The Ray launcher needs `ray` installed")
+        if not ray.is_initialized():
+            ray.init(address=self.address, num_cpus=self.num_cpus, ignore_reinit_error=True)
+        remote = ray.remote(num_cpus=self.cpus_per_task)(_call)
+        # the function is put in the object store once instead of with every task
+        function_ref = ray.put(function)
+        return ray.get([remote.remote(function_ref, task) for task in tasks])
@@ -0,0 +1,304 @@
+"""Preprocessing stages run over shards of the polygons by `solar_mapper.prepare`.
+
+- `index_shard` searches the catalog once per polygon and writes the acquisition dates of the
+  whole period, see `solar_mapper.dataset.acquisitions.AcquisitionCalendar`, `seed_calendar`
+  reads them back, so later stages and training runs don't search again
+- `write_mask_chunks` rasterizes polygons into the label store, sharded by chunk instead of by
+  polygon, so no two processes write the same chunk
+- `materialize_shard` loads a chip for every polygon and writes it as a `.npz` file, skipping
+  chips written by an earlier run, `Sentinel2PolygonDataset` reads them back with `chip_cache`,
+  the windows are drawn from the index of the shard when there is one
+
+Every function is self-contained, so it can run in any worker process of a launcher, and
+returns counters that are summed over the shards.
+"""
+
+import json
+import math
+import os
+from datetime import datetime
+from typing import Any, Container, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from shapely.geometry import shape
+
+from solar_mapper.dataset.cog import configure_cog_access
+from solar_mapper.dataset.resilience import RemoteReadError, configure_remote_io, get_remote_io
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+
+class Shard(NamedTuple):
+    """Polygons processed by one task, with their index in the input file."""
+
+    index: int
+    features: List[Tuple[int, dict]]
+
+
+class MaskTask(NamedTuple):
+    """Chunks of one UTM zone array written by one task."""
+
+    path: str
+    epsg: int
+    chunks: Dict[Tuple[int, int], list]
+
+
+def shard_features(features: Sequence[dict], shard_size: int) -> List[Shard]:
+    """Splits polygons into shards of neighbouring polygons.
+
+    Polygons are ordered by the 1° cell they are in, so the polygons of a shard tend to share
+    scenes, and the COG blocks cached while loading one are reused for the next.
+
+    Args:
+        features: GeoJSON features in EPSG:4326
+        shard_size: Number of polygons per shard
+
+    Returns:
+        Shards covering every polygon once
+    """
+
+    def cell(item: Tuple[int, dict]) -> Tuple[int, int]:
+        point = shape(item[1]["geometry"]).representative_point()
+        return math.floor(point.x), math.floor(point.y)
+
+    ordered = sorted(enumerate(features), key=cell)
+    return [
+        Shard(index, ordered[start : start + shard_size])
+        for index, start in enumerate(range(0, len(ordered), shard_size))
+    ]
+
+
+def split_mask_tasks(path: str, buckets: Dict[int, Dict[Tuple[int, int], list]], num_tasks: int):
+    """Spreads the chunks of `bucket_polygons` over about `num_tasks` tasks."""
+    total = sum(len(chunks) for chunks in buckets.values())
+    chunks_per_task = max(1, math.ceil(total / max(num_tasks, 1)))
+    tasks = []
+    for epsg, chunks in buckets.items():
+        # neighbouring chunks share polygons, contiguous runs keep a task's work local
+        keys = sorted(chunks)
+        for start in range(0, len(keys), chunks_per_task):
+            selected = keys[start : start + chunks_per_task]
+            tasks.append(MaskTask(path, epsg, {key: chunks[key] for key in selected}))
+    return tasks
+
+
+def setup_worker(
+    cog_settings: Optional[Dict[str, Any]] = None, remote_io: Optional[Dict[str, Any]] = None
+) -> None:
+    """Applies the COG read and retry settings in a worker process of a launcher."""
+    import dask
+
+    configure_cog_access(cog_settings)
+    configure_remote_io(remote_io)
+    # chips are computed in the worker, with threads for the concurrent reads of a chip
+    dask.config.set(scheduler="threads")
+
+
+def index_shard(
+    shard: Shard,
+    output_dir: str,
+    start_time: str,
+    end_time: str,
+    collection: str = "sentinel-2-l2a",
+    max_cloud_cover: Optional[float] = None,
+    cog_settings: Optional[Dict[str, Any]] = None,
+    remote_io: Optional[Dict[str, Any]] = None,
+) -> Dict[str, int]:
+    """Writes the acquisition dates of the polygons of a shard to `index/shard-<index>.json`.
+
+    Returns:
+        Number of indexed and failed polygons, and of acquisitions
+    """
+    from solar_mapper.dataset.acquisitions import AcquisitionCalendar
+    from solar_mapper.dataset.sentinel_2 import default_catalog
+
+    setup_worker(cog_settings, remote_io)
+    calendar = AcquisitionCalendar(collection, max_cloud_cover, max_size=1)
+    start, end = datetime.fromisoformat(start_time), datetime.fromisoformat(end_time)
+    dates, geometries, failed = {}, {}, 0
+    for polygon, feature in shard.features:
+        try:
+            found = calendar.dates(feature, start, end, default_catalog())
+        except RemoteReadError as error:
+            log.warning(f"Couldn't index polygon {polygon}: {error}")
+            failed += 1
+            continue
+        dates[str(polygon)] = [str(date) for date in found]
+        geometries[str(polygon)] = calendar.geometry_key(feature)
+
+    index = {
+        "collection": collection,
+        "start_time": start_time,
+        "end_time": end_time,
+        "max_cloud_cover": max_cloud_cover,
+        "dates": dates,
+        # dates are only used for the same geometry, even if the polygons file changed
+        "geometries": geometries,
+    }
+    _write_json(index_path(output_dir, shard.index), index)
+    return {
+        "polygons": len(dates),
+        "failed": failed,
+        "acquisitions": sum(len(found) for found in dates.values()),
+    }
+
+
+def index_path(output_dir: str, shard: int) -> str:
+    return os.path.join(output_dir, "index", f"shard-{shard:05d}.json")
+
+
+def seed_calendar(
+    calendar: Any,
+    output_dir: str,
+    shard: Optional[int] = None,
+    polygons: Optional[Container[int]] = None,
+) -> int:
+    """Adds the acquisition dates written by `index_shard` to an `AcquisitionCalendar`.
+
+    Indexes of another collection or cloud cover limit than the calendar's are skipped.
+
+    Args:
+        calendar: Calendar to add the dates to
+        output_dir: Directory of the prepared data
+        shard: Index of the shard to read, all shards if None
+        polygons: Only add the dates of these polygons, all if None
+
+    Returns:
+        Number of polygons added, 0 if there is no index
+    """
+    if shard is not None:
+        paths = [index_path(output_dir, shard)]
+    else:
+        directory = os.path.join(output_dir, "index")
+        names = sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+        paths = [os.path.join(directory, name) for name in names if name.endswith(".json")]
+
+    added = 0
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path) as file:
+            index = json.load(file)
+        settings = (index["collection"], index["max_cloud_cover"])
+        if settings != (calendar.collection, calendar.max_cloud_cover):
+            log.warning(f"Skipping <{path}>, indexed with {settings}")
+            continue
+        start = datetime.fromisoformat(index["start_time"])
+        end = datetime.fromisoformat(index["end_time"])
+        for polygon, key in index.get("geometries", {}).items():
+            if polygons is None or int(polygon) in polygons:
+                calendar.add(key, start, end, index["dates"][polygon])
+                added += 1
+    return added
+
+
+def write_mask_chunks(
+    task: MaskTask, storage_options: Optional[Dict[str, Any]] = None
+) -> Dict[str, int]:
+    """Rasterizes the chunks of a task into an array created by `open_label_array`.
+
+    Returns:
+        Number of chunks and of chunks with labels
+    """
+    from solar_mapper.dataset.label_store import open_label_group, write_label_chunks
+
+    array = open_label_group(task.path, storage_options)[str(task.epsg)]
+    return {"chunks": len(task.chunks), "labelled": write_label_chunks(array, task.chunks)}
+
+
+def chip_path(output_dir: str, polygon: int) -> str:
+    return os.path.join(output_dir, "chips", f"{polygon:07d}.npz")
+
+
+def cached_polygons(output_dir: str) -> List[int]:
+    """Indices of the polygons with a chip written by `materialize_shard`."""
+    names = os.listdir(os.path.join(output_dir, "chips"))
+    return sorted(int(name[: -len(".npz")]) for name in names if name.endswith(".npz"))
+
+
+def write_chip_manifest(output_dir: str, manifest: Dict[str, Any]) -> None:
+    """Records what the chips were loaded with, checked by datasets reading them as a cache."""
+    _write_json(os.path.join(output_dir, "chips", "manifest.json"), manifest)
+
+
+def read_chip_manifest(output_dir: str) -> Dict[str, Any]:
+    path = os.path.join(output_dir, "chips", "manifest.json")
+    if not os.path.exists(path):
+        raise ValueError(f"No chips prepared in <{output_dir}>, run the chips stage of prepare.py")
+    with open(path) as file:
+        return json.load(file)
+
+
+def materialize_shard(
+    shard: Shard,
+    dataset: Any,
+    output_dir: str,
+    seed: int = 0,
+    overwrite: bool = False,
+    cog_settings: Optional[Dict[str, Any]] = None,
+    remote_io: Optional[Dict[str, Any]] = None,
+) -> Dict[str, int]:
+    """Loads a chip for every polygon of a shard and writes it to `chips/<polygon>.npz`.
+
+    Args:
+        shard: Polygons to load
+        dataset: `Sentinel2PolygonDataset` whose `load_sample` loads the chips
+        output_dir: Directory of the prepared data
+        seed: Seed of the sampling, each polygon draws from `seed + polygon`, so reruns load the
+            same chips
+        overwrite: Load chips again that were written by an earlier run
+        cog_settings: COG read settings of the worker
+        remote_io: Retry settings of the worker
+
+    Returns:
+        Number of written, skipped (already written) and failed chips
+    """
+    from solar_mapper.dataset.sentinel_2 import ACQUISITION_CALENDAR
+
+    setup_worker(cog_settings, remote_io)
+    # the dates the index stage found for the shard, so the windows are drawn without a search
+    seed_calendar(ACQUISITION_CALENDAR, output_dir, shard.index)
+    os.makedirs(os.path.join(output_dir, "chips"), exist_ok=True)
+    counts = {"written": 0, "skipped": 0, "failed": 0}
+    for polygon, feature in shard.features:
+        path = chip_path(output_dir, polygon)
+        if not overwrite and os.path.exists(path):
+            counts["skipped"] += 1
+            continue
+        try:
+            sample = get_remote_io().call("cog", _load_sample, dataset, feature, seed + polygon)
+        except (ValueError, RemoteReadError) as error:
+            log.debug(f"No chip for polygon {polygon}: {error}")
+            counts["failed"] += 1
+            continue
+        # written next to the target and renamed, so an interrupted run leaves no partial chip
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            np.savez(file, **{key: tensor.numpy() for key, tensor in sample.items()})
+        os.replace(temporary, path)
+        counts["written"] += 1
+    return counts
+
+
+def _load_sample(dataset: Any, feature: dict, seed: int) -> Dict[str, torch.Tensor]:
+    # seeded on every attempt, so a retried load draws the same chip
+    rng = np.random.default_rng(seed)
+    # the time window search draws from the global numpy generator
+    np.random.seed(rng.integers(2**32))
+    return dataset.load_sample(feature, rng)
+
+
+def load_chip(path: str) -> Dict[str, torch.Tensor]:
+    """Reads a chip written by `materialize_shard` as a sample of `Sentinel2PolygonDataset`."""
+    with np.load(path) as chip:
+        return {key: torch.from_numpy(chip[key]) for key in chip.files}
+
+
+def _write_json(path: str, content: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(content, file)
+    os.replace(temporary, path)
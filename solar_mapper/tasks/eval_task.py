@@ -26,6 +26,13 @@ def evaluate(cfg: DictConfig) -> Tuple[dict, dict]:
 
     assert cfg.ckpt_path
 
+    if cfg.get("dask"):
+        # imported here, so runs without a cluster don't pay for importing distributed
+        from solar_mapper.utils.dask_utils import instantiate_dask_client
+
+        log.info("Instantiating dask client...")
+        instantiate_dask_client(cfg.dask)
+
     log.info(f"Instantiating datamodule <{cfg.datamodule._target_}>")
     datamodule: LightningDataModule = hydra.utils.instantiate(cfg.datamodule)
 
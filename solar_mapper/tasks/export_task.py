@@ -0,0 +1,66 @@
+import os
+from typing import Tuple
+
+import torch
+from omegaconf import DictConfig
+
+from solar_mapper import utils
+from solar_mapper.inference.engine import CPUInferenceEngine
+from solar_mapper.inference.export import (
+    export_onnx,
+    export_torchscript,
+    load_segmenter,
+    quantize_onnx,
+)
+
+log = utils.get_pylogger(__name__)
+
+
+@utils.task_wrapper
+def export(cfg: DictConfig) -> Tuple[dict, dict]:
+    """Exports a checkpoint to TorchScript and/or ONNX and benchmarks CPU inference on it.
+
+    This method is wrapped in @task_wrapper decorator which applies extra utilities
+    before and after the call.
+
+    Args:
+        cfg (DictConfig): Configuration composed by Hydra.
+
+    Returns:
+        Tuple[dict, dict]: Dict with benchmark metrics and dict with all instantiated objects.
+    """
+
+    assert cfg.ckpt_path
+
+    num_s2_bands = len(cfg.datamodule.bands)
+    in_channels = num_s2_bands + len(cfg.datamodule.s1_bands)
+
+    log.info(f"Loading model <{cfg.model._target_}> from <{cfg.ckpt_path}>")
+    segmenter = load_segmenter(cfg.model, cfg.ckpt_path, num_s2_bands)
+    example = torch.zeros(1, in_channels, cfg.export.tile_size, cfg.export.tile_size)
+
+    paths = {}
+    if "torchscript" in cfg.export.formats:
+        paths["torchscript"] = export_torchscript(
+            segmenter, os.path.join(cfg.paths.output_dir, "model.pt"), example
+        )
+    if "onnx" in cfg.export.formats:
+        paths["onnx"] = export_onnx(
+            segmenter, os.path.join(cfg.paths.output_dir, "model.onnx"), example, cfg.export.opset
+        )
+        if cfg.export.quantize:
+            paths["onnx_int8"] = quantize_onnx(paths["onnx"])
+
+    metric_dict = {}
+    if cfg.get("benchmark"):
+        for name, path in paths.items():
+            log.info(f"Benchmarking <{name}>")
+            engine = CPUInferenceEngine(model_path=path, **cfg.engine)
+            metrics = engine.benchmark(
+                in_channels, cfg.export.tile_size, num_tiles=cfg.benchmark.num_tiles
+            )
+            metric_dict.update({f"{name}/{key}": value for key, value in metrics.items()})
+
+    object_dict = {"cfg": cfg, "model": segmenter, "paths": paths}
+
+    return metric_dict, object_dict
@@ -0,0 +1,132 @@
+import math
+import os
+import time
+from collections import Counter
+from functools import partial
+from typing import Tuple
+
+import hydra
+from omegaconf import DictConfig, OmegaConf
+
+from solar_mapper import utils
+from solar_mapper.datamodules.components.sentinel2_dataset import resolve_path
+from solar_mapper.dataset.geojson_stream import iter_features
+from solar_mapper.preprocessing.launchers import Launcher
+from solar_mapper.preprocessing.stages import (
+    index_shard,
+    materialize_shard,
+    shard_features,
+    split_mask_tasks,
+    write_chip_manifest,
+    write_mask_chunks,
+)
+
+log = utils.get_pylogger(__name__)
+
+STAGES = ("index", "masks", "chips")
+
+
+@utils.task_wrapper
+def prepare(cfg: DictConfig) -> Tuple[dict, dict]:
+    """Prepares training data ahead of time, spreading shards of the polygons over workers.
+
+    Stages, run in the order given by `prepare.stages`:
+    - index: acquisition dates of every polygon, see `preprocessing.stages.index_shard`
+    - masks: label store of all polygons, see `solar_mapper.dataset.label_store`
+    - chips: one materialized chip per polygon, see `preprocessing.stages.materialize_shard`
+
+    This method is wrapped in @task_wrapper decorator which applies extra utilities
+    before and after the call.
+
+    Args:
+        cfg (DictConfig): Configuration composed by Hydra.
+
+    Returns:
+        Tuple[dict, dict]: Dict with counters of each stage and dict with all instantiated objects.
+    """
+
+    unknown = set(cfg.prepare.stages) - set(STAGES)
+    if unknown:
+        raise ValueError(f"Unknown stages {sorted(unknown)}, choose from {STAGES}")
+
+    log.info(f"Instantiating launcher <{cfg.prepare.launcher._target_}>")
+    launcher: Launcher = hydra.utils.instantiate(cfg.prepare.launcher)
+
+    polygons = resolve_path(cfg.prepare.polygons, cfg.paths.data_dir)
+    log.info(f"Reading polygons from <{polygons}>")
+    features = list(iter_features(polygons))
+    shards = shard_features(features, cfg.prepare.shard_size)
+    log.info(f"Split {len(features)} polygons into {len(shards)} shards")
+
+    output_dir = cfg.prepare.output_dir
+    label_store = os.path.join(output_dir, "labels.zarr")
+    worker_settings = {
+        "cog_settings": _container(cfg.datamodule.get("cog_settings")),
+        "remote_io": _container(cfg.datamodule.get("remote_io")),
+    }
+
+    metric_dict = {}
+    object_dict = {"cfg": cfg, "launcher": launcher}
+    for stage in cfg.prepare.stages:
+        log.info(f"Starting stage <{stage}> on {launcher.num_workers} workers")
+        start = time.time()
+        if stage == "index":
+            function = partial(
+                index_shard,
+                output_dir=output_dir,
+                start_time=cfg.datamodule.start_time,
+                end_time=cfg.datamodule.end_time,
+                collection=cfg.prepare.index.collection,
+                max_cloud_cover=cfg.prepare.index.max_cloud_cover,
+                **worker_settings,
+            )
+            results = launcher.map(function, shards)
+        elif stage == "masks":
+            from solar_mapper.dataset.label_store import (
+                bucket_polygons,
+                open_label_array,
+                open_label_group,
+            )
+
+            masks = cfg.prepare.masks
+            buckets = bucket_polygons(
+                features, masks.resolution, masks.chunk_size, masks.neighbour_zones
+            )
+            # arrays are created here, so workers only ever write chunks to existing ones
+            group = open_label_group(label_store)
+            for epsg in buckets:
+                open_label_array(group, epsg, masks.resolution, masks.chunk_size)
+            tasks = split_mask_tasks(label_store, buckets, 4 * launcher.num_workers)
+            results = launcher.map(write_mask_chunks, tasks)
+        else:
+            log.info(f"Instantiating datamodule <{cfg.datamodule._target_}>")
+            datamodule = hydra.utils.instantiate(cfg.datamodule)
+            dataset = datamodule._dataset(polygons, len(features), jitter=False)
+            if "masks" in cfg.prepare.stages:
+                from solar_mapper.dataset.label_store import LabelStore
+
+                dataset.label_store = LabelStore(label_store)
+            function = partial(
+                materialize_shard,
+                dataset=dataset,
+                output_dir=output_dir,
+                seed=cfg.get("seed") or 0,
+                overwrite=cfg.prepare.chips.overwrite,
+                **worker_settings,
+            )
+            results = launcher.map(function, shards)
+            write_chip_manifest(output_dir, dataset.chip_manifest())
+            object_dict["datamodule"] = datamodule
+
+        counters = Counter()
+        for result in results:
+            counters.update(result)
+        metric_dict.update({f"{stage}/{name}": value for name, value in counters.items()})
+        metric_dict[f"{stage}/seconds"] = time.time() - start
+        log.info(f"Finished stage <{stage}> in {math.ceil(time.time() - start)}s: {dict(counters)}")
+
+    return metric_dict, object_dict
+
+
+def _container(cfg):
+    return OmegaConf.to_container(cfg, resolve=True) if cfg is not None else None
@@ -30,6 +30,13 @@ def train(cfg: DictConfig) -> Tuple[dict, dict]:
     if cfg.get("seed"):
         pl.seed_everything(cfg.seed, workers=True)
 
+    if cfg.get("dask"):
+        # imported here, so runs without a cluster don't pay for importing distributed
+        from solar_mapper.utils.dask_utils import instantiate_dask_client
+
+        log.info("Instantiating dask client...")
+        instantiate_dask_client(cfg.dask)
+
     log.info(f"Instantiating datamodule <{cfg.datamodule._target_}>")
     datamodule: LightningDataModule = hydra.utils.instantiate(cfg.datamodule)
 
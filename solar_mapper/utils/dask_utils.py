@@ -0,0 +1,99 @@
+"""Dask cluster setup for the loading, compositing and inference stages.
+
+`stac_load` returns dask-backed stacks, so once a `distributed.Client` is the default scheduler,
+every `.compute()`/`.values`/`.load()` on them runs on the cluster instead of the local threaded
+scheduler of the calling process. The cluster is either a `LocalCluster`, using all cores of this
+machine, or an existing scheduler, e.g. one spanning several nodes.
+
+Chunking follows the loading profiles, `"auto"` chunks there are sized by the `array.chunk-size`
+dask setting given in the `dask` config.
+"""
+from typing import Any, Dict, Mapping, Optional
+
+import dask
+import hydra
+from distributed import Client, WorkerPlugin, default_client
+from omegaconf import DictConfig, OmegaConf
+
+from solar_mapper.dataset.cog import configure_cog_access
+from solar_mapper.utils import pylogger
+
+log = pylogger.get_pylogger(__name__)
+
+
+def flatten_dask_config(config: Mapping[str, Any], prefix: str = "") -> Dict[str, Any]:
+    """Flattens nested settings to the dotted keys `dask.config.set` expects.
+
+    `dask.config.set` replaces whole sub-trees when given nested dicts, so
+    `{"distributed": {"worker": {"memory": {"spill": 0.7}}}}` would drop every other
+    `distributed` setting, while `{"distributed.worker.memory.spill": 0.7}` only sets one value.
+    """
+    flat = {}
+    for key, value in config.items():
+        name = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(value, Mapping):
+            flat.update(flatten_dask_config(value, name))
+        else:
+            flat[name] = value
+    return flat
+
+
+class COGSettingsPlugin(WorkerPlugin):
+    """Applies the COG read settings on every worker, including ones that join later."""
+
+    def __init__(self, cog_settings: Optional[Dict[str, Any]] = None):
+        self.cog_settings = cog_settings
+
+    def setup(self, worker):
+        configure_cog_access(self.cog_settings)
+
+
+def instantiate_dask_client(dask_cfg: Optional[DictConfig]) -> Optional[Client]:
+    """Starts or connects to a dask cluster and makes it the default scheduler.
+
+    Args:
+        dask_cfg: Config with either a `cluster` to instantiate or the `address` of a running
+            scheduler, plus optional dask `config` overrides and `cog_settings` for the workers
+
+    Returns:
+        The client, or None if no dask config is given
+    """
+    if not dask_cfg:
+        return None
+
+    if dask_cfg.get("config"):
+        # set before the cluster is created, so nanny-started workers inherit the memory limits
+        settings = flatten_dask_config(OmegaConf.to_container(dask_cfg.config, resolve=True))
+        log.info(f"Setting dask config <{settings}>")
+        dask.config.set(settings)
+
+    if dask_cfg.get("address"):
+        log.info(f"Connecting to dask scheduler <{dask_cfg.address}>")
+        client = Client(dask_cfg.address)
+    elif dask_cfg.get("cluster"):
+        log.info(f"Instantiating dask cluster <{dask_cfg.cluster._target_}>")
+        client = Client(hydra.utils.instantiate(dask_cfg.cluster))
+    else:
+        raise ValueError("Dask config needs either a `cluster` or an `address`!")
+
+    cog_settings = dask_cfg.get("cog_settings")
+    if cog_settings is not None:
+        cog_settings = OmegaConf.to_container(cog_settings, resolve=True)
+    client.register_plugin(COGSettingsPlugin(cog_settings), name="cog-settings")
+
+    log.info(f"Dask dashboard: {client.dashboard_link}")
+    return client
+
+
+def close_dask_client() -> None:
+    """Closes the default client and any cluster it started."""
+    try:
+        client = default_client()
+    except ValueError:
+        return
+
+    log.info("Closing dask client!")
+    cluster = client.cluster
+    client.close()
+    if cluster is not None:
+        cluster.close()
@@ -22,6 +22,7 @@ def task_wrapper(task_func: Callable) -> Callable:
     Utilities:
     - Calling the `utils.extras()` before the task is started
     - Calling the `utils.close_loggers()` after the task is finished
+    - Closing the dask client and cluster after the task is finished
     - Logging the exception if occurs
     - Logging the task total execution time
     - Logging the output dir
@@ -44,6 +45,10 @@ def task_wrapper(task_func: Callable) -> Callable:
             content = f"'{cfg.task_name}' execution time: {time.time() - start_time} (s)"
             save_file(path, content)  # save task execution time (even if exception occurs)
             close_loggers()  # close loggers (even if exception occurs so multirun won't fail)
+            if cfg.get("dask"):
+                from solar_mapper.utils.dask_utils import close_dask_client
+
+                close_dask_client()  # shut down the cluster so multirun jobs don't leak workers
 
         log.info(f"Output dir: {cfg.paths.output_dir}")
 
@@ -1,3 +1,5 @@
+from typing import Callable, Optional
+
 import pyrootutils
 import pytest
 from hydra import compose, initialize
@@ -77,3 +79,25 @@ def cfg_eval(cfg_eval_global, tmp_path) -> DictConfig:
     yield cfg
 
     GlobalHydra.instance().clear()
+
+
+# builds training datasets over polygons kept in memory, whose chips come from `load_sample`
+# and `load_negative` instead of the remote imagery
+@pytest.fixture(scope="function")
+def polygon_dataset() -> Callable:
+    from solar_mapper.datamodules.components.sentinel2_dataset import Sentinel2PolygonDataset
+
+    def make(
+        features: list,
+        load_sample: Callable,
+        load_negative: Optional[Callable] = None,
+        **kwargs,
+    ) -> Sentinel2PolygonDataset:
+        dataset = Sentinel2PolygonDataset("polygons.geojson", "2020-01-01", "2020-12-31", **kwargs)
+        dataset._features = features
+        dataset.load_sample = load_sample
+        if load_negative is not None:
+            dataset.load_negative = load_negative
+        return dataset
+
+    return make
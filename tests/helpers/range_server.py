@@ -0,0 +1,74 @@
+import functools
+import http.server
+import multiprocessing
+import os
+import re
+from typing import List, Tuple
+
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static file handler with single-range `Range` support that logs every GET."""
+
+    log_path: str = ""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        header = self.headers.get("Range")
+        with open(self.log_path, "a") as log:
+            log.write(f"{self.path} {header}\n")
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        match = re.match(r"bytes=(\d+)-(\d*)$", header or "")
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2) or len(data) - 1), len(data) - 1)
+            body = data[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except ConnectionError:
+            # Clients abort unranged GETs once they have the headers
+            pass
+
+
+def _serve(directory: str, log_path: str, queue: multiprocessing.Queue):
+    handler = type("Handler", (RangeRequestHandler,), {"log_path": log_path})
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(handler, directory=directory)
+    )
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_range_server(directory: str, log_path: str) -> Tuple[str, multiprocessing.Process]:
+    """Serves `directory` over HTTP from a separate process.
+
+    The server must not share the GIL with GDAL, which holds it while reading.
+
+    Returns:
+        Base URL of the server and the server process
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_serve, args=(directory, log_path, queue), daemon=True)
+    process.start()
+    return f"http://127.0.0.1:{queue.get(timeout=30)}", process
+
+
+def read_request_log(log_path: str) -> List[str]:
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path) as log:
+        return log.read().splitlines()
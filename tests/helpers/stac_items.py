@@ -0,0 +1,63 @@
+import datetime
+from typing import Dict, Tuple
+
+import numpy as np
+import pystac
+import rasterio
+from pystac.extensions.projection import ProjectionExtension
+from rasterio.transform import from_origin
+
+ORIGIN = (500_000, 4_000_000)
+EPSG = 32633
+
+
+def make_item(
+    directory: str,
+    assets: Dict[str, Tuple[int, np.ndarray]],
+    collection: str = "sentinel-2-l2a",
+    item_id: str = "item",
+    date: datetime.datetime = datetime.datetime(2020, 1, 1),
+) -> pystac.Item:
+    """Writes `assets` as local GeoTIFFs and returns a STAC item with projection metadata.
+
+    Args:
+        directory: Directory to write the GeoTIFFs to
+        assets: Mapping of asset name to (resolution in metres, 2D array)
+        collection: Collection of the item
+        item_id: ID of the item
+        date: Acquisition time of the item
+    """
+    item = pystac.Item(
+        item_id,
+        geometry={
+            "type": "Polygon",
+            "coordinates": [[[15, 36], [15.1, 36], [15.1, 36.1], [15, 36.1], [15, 36]]],
+        },
+        bbox=[15, 36, 15.1, 36.1],
+        datetime=date,
+        properties={},
+        collection=collection,
+    )
+    ProjectionExtension.add_to(item)
+    for name, (resolution, data) in assets.items():
+        path = f"{directory}/{item_id}_{name}.tif"
+        transform = from_origin(*ORIGIN, resolution, resolution)
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=data.shape[1],
+            height=data.shape[0],
+            count=1,
+            dtype=data.dtype,
+            crs=f"EPSG:{EPSG}",
+            transform=transform,
+        ) as dst:
+            dst.write(data, 1)
+        asset = pystac.Asset(path, media_type=pystac.MediaType.GEOTIFF, roles=["data"])
+        item.add_asset(name, asset)
+        projection = ProjectionExtension.ext(asset)
+        projection.epsg = EPSG
+        projection.shape = list(data.shape)
+        projection.transform = list(transform)[:6]
+    return item
@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+import numpy as np
+import pystac_client
+import pytest
+
+from solar_mapper.dataset.acquisitions import AcquisitionCalendar
+
+FEATURE = {
+    "type": "Feature",
+    "properties": {"Date": "2019-01-01 00:00:00"},
+    "geometry": {"type": "Point", "coordinates": [15.0, 36.0]},
+}
+START, END = datetime(2018, 1, 1), datetime(2021, 1, 1)
+DELTA = timedelta(days=30)
+
+
+class FakeCatalog:
+    """Catalog with a scene every 60 days, alternating clear and cloudy."""
+
+    def __init__(self, scenes=True):
+        self.scenes = scenes
+        self.searches = []
+
+    def search(self, collections, intersects, datetime):
+        self.searches.append(datetime)
+        start, end = (np.datetime64(d.rstrip("Z")) for d in datetime.split("/"))
+        dates = np.arange(np.datetime64("2015-01-03T10:20:30"), end, np.timedelta64(60, "D"))
+        items = [
+            {"properties": {"datetime": f"{date}Z", "eo:cloud_cover": 80.0 * (i % 2)}}
+            for i, date in enumerate(dates)
+            if self.scenes and date >= start
+        ]
+        return mock.Mock(items_as_dicts=lambda: iter(items))
+
+
+def _scenes(catalog, start, end):
+    """Acquisition dates of the catalog inside a window."""
+    period = f"{start.strftime('%Y-%m-%dT%H:%M:%SZ')}/{end.strftime('%Y-%m-%dT%H:%M:%SZ')}"
+    return catalog.search(None, None, period).items_as_dicts()
+
+
+def test_windows_always_contain_scenes():
+    catalog = FakeCatalog()
+    calendar = AcquisitionCalendar()
+    rng = np.random.RandomState(0)
+    for _ in range(50):
+        start, end = calendar.sample_window(FEATURE, START, END, DELTA, catalog, rng)
+        assert START <= start and end <= END and end - start == DELTA
+        assert list(_scenes(FakeCatalog(), start, end))
+    # one search of the whole period, plus the checks above
+    assert calendar.num_searches == 1 and len(catalog.searches) == 1
+
+
+def test_cloud_cover_filter_and_cache_size():
+    calendar = AcquisitionCalendar(max_cloud_cover=50, max_size=1)
+    dates = calendar.dates(FEATURE, START, END, FakeCatalog())
+    assert len(dates) == 9 and np.all(np.diff(dates) == np.timedelta64(120, "D"))
+
+    other = {**FEATURE, "geometry": {"type": "Point", "coordinates": [16.0, 36.0]}}
+    calendar.dates(other, START, END, FakeCatalog())
+    calendar.dates(FEATURE, START, END, FakeCatalog())
+    assert calendar.num_searches == 3
+
+
+def test_indexed_dates_answer_without_search():
+    catalog = FakeCatalog()
+    dates = AcquisitionCalendar().dates(FEATURE, START, END, catalog)
+    calendar = AcquisitionCalendar()
+    calendar.add(AcquisitionCalendar.geometry_key(FEATURE), START, END, [str(d) for d in dates])
+    later = datetime(2019, 1, 1)
+    assert np.array_equal(calendar.dates(FEATURE, START, END, catalog), dates)
+    assert np.array_equal(calendar.dates(FEATURE, later, END, catalog), dates[dates >= later])
+    assert calendar.num_searches == 0
+    # periods the index doesn't cover are searched
+    calendar.dates(FEATURE, START, datetime(2022, 1, 1), catalog)
+    assert calendar.num_searches == 1
+
+
+def test_no_scenes_fails_without_loading():
+    catalog = FakeCatalog(scenes=False)
+    calendar = AcquisitionCalendar()
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            calendar.sample_window(FEATURE, START, END, DELTA, catalog)
+    assert len(catalog.searches) == 1
+
+
+def test_randomly_sample_from_valid_times_uses_calendar():
+    with mock.patch.object(pystac_client.Client, "open"):
+        from solar_mapper.dataset import sentinel_2
+
+    catalog = FakeCatalog()
+    with mock.patch.object(sentinel_2, "get_area_of_interest") as get_area_of_interest:
+        sentinel_2.randomly_sample_from_valid_times(
+            FEATURE, START, END, DELTA, calendar=AcquisitionCalendar(), catalog=catalog
+        )
+    period = get_area_of_interest.call_args.kwargs["time_period"]
+    start, end = (datetime.strptime(d, "%Y-%m-%dT%H:%M:%SZ") for d in period.split("/"))
+    # windows start after the date of the polygon
+    assert start >= datetime(2019, 1, 1) and list(_scenes(FakeCatalog(), start, end))
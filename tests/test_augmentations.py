@@ -0,0 +1,115 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pystac_client
+import pytest
+import torch
+
+from solar_mapper.datamodules.components.augmentations import BatchAugmentation, crop
+
+
+def make_batch(batch_size: int = 16, size: int = 8):
+    s2 = torch.randint(5_000, 10_000, (batch_size, 4, size, size), dtype=torch.int16)
+    s2[:, :, 0, 0] = 0
+    s1 = -torch.rand(batch_size, 2, size, size).half() * 20
+    s1[:, :, 1, 1] = float("nan")
+    mask = torch.zeros(batch_size, 1, size, size, dtype=torch.uint8)
+    mask[:, :, 1:3, 2:6] = 1
+    # band 0 of s2 and s1 encode the position of each pixel, to follow the geometry
+    position = torch.arange(size * size, dtype=torch.int16).view(size, size) + 1
+    s2[:, 0] = position
+    s1[:, 0] = position.half()
+    return {"s2": s2, "s1": s1, "mask": mask}
+
+
+def test_geometry_is_consistent_across_tensors():
+    torch.manual_seed(0)
+    batch = make_batch()
+    augmented = BatchAugmentation(flip=True, rotate=True)(batch)
+    for key, tensor in batch.items():
+        assert augmented[key].dtype == tensor.dtype and augmented[key].shape == tensor.shape
+    # every sample moved its pixels the same way in all tensors
+    s1_positions = augmented["s1"][:, 0].nan_to_num(0).to(torch.int16)
+    valid = ~torch.isnan(augmented["s1"][:, 0])
+    assert torch.equal(augmented["s2"][:, 0][valid], s1_positions[valid])
+    for sample in range(len(batch["mask"])):
+        moved = augmented["s2"][sample, 0].long() - 1
+        assert torch.equal(augmented["mask"][sample, 0], batch["mask"][sample, 0].flatten()[moved])
+    # the 8 symmetries of the square are all drawn
+    corners = {tuple(x[0, [0, 0, -1, -1], [0, -1, 0, -1]].tolist()) for x in augmented["s2"]}
+    assert len(corners) > 4
+
+
+def test_crop_takes_a_window_per_sample():
+    x = torch.arange(2 * 1 * 6 * 6).view(2, 1, 6, 6)
+    rows = torch.tensor([[0, 1, 2], [3, 4, 5]])
+    cols = torch.tensor([[1, 2, 3], [0, 1, 2]])
+    cropped = crop(x, rows, cols)
+    assert torch.equal(cropped[0], x[0, :, 0:3, 1:4])
+    assert torch.equal(cropped[1], x[1, :, 3:6, 0:3])
+
+    torch.manual_seed(0)
+    augmented = BatchAugmentation(flip=False, rotate=False, crop_size=4)(make_batch(size=8))
+    assert augmented["s2"].shape == (16, 4, 4, 4)
+    assert augmented["mask"].shape == (16, 1, 4, 4)
+
+
+def test_sequences_share_the_transform_of_their_sample():
+    torch.manual_seed(0)
+    batch = make_batch()
+    # the same chip at three time steps, the middle one brighter
+    s2 = batch["s2"][:, None].repeat(1, 3, 1, 1, 1)
+    s2[:, 1, 1:] *= 2
+    sequences = {"s2": s2, "mask": batch["mask"]}
+    augmented = BatchAugmentation(flip=True, rotate=True, crop_size=6, s2_offset=0)(sequences)
+    assert augmented["s2"].shape == (16, 3, 4, 6, 6)
+    positions = augmented["s2"][:, :, 0]
+    assert torch.equal(positions[:, 0], positions[:, 2])
+    # same gain of each band at every step
+    ratio = augmented["s2"][:, 1, 1:].float() / augmented["s2"][:, 0, 1:].float()
+    assert torch.allclose(ratio[augmented["s2"][:, 0, 1:] > 0], torch.tensor(2.0), atol=1e-3)
+    moved = positions[:, 0].long() - 1
+    for sample in range(16):
+        assert torch.equal(
+            augmented["mask"][sample, 0], batch["mask"][sample, 0].flatten()[moved[sample]]
+        )
+
+
+def test_radiometric_jitter_keeps_nodata():
+    torch.manual_seed(0)
+    batch = make_batch()
+    augmented = BatchAugmentation(
+        flip=False, rotate=False, s2_gain=0.1, s2_offset=100, s1_offset_db=1.0
+    )(batch)
+    assert torch.equal(augmented["mask"], batch["mask"])
+    assert (augmented["s2"][:, 1:, 0, 0] == 0).all()
+    assert (augmented["s2"][:, 1:, 1:, 1:] > 0).all()
+    ratio = augmented["s2"][:, 1:, 2:, 2:].float() / batch["s2"][:, 1:, 2:, 2:].float()
+    assert 0.85 < ratio.min() and ratio.max() < 1.15
+    assert not torch.equal(augmented["s2"], batch["s2"])
+    assert torch.isnan(augmented["s1"][:, 1:, 1, 1]).all()
+    difference = (augmented["s1"] - batch["s1"]).float().nan_to_num(0)
+    assert difference.abs().max() <= 1.01
+    # one offset per sample and band
+    offsets = difference[:, :, 2:, 2:].flatten(2)
+    assert torch.allclose(offsets, offsets[..., :1], atol=0.05)
+
+
+def test_rotation_needs_square_chips():
+    batch = {"mask": torch.zeros(2, 1, 4, 6, dtype=torch.uint8)}
+    with pytest.raises(ValueError):
+        BatchAugmentation(rotate=True)(batch)
+    assert BatchAugmentation(rotate=False)(batch)["mask"].shape == (2, 1, 4, 6)
+
+
+def test_datamodule_only_augments_training_batches():
+    with mock.patch.object(pystac_client.Client, "open"):
+        from solar_mapper.datamodules.sentinel2_datamodule import Sentinel2DataModule
+
+    augmentation = mock.Mock(side_effect=lambda batch: {**batch, "augmented": True})
+    datamodule = Sentinel2DataModule(augmentation=augmentation)
+    batch = make_batch()
+    datamodule.trainer = SimpleNamespace(training=False)
+    assert "augmented" not in datamodule.on_after_batch_transfer(batch, 0)
+    datamodule.trainer = SimpleNamespace(training=True, num_training_batches=10)
+    assert datamodule.on_after_batch_transfer(batch, 0)["augmented"]
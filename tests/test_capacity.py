@@ -0,0 +1,93 @@
+import time
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import Point, box
+
+from solar_mapper.dataset.utils import V_inv
+from solar_mapper.evaluation.capacity import (
+    capacity_table,
+    geodesic_distance,
+    match_to_gem,
+    operating_plants,
+)
+
+
+def test_geodesic_distance_matches_vincenty():
+    rng = np.random.default_rng(0)
+    lat1, lat2 = rng.uniform(-60, 60, (2, 20))
+    lon1, lon2 = rng.uniform(-180, 180, (2, 20))
+    distances = geodesic_distance(lat1, lon1, lat2, lon2)
+    expected = [V_inv((a, b), (c, d))[0] * 1000 for a, b, c, d in zip(lat1, lon1, lat2, lon2)]
+    np.testing.assert_allclose(distances, expected, rtol=1e-6)
+
+
+def _gem():
+    return gpd.GeoDataFrame(
+        {
+            "Project Name": ["a", "b", "c"],
+            "Capacity (MW)": [10.0, 40.0, 5.0],
+            "Start year": [2015, 2018, None],
+            "Retired year": [None, None, None],
+        },
+        geometry=[Point(10.0, 45.0), Point(10.5, 45.0), Point(20.0, 0.0)],
+        crs="EPSG:4326",
+    )
+
+
+def _square(lon, lat, side_m):
+    # about 111 km per degree of latitude
+    half = side_m / 2 / 111_000
+    return box(
+        lon - half / np.cos(np.radians(lat)),
+        lat - half,
+        lon + half / np.cos(np.radians(lat)),
+        lat + half,
+    )
+
+
+def test_capacity_table():
+    polygons = gpd.GeoDataFrame(
+        {"country": ["X", "X", "X", "Y"]},
+        geometry=[
+            _square(10.0, 45.0, 100),  # plant a, 0.01 km²
+            _square(10.5, 45.0, 200),  # plant b, 0.04 km², split into two polygons
+            _square(10.5 + 0.003, 45.0, 200),
+            _square(30.0, 10.0, 100),  # no plant nearby
+        ],
+        crs="EPSG:4326",
+    )
+    table = capacity_table(
+        polygons, _gem(), region_column="country", min_plants=2, years=(2016, 2020)
+    )
+    assert table.gem_index.tolist()[:3] == [0, 1, 1] and np.isnan(table.gem_index[3])
+    assert table.distance_m.iloc[0] < 1 and table.distance_m.iloc[2] == pytest.approx(236, rel=0.02)
+    assert table["gem_Project Name"].tolist()[:3] == ["a", "b", "b"]
+    # region X and, as fallback, region Y get the median density of plants a and b
+    area_km2 = table.area_m2.to_numpy() / 1e6
+    density = np.median([10 / area_km2[0], 40 / (area_km2[1] + area_km2[2])])
+    np.testing.assert_allclose(
+        table.estimated_capacity_mw, table.area_m2 / 1e6 * density, rtol=1e-3
+    )
+    assert table.area_m2.iloc[0] == pytest.approx(10_000, rel=0.01)
+
+    # plant b only started in 2018
+    assert len(operating_plants(_gem(), 2010, 2016)) == 1
+
+
+def test_match_full_tracker_quickly():
+    rng = np.random.default_rng(0)
+    n = 100_000
+    lon, lat = rng.uniform(-180, 180, n), rng.uniform(-60, 60, n)
+    gem = gpd.GeoDataFrame(geometry=gpd.points_from_xy(lon, lat), crs="EPSG:4326")
+    offset = rng.normal(0, 0.001, (2, n))
+    polygons = gpd.GeoDataFrame(
+        geometry=gpd.points_from_xy(lon + offset[0], lat + offset[1]).buffer(1e-4),
+        crs="EPSG:4326",
+    )
+    start = time.perf_counter()
+    matches = match_to_gem(polygons, gem, max_distance_m=1000)
+    assert time.perf_counter() - start < 30
+    assert (matches.gem_index.to_numpy() == matches.index.to_numpy()).mean() > 0.99
+    assert matches.distance_m.max() <= 1000
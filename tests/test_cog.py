@@ -0,0 +1,80 @@
+from typing import List
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from solar_mapper.dataset.cog import cog_env, get_gdal_options, open_remote
+from tests.helpers.range_server import read_request_log, start_range_server
+
+
+@pytest.fixture(scope="module")
+def cog_server(tmp_path_factory):
+    directory = tmp_path_factory.mktemp("cogs")
+    data = np.random.default_rng(0).integers(0, 10_000, (1024, 1024), dtype="uint16")
+    profile = dict(
+        driver="GTiff",
+        width=1024,
+        height=1024,
+        count=1,
+        dtype="uint16",
+        tiled=True,
+        blockxsize=256,
+        blockysize=256,
+        compress="deflate",
+        crs="EPSG:32633",
+        transform=from_origin(500_000, 4_000_000, 10, 10),
+    )
+    with rasterio.open(directory / "B04.tif", "w", **profile) as dst:
+        dst.write(data, 1)
+    log_path = str(directory / "requests.log")
+    url, process = start_range_server(str(directory), log_path)
+    yield url, data, log_path
+    process.terminate()
+
+
+def test_gdal_options_merge_ranges():
+    options = get_gdal_options()
+    assert options["GDAL_HTTP_MERGE_CONSECUTIVE_RANGES"] == "YES"
+    assert options["GDAL_HTTP_MULTIPLEX"] == "YES"
+    assert (
+        get_gdal_options(merge_consecutive_ranges=False)["GDAL_HTTP_MERGE_CONSECUTIVE_RANGES"]
+        == "NO"
+    )
+
+
+def _data_requests(log_path: str, tag: str) -> List[str]:
+    """Range requests of the reads tagged with `tag`, the header is the first 32KB."""
+    requests = [request for request in read_request_log(log_path) if f"?{tag} " in request]
+    return [request for request in requests if "bytes=" in request and "bytes=0-" not in request]
+
+
+def test_cog_env_coalesces_tile_reads(cog_server):
+    url, data, log_path = cog_server
+    # small reads and caches, so only the coalescing of the tile reads keeps requests down, each
+    # read gets its own URL, so no blocks are cached from an earlier one
+    settings = {"chunk_size_kb": 16, "header_size_kb": 16, "block_cache_mb": 1}
+    with cog_env(settings):
+        assert rasterio.env.getenv()["GDAL_HTTP_MERGE_CONSECUTIVE_RANGES"] == "YES"
+        with rasterio.open(f"{url}/B04.tif?row") as src:
+            row = src.read(1, window=Window(0, 0, 1024, 256))
+        # the same tiles, read backwards one at a time, can't be merged
+        with rasterio.open(f"{url}/B04.tif?tiles") as src:
+            tiles = [src.read(1, window=Window(c * 256, 0, 256, 256)) for c in range(3, -1, -1)]
+
+    np.testing.assert_array_equal(row, data[:256])
+    np.testing.assert_array_equal(np.concatenate(tiles[::-1], axis=1), data[:256])
+    # the 4 adjacent tiles of the row are fetched as one range
+    assert len(_data_requests(log_path, "row")) == 1
+    assert len(_data_requests(log_path, "tiles")) == 4
+    with cog_env({"merge_consecutive_ranges": False}):
+        assert rasterio.env.getenv()["GDAL_HTTP_MERGE_CONSECUTIVE_RANGES"] == "NO"
+
+
+def test_open_remote_block_cache(cog_server):
+    url, _, _ = cog_server
+    with open_remote(f"{url}/B04.tif", settings={"fsspec_block_size_mb": 0.0625}) as f:
+        assert f.read(4) in (b"II*\x00", b"MM\x00*")
+        assert f.cache.name == "blockcache"
@@ -0,0 +1,63 @@
+import dask
+import dask.array as da
+import pytest
+from distributed import default_client
+from omegaconf import OmegaConf
+
+from solar_mapper.utils.dask_utils import (
+    close_dask_client,
+    flatten_dask_config,
+    instantiate_dask_client,
+)
+
+
+def test_flatten_dask_config():
+    config = {"array": {"chunk-size": "64MiB"}, "distributed": {"worker": {"memory": {"spill": 0.7}}}}
+    assert flatten_dask_config(config) == {
+        "array.chunk-size": "64MiB",
+        "distributed.worker.memory.spill": 0.7,
+    }
+
+
+def test_instantiate_dask_client_local_cluster():
+    cfg = OmegaConf.create(
+        {
+            "cluster": {
+                "_target_": "distributed.LocalCluster",
+                "n_workers": 2,
+                "threads_per_worker": 1,
+                "memory_limit": "3GiB",
+                "processes": False,
+                "dashboard_address": ":0",
+            },
+            "config": {"array": {"chunk-size": "1MiB"}},
+            "cog_settings": {"chunk_size_kb": 512},
+        }
+    )
+    with dask.config.set({"array.chunk-size": dask.config.get("array.chunk-size")}):
+        client = instantiate_dask_client(cfg)
+        try:
+            assert default_client() is client
+            workers = client.scheduler_info()["workers"]
+            assert len(workers) == 2
+            assert all(worker["memory_limit"] == 3 * 2**30 for worker in workers.values())
+
+            # "auto" chunks follow the configured chunk size
+            array = da.ones((2048, 2048), chunks="auto", dtype="float32")
+            assert array.chunksize[0] * array.chunksize[1] * 4 <= 2**20
+            assert array.sum().compute() == 2048 * 2048
+
+            # the COG settings are applied on each worker
+            registered = client.run(lambda dask_worker: "cog-settings" in dask_worker.plugins)
+            assert list(registered.values()) == [True, True]
+        finally:
+            close_dask_client()
+
+    with pytest.raises(ValueError):
+        default_client()
+
+
+def test_instantiate_dask_client_needs_cluster_or_address():
+    assert instantiate_dask_client(None) is None
+    with pytest.raises(ValueError):
+        instantiate_dask_client(OmegaConf.create({"config": None}))
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import torch
+from torch.utils.data import DataLoader
+
+from solar_mapper.datamodules.components.sentinel2_dataset import (
+    Sentinel2PolygonDataset,
+    resume_order,
+)
+from solar_mapper.datamodules.sentinel2_datamodule import Sentinel2DataModule
+
+FEATURES = [{"geometry": {"type": "Point", "coordinates": [i, 0.0]}} for i in range(10)]
+
+
+def _load_sample(example, rng):
+    polygon = example["geometry"]["coordinates"][0]
+    return {"x": torch.tensor([polygon, rng.integers(1 << 30)])}
+
+
+def _batches(dataset: Sentinel2PolygonDataset):
+    loader = DataLoader(dataset, batch_size=2, num_workers=2)
+    return [batch["x"].tolist() for batch in loader]
+
+
+def test_resume_order_follows_the_worker_order():
+    # 5 and 4 samples make 3 and 2 batches, returned by worker 0, 1, 0, 1, 0
+    assert resume_order([5, 4], batch_size=2, batches=0) == [(0, 0), (1, 0)]
+    assert resume_order([5, 4], batch_size=2, batches=3) == [(1, 2), (0, 4)]
+    assert resume_order([5, 4], batch_size=2, batches=4) == [(0, 4), (1, 4)]
+    assert resume_order([5, 4], batch_size=2, batches=9) == [(1, 4), (0, 5)]
+    # worker 1 ran out, worker 0 continues and worker 2 is next
+    assert resume_order([6, 2, 5], batch_size=2, batches=4) == [(2, 2), (0, 4), (1, 2)]
+
+
+def test_resumed_pass_continues_the_interrupted_one(polygon_dataset):
+    def dataset():
+        return polygon_dataset(FEATURES, _load_sample, samples_per_epoch=9, seed=7)
+
+    epoch = _batches(dataset())
+    assert len(epoch) == 5
+    assert _batches(dataset()) == epoch
+
+    resumed = dataset()
+    resumed.set_progress(0, batches=3, batch_size=2)
+    assert _batches(resumed) == epoch[3:]
+
+    # the next epoch draws other samples
+    following = dataset()
+    following.set_progress(1)
+    assert _batches(following) != epoch
+
+
+def test_datamodule_state_round_trip(tmp_path):
+    datamodule = Sentinel2DataModule(data_dir=str(tmp_path), batch_size=2)
+    datamodule.setup()
+    datamodule.trainer = SimpleNamespace(
+        training=True, num_training_batches=3, global_rank=0, world_size=1
+    )
+    batch = {"s2": torch.zeros(2, 1, 4, 4)}
+    for _ in range(4):
+        datamodule.on_after_batch_transfer(batch, 0)
+    # the epoch ended after 3 batches
+    assert (datamodule.epoch, datamodule.batches) == (1, 1)
+    assert datamodule.data_train.progress.tolist() == [1, 0, 1]
+
+    state = datamodule.state_dict()
+    restored = Sentinel2DataModule(data_dir=str(tmp_path), batch_size=2)
+    restored.load_state_dict(state)
+    restored.setup()
+    assert restored.data_train.seed == datamodule.data_train.seed
+    assert restored.data_train.progress.tolist() == [1, 1, 2]
+    assert (restored.epoch, restored.batches) == (1, 1)
+
+
+def test_ranks_share_the_seed_of_rank_zero(tmp_path):
+    datamodule = Sentinel2DataModule(data_dir=str(tmp_path), batch_size=2)
+    # rank zero's seed is what a checkpoint holds
+    datamodule.trainer = SimpleNamespace(
+        global_rank=1, world_size=2, strategy=SimpleNamespace(broadcast=lambda obj, src: 1234)
+    )
+    datamodule.setup()
+    assert datamodule.data_train.seed == 1234
+
+    # every rank resumes with the seed of the checkpoint
+    restored = Sentinel2DataModule(data_dir=str(tmp_path), batch_size=2)
+    restored.trainer = datamodule.trainer
+    restored.load_state_dict({**datamodule.state_dict(), "seed": 99})
+    restored.setup()
+    assert restored.data_train.seed == 99
@@ -0,0 +1,77 @@
+import time
+
+import torch
+from pytorch_lightning import LightningDataModule, LightningModule, Trainer
+from torch.utils.data import DataLoader, Dataset
+
+from solar_mapper.callbacks.dataloader_stall import DataLoaderStallMonitor
+
+
+class SlowDataset(Dataset):
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def __len__(self):
+        return 8
+
+    def __getitem__(self, idx):
+        time.sleep(self.delay)
+        return torch.randn(4)
+
+
+class SlowDataModule(LightningDataModule):
+    def __init__(self, delay: float, num_workers: int = 0):
+        super().__init__()
+        self.save_hyperparameters()
+
+    def train_dataloader(self):
+        return DataLoader(SlowDataset(self.hparams.delay), batch_size=2)
+
+
+class TinyModule(LightningModule):
+    def __init__(self):
+        super().__init__()
+        self.layer = torch.nn.Linear(4, 1)
+
+    def training_step(self, batch, batch_idx):
+        return self.layer(batch).sum()
+
+    def configure_optimizers(self):
+        return torch.optim.SGD(self.parameters(), lr=0.1)
+
+
+def _fit(datamodule, monitor):
+    trainer = Trainer(
+        max_epochs=1,
+        accelerator="cpu",
+        devices=1,
+        callbacks=[monitor],
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    trainer.fit(TinyModule(), datamodule=datamodule)
+    return trainer
+
+
+def test_dataloader_stall_monitor_logs_metrics():
+    monitor = DataLoaderStallMonitor(log_every_n_steps=2)
+    trainer = _fit(SlowDataModule(delay=0.0), monitor)
+
+    metrics = trainer.callback_metrics
+    for name in ("perf/data_wait_ms", "perf/compute_ms", "perf/idle_fraction"):
+        assert name in metrics
+    assert 0.0 <= metrics["perf/idle_fraction"] <= 1.0
+    assert metrics["perf/examples_per_sec"] > 0
+
+
+def test_dataloader_stall_monitor_auto_tunes_input_bound_runs():
+    monitor = DataLoaderStallMonitor(
+        log_every_n_steps=1, input_bound_threshold=0.5, auto_tune=True, max_num_workers=4
+    )
+    datamodule = SlowDataModule(delay=0.02)
+    trainer = _fit(datamodule, monitor)
+
+    assert trainer.callback_metrics["perf/idle_fraction"] > 0.5
+    assert datamodule.hparams.num_workers == 1
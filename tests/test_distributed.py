@@ -0,0 +1,96 @@
+import os
+import subprocess
+import sys
+from unittest import mock
+
+import pyrootutils
+import pytest
+import torch
+from hydra import compose, initialize
+from omegaconf import open_dict
+from torch.utils.data import DataLoader
+
+from solar_mapper.datamodules.components.sentinel2_dataset import Sentinel2PolygonDataset
+
+FEATURES = [{"geometry": {"type": "Point", "coordinates": [i, 0.0]}} for i in range(10)]
+
+
+def _load_sample(example, rng):
+    return {"x": torch.tensor([example["geometry"]["coordinates"][0], rng.integers(1 << 30)])}
+
+
+@pytest.fixture
+def dataset(polygon_dataset):
+    def make(rank: int, world_size: int) -> Sentinel2PolygonDataset:
+        return polygon_dataset(
+            FEATURES, _load_sample, samples_per_epoch=9, seed=42, rank=rank, world_size=world_size
+        )
+
+    return make
+
+
+def test_ranks_sample_their_own_polygons(dataset):
+    samples = {}
+    for rank in range(2):
+        ranked = dataset(rank, world_size=2)
+        samples[rank] = [sample["x"].tolist() for sample in ranked]
+        assert len(samples[rank]) == len(ranked)
+
+    # 9 samples rounded up to 5 per rank, from the even and odd polygons
+    assert [len(samples[0]), len(samples[1])] == [5, 5]
+    assert {polygon % 2 for polygon, _ in samples[0]} == {0}
+    assert {polygon % 2 for polygon, _ in samples[1]} == {1}
+    # a fixed seed doesn't make ranks repeat each other's draws
+    assert not {draw for _, draw in samples[0]} & {draw for _, draw in samples[1]}
+
+    # a single process keeps drawing from all polygons, as before
+    single = dataset(0, world_size=1)
+    assert len(list(single)) == 9
+    assert single.rank_features == FEATURES
+
+
+def test_ranks_run_the_same_number_of_batches(dataset):
+    batches = []
+    for rank in range(4):
+        ranked = dataset(rank, world_size=4)
+        ranked.samples_per_epoch = 27
+        batches.append(len(list(DataLoader(ranked, batch_size=3, num_workers=2))))
+    # an extra batch on one rank would leave it all-reducing alone
+    assert batches == [3, 3, 3, 3]
+
+
+def test_importing_sentinel_2_stays_offline():
+    # the catalog is only opened when the first search needs it
+    code = (
+        "import pystac_client\n"
+        "def fail(*args, **kwargs): raise RuntimeError('catalog opened')\n"
+        "pystac_client.Client.open = fail\n"
+        "import solar_mapper.datamodules.sentinel2_datamodule\n"
+        "import solar_mapper.dataset.sentinel_2 as s2\n"
+        "try:\n"
+        "    s2.DEFAULT_CATALOG\n"
+        "except RuntimeError:\n"
+        "    print('lazy')\n"
+    )
+    root = str(pyrootutils.find_root())
+    result = subprocess.run(
+        [sys.executable, "-c", code], cwd=root, capture_output=True, text=True, timeout=600
+    )
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "lazy"
+
+
+def test_torchrun_trainer_config():
+    environment = {"LOCAL_WORLD_SIZE": "2", "GROUP_WORLD_SIZE": "3", "SOLAR_MAPPER_RUN_DIR": "run"}
+    with mock.patch.dict(os.environ, environment):
+        with initialize(version_base="1.2", config_path="../configs"):
+            cfg = compose(
+                config_name="train.yaml", return_hydra_config=True, overrides=["trainer=torchrun"]
+            )
+        with open_dict(cfg):
+            cfg.paths.root_dir = str(pyrootutils.find_root())
+        assert cfg.trainer.devices == 2
+        assert cfg.trainer.num_nodes == 3
+        assert cfg.trainer.sync_batchnorm
+        assert cfg.trainer.strategy._target_.endswith("DDPStrategy")
+        assert cfg.hydra.run.dir == "run"
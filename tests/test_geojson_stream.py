@@ -0,0 +1,66 @@
+import io
+import json
+import math
+import tracemalloc
+
+import pytest
+
+from solar_mapper.dataset.geojson_stream import FeatureStream, iter_features
+
+
+def _feature(index, value=1.5):
+    return {
+        "type": "Feature",
+        "properties": {"id": index, "area": value, "Date": "2018-01-01 00:00:00"},
+        "geometry": {"type": "Point", "coordinates": [index * 0.001, 12345.6789]},
+    }
+
+
+def _collection(features, **members):
+    return json.dumps({"type": "FeatureCollection", **members, "features": features, "tail": [1]})
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 20])
+def test_iter_features_with_nan(chunk_size):
+    text = _collection(
+        [_feature(0, float("nan")), _feature(1), _feature(2, 10**12)],
+        crs={"type": "name", "properties": {"name": "features"}},
+    )
+    assert "NaN" in text
+    features = list(iter_features(io.StringIO(text), chunk_size=chunk_size))
+    assert [f["properties"]["id"] for f in features] == [0, 1, 2]
+    assert math.isnan(features[0]["properties"]["area"])
+    assert features[2]["properties"]["area"] == 10**12
+    assert features[1]["geometry"]["coordinates"] == [0.001, 12345.6789]
+
+
+def test_iter_features_projects_properties(tmp_path):
+    path = tmp_path / "polygons.geojson"
+    path.write_text(_collection([_feature(0), _feature(1)]))
+    features = list(FeatureStream(str(path), properties=["Date", "missing"]))
+    assert features[0]["properties"] == {"Date": "2018-01-01 00:00:00"}
+    # features without a Date keep falling back to the start of the period
+    undated = _feature(2)
+    del undated["properties"]["Date"]
+    undated_path = tmp_path / "undated.geojson"
+    undated_path.write_text(_collection([undated]))
+    assert next(iter_features(str(undated_path), properties=["Date"]))["properties"] == {}
+    # the stream can be iterated again
+    assert len(list(FeatureStream(str(path)))) == 2
+    assert list(iter_features(io.BytesIO(b'{"type": "FeatureCollection", "features": []}'))) == []
+
+
+def test_iter_features_bounded_memory(tmp_path):
+    path = tmp_path / "large.geojson"
+    with open(path, "w") as f:
+        f.write('{"type": "FeatureCollection", "features": [')
+        f.write(",".join(json.dumps(_feature(i, float("nan"))) for i in range(50_000)))
+        f.write("]}")
+    assert path.stat().st_size > 8_000_000
+
+    tracemalloc.start()
+    count = sum(1 for _ in iter_features(str(path), properties=["id"], chunk_size=1 << 16))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert count == 50_000
+    assert peak < 2_000_000
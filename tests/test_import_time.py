@@ -0,0 +1,57 @@
+import re
+import subprocess
+import sys
+from typing import Dict
+
+import pyrootutils
+
+# loaded by `Sentinel2PolygonDataset.load_sample` and the preprocessing stages, never on import
+GEO_STACK = (
+    "dask",
+    "odc.stac",
+    "pandas",
+    "planetary_computer",
+    "pyproj",
+    "pystac_client",
+    "rasterio",
+    "xarray",
+)
+
+# seconds the datamodule may add on top of torch and Lightning, about 0.8s before the geo stack
+# was deferred and under 0.1s after
+DATAMODULE_IMPORT_BUDGET = 0.4
+
+
+def _import_times(code: str) -> Dict[str, float]:
+    """Cumulative import time in seconds of every module imported by `code`."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=str(pyrootutils.find_root()),
+        capture_output=True,
+        text=True,
+        timeout=600,
+    )
+    assert result.returncode == 0, result.stderr
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|\s*(\S+)", line)
+        if match:
+            times[match.group(2)] = int(match.group(1)) / 1e6
+    return times
+
+
+def test_entry_points_defer_the_geo_stack():
+    times = _import_times(
+        "import solar_mapper.datamodules.sentinel2_datamodule\n"
+        "import solar_mapper.tasks.prepare_task\n"
+    )
+    assert "solar_mapper.datamodules.sentinel2_datamodule" in times
+    assert not [module for module in GEO_STACK if module in times]
+
+
+def test_datamodule_import_budget():
+    # the frameworks are imported first, so only the time added by this repo is measured
+    times = _import_times(
+        "import torch, pytorch_lightning\nimport solar_mapper.datamodules.sentinel2_datamodule\n"
+    )
+    assert times["solar_mapper.datamodules.sentinel2_datamodule"] < DATAMODULE_IMPORT_BUDGET
@@ -0,0 +1,124 @@
+import threading
+
+import numpy as np
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from solar_mapper.inference.engine import CPUInferenceEngine
+from solar_mapper.inference.export import (
+    Segmenter,
+    export_onnx,
+    export_torchscript,
+    load_segmenter,
+    quantize_onnx,
+)
+from solar_mapper.models.components.unet import ConvEncoder, UNet
+
+MODEL_CFG = {
+    "_target_": "solar_mapper.models.segmentation_module.SegmentationLitModule",
+    "optimizer": {"_target_": "torch.optim.Adam", "_partial_": True},
+    "net": {
+        "_target_": "solar_mapper.models.components.unet.UNet",
+        "encoder": {
+            "_target_": "solar_mapper.models.components.unet.ConvEncoder",
+            "in_channels": 4,
+            "widths": [4, 8],
+        },
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def segmenter():
+    torch.manual_seed(0)
+    return Segmenter(UNet(ConvEncoder(4, widths=(4, 8))), 3, 1e-4, 0.1).eval()
+
+
+def _tiles(num_tiles, size=32):
+    rng = np.random.default_rng(0)
+    tiles = rng.uniform(0, 3000, (num_tiles, 4, size, size)).astype(np.float32)
+    tiles[:, 3] = -12.0
+    tiles[:, 3, 0] = np.nan
+    return tiles
+
+
+def test_load_segmenter_from_checkpoint(tmp_path):
+    import hydra
+
+    model = hydra.utils.instantiate(OmegaConf.create(MODEL_CFG)).eval()
+    torch.save({"state_dict": model.state_dict()}, tmp_path / "model.ckpt")
+
+    segmenter = load_segmenter(OmegaConf.create(MODEL_CFG), str(tmp_path / "model.ckpt"), 3)
+    tiles = torch.from_numpy(_tiles(2))
+    with torch.no_grad():
+        probs = segmenter(tiles)
+        expected = torch.sigmoid(
+            model.net(torch.nan_to_num(tiles) * torch.tensor([1e-4] * 3 + [0.1])[:, None, None])
+        )
+    assert torch.allclose(probs, expected, atol=1e-6)
+
+
+def test_export_torchscript(segmenter, tmp_path):
+    path = export_torchscript(segmenter, str(tmp_path / "model.pt"), torch.zeros(1, 4, 32, 32))
+    engine = CPUInferenceEngine(model_path=path, intra_op_threads=1)
+    tiles = _tiles(3)
+    with torch.no_grad():
+        expected = segmenter(torch.from_numpy(tiles)).numpy()
+    np.testing.assert_allclose(engine.predict_batch(tiles), expected, atol=1e-5)
+
+
+def test_export_onnx_dynamic_tile_size(segmenter, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    path = export_onnx(segmenter, str(tmp_path / "model.onnx"), torch.zeros(1, 4, 32, 32))
+
+    tiles = _tiles(3, size=48)
+    with torch.no_grad():
+        expected = segmenter(torch.from_numpy(tiles)).numpy()
+    engine = CPUInferenceEngine(model_path=path, intra_op_threads=1)
+    np.testing.assert_allclose(engine.predict_batch(tiles), expected, atol=1e-5)
+
+    quantized = CPUInferenceEngine(model_path=path, intra_op_threads=1, quantize=True)
+    assert (tmp_path / "model.int8.onnx").exists()
+    # the convolutions run as int8 kernels, not as float ones
+    import onnx
+
+    operators = {node.op_type for node in onnx.load(tmp_path / "model.int8.onnx").graph.node}
+    assert "ConvInteger" in operators and "Conv" not in operators
+    assert np.abs(quantized.predict_batch(tiles) - expected).mean() < 0.05
+    assert quantize_onnx(path, str(tmp_path / "other.onnx")).endswith("other.onnx")
+
+
+def test_quantize_needs_an_onnx_model(segmenter, tmp_path):
+    # PyTorch can't dynamically quantize convolutions, the model would silently stay float
+    with pytest.raises(ValueError):
+        CPUInferenceEngine(model=segmenter, quantize=True)
+    path = export_torchscript(segmenter, str(tmp_path / "model.pt"), torch.zeros(1, 4, 32, 32))
+    with pytest.raises(ValueError):
+        CPUInferenceEngine(model_path=path, quantize=True)
+
+
+def test_engine_run_batches_in_order(segmenter):
+    engine = CPUInferenceEngine(model=segmenter, batch_size=4, intra_op_threads=1, io_threads=2)
+    tiles = list(_tiles(6)) + list(_tiles(3, size=16))
+    threads = set()
+
+    def load(index):
+        threads.add(threading.current_thread().name)
+        return tiles[index]
+
+    results = list(engine.run(range(len(tiles)), load))
+    assert [index for index, _ in results] == list(range(len(tiles)))
+    assert results[0][1].shape == (1, 32, 32) and results[-1][1].shape == (1, 16, 16)
+    assert all(name.startswith("tile-io") for name in threads)
+    with torch.no_grad():
+        expected = segmenter(torch.from_numpy(np.stack(tiles[6:]))).numpy()
+    np.testing.assert_allclose(np.stack([pred for _, pred in results[6:]]), expected, atol=1e-6)
+
+
+def test_engine_benchmark(segmenter):
+    engine = CPUInferenceEngine(model=segmenter, batch_size=2, intra_op_threads=1)
+    metrics = engine.benchmark(in_channels=4, tile_size=32, num_tiles=4)
+    assert metrics["tiles_per_sec"] > 0
+    assert metrics["tiles_per_hour_per_core"] == pytest.approx(metrics["tiles_per_sec"] * 3600)
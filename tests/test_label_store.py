@@ -0,0 +1,90 @@
+import numpy as np
+import pytest
+from affine import Affine
+from pyproj import Transformer
+from rasterio.features import rasterize
+from shapely import ops
+from shapely.geometry import box, mapping
+
+pytest.importorskip("zarr")
+from odc.geo.geobox import GeoBox  # noqa: E402
+
+from solar_mapper.dataset.label_store import LabelStore, build_label_store  # noqa: E402
+
+EPSG = 32633
+TO_UTM = Transformer.from_crs(EPSG, 4326, always_xy=True)
+
+
+def _feature(minx, miny, maxx, maxy):
+    """Feature in EPSG:4326 of a box given in UTM zone 33N coordinates."""
+    return {
+        "type": "Feature",
+        "properties": {},
+        "geometry": mapping(
+            ops.transform(TO_UTM.transform, box(minx, miny, maxx, maxy).segmentize(10))
+        ),
+    }
+
+
+@pytest.fixture(scope="module")
+def store(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("labels") / "labels.zarr")
+    features = [
+        _feature(500_003, 4_000_003, 500_202, 4_000_102),
+        # across a chunk border
+        _feature(504_200, 4_000_000, 504_400, 4_000_300),
+    ]
+    written = build_label_store(features, path, chunk_size=256)
+    # far from the zone borders, only zone 33 gets the polygons
+    assert written == {EPSG: 3}
+    # a second run adds to the labels
+    build_label_store([_feature(500_500, 4_000_500, 500_600, 4_000_600)], path, chunk_size=256)
+    return LabelStore(path)
+
+
+def _expected(geobox):
+    geometries = [
+        box(500_003, 4_000_003, 500_202, 4_000_102),
+        box(504_200, 4_000_000, 504_400, 4_000_300),
+        box(500_500, 4_000_500, 500_600, 4_000_600),
+    ]
+    return rasterize(geometries, out_shape=tuple(geobox.shape), transform=geobox.transform, fill=0)
+
+
+def test_read_aligned_geobox(store):
+    geobox = GeoBox((512, 768), Affine(10, 0, 499_000, 0, -10, 4_001_200), f"EPSG:{EPSG}")
+    mask = store.read(geobox)
+    assert mask.dtype == np.uint8
+    np.testing.assert_array_equal(mask, _expected(geobox))
+    assert mask.sum() > 0
+
+
+def test_read_unaligned_geobox(store):
+    geobox = GeoBox((128, 128), Affine(20, 0, 499_905, 0, -20, 4_001_205), f"EPSG:{EPSG}")
+    mask = store.read(geobox)
+    difference = mask.astype(int) - _expected(geobox)
+    # only pixels along the polygon borders can differ
+    assert np.abs(difference).sum() < 0.1 * _expected(geobox).sum()
+
+
+def test_read_missing_zone_and_outside_grid(store):
+    geobox = GeoBox((64, 64), Affine(10, 0, 500_000, 0, -10, 4_000_640), "EPSG:32610")
+    assert not store.read(geobox).any()
+    # reaches past the western edge of the grid
+    geobox = GeoBox((64, 64), Affine(10, 0, -320, 0, -10, 4_000_640), f"EPSG:{EPSG}")
+    assert store.read(geobox).shape == (64, 64)
+    with pytest.raises(ValueError):
+        store.read(GeoBox((4, 4), Affine(0.1, 0, 15, 0, -0.1, 36), "EPSG:4326"))
+
+
+def test_polygons_near_zone_border(tmp_path):
+    path = str(tmp_path / "labels.zarr")
+    # about 10km east of the border of zones 32 and 33
+    written = build_label_store([_feature(240_000, 4_000_000, 240_500, 4_000_500)], path)
+    assert set(written) == {32632, EPSG}
+
+    corner = Transformer.from_crs(EPSG, 32632, always_xy=True).transform(240_000, 4_000_500)
+    x, y = 10 * (corner[0] // 10) - 500, 10 * (corner[1] // 10) + 500
+    geobox = GeoBox((256, 256), Affine(10, 0, x, 0, -10, y), "EPSG:32632")
+    # the polygon is slightly rotated in zone 32
+    assert LabelStore(path).read(geobox).sum() == pytest.approx(2500, rel=0.05)
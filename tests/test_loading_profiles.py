@@ -0,0 +1,61 @@
+import dask.array
+import numpy as np
+import pytest
+from odc.stac import stac_load
+
+from solar_mapper.dataset.loading_profiles import (
+    db_scale,
+    get_loading_profiles,
+    get_stac_cfg,
+)
+from tests.helpers.stac_items import make_item
+
+
+def test_stac_cfg_has_top_level_collections():
+    stac_cfg = get_stac_cfg(get_loading_profiles())
+    assert stac_cfg["sentinel-1-rtc"]["assets"]["*"]["data_type"] == "float32"
+    assert "sentinel-1-rtc" not in stac_cfg["sentinel-2-l2a"]
+
+
+def test_overrides_are_merged():
+    profiles = get_loading_profiles({"sentinel-1-rtc": {"db_scale": True, "chunks": {"x": 512}}})
+    assert profiles["sentinel-1-rtc"]["db_scale"]
+    assert profiles["sentinel-1-rtc"]["chunks"] == {"x": 512, "y": 1024}
+    assert not profiles["sentinel-2-l2a"]["db_scale"]
+
+
+@pytest.mark.parametrize(
+    "override",
+    [
+        {"sentinel-2-l2a": {"sentinel-1-rtc": {"assets": {}}}},
+        {"sentinel-2-l2a": {"assets": {"B04": {"data_type": "uint16", "nodata": -1}}}},
+        {"sentinel-2-l2a": {"assets": {"B04": {"data_type": "uint17"}}}},
+        {"sentinel-2-l2a": {"resampling": {"*": "linear"}}},
+        {"sentinel-1-rtc": {"chunks": {"x": 0}}},
+    ],
+)
+def test_invalid_profiles_are_rejected(override):
+    with pytest.raises(ValueError):
+        get_loading_profiles(override)
+
+
+def test_db_scale_during_load(tmp_path):
+    backscatter = np.full((64, 64), 0.1, dtype=np.float32)
+    backscatter[:8] = 0  # nodata
+    item = make_item(str(tmp_path), {"vv": (10, backscatter)}, collection="sentinel-1-rtc")
+
+    profiles = get_loading_profiles()
+    stack = stac_load(
+        [item],
+        bands=["vv"],
+        chunks={"x": 32, "y": 32},
+        stac_cfg=get_stac_cfg(profiles),
+    )
+    scaled = db_scale(stack)
+
+    # still lazy, the conversion runs per chunk as part of the load
+    assert isinstance(scaled.vv.data, dask.array.Array)
+    assert scaled.vv.dtype == np.float16
+    values = scaled.vv.values[0]
+    assert np.isnan(values[:8]).all()
+    np.testing.assert_allclose(values[8:], -10.0, atol=1e-2)
@@ -0,0 +1,117 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from solar_mapper.callbacks.hard_example_mining import HardExampleMining
+from solar_mapper.datamodules.components.mining import (
+    TABLE_DTYPE,
+    HardExampleTable,
+    load_sampling_weights,
+    merge_tables,
+    polygon_cells,
+    sampling_weights,
+    write_sampling_weights,
+)
+
+# polygons 0-4 in one 1° cell, 5-9 in another
+FEATURES = [
+    {"geometry": {"type": "Point", "coordinates": [0.1 * i + 10 * (i // 5), 0.5]}}
+    for i in range(10)
+]
+
+
+def _load_sample(example, rng):
+    return {"mask": torch.zeros(1, 2, 2, dtype=torch.uint8)}
+
+
+@pytest.fixture
+def dataset(polygon_dataset, tmp_path):
+    return polygon_dataset(
+        FEATURES, _load_sample, samples_per_epoch=200, seed=1, mining_dir=str(tmp_path)
+    )
+
+
+def test_table_keeps_running_means(tmp_path):
+    path = str(tmp_path / "table-0.npy")
+    table = HardExampleTable(path, 10, momentum=0.5)
+    table.record(np.array([3, 3]), np.array([1.0, 0.0]), np.array([0.2, 0.4]), epoch=2)
+    table.flush()
+
+    rows = HardExampleTable(path, 10).rows
+    assert rows[3]["count"] == 2 and rows[3]["epoch"] == 2
+    assert rows[3]["loss"] == pytest.approx(0.5)
+    assert rows[3]["false_positives"] == pytest.approx(0.3)
+    assert rows["count"].sum() == 2
+    with pytest.raises(ValueError):
+        HardExampleTable(path, 11)
+
+
+def test_merge_keeps_the_latest_rows_of_overlapping_tables():
+    # rank 1 of a run on 2 ranks, then rank 0 of the resumed run on 1 rank
+    earlier = np.zeros(4, dtype=TABLE_DTYPE)
+    earlier[[1, 3]] = [(1.0, 0.5, 2, 3), (2.0, 0.0, 1, 3)]
+    resumed = np.zeros(4, dtype=TABLE_DTYPE)
+    resumed[[0, 1, 3]] = [(0.5, 0.0, 1, 4), (0.1, 0.1, 3, 4), (1.0, 1.0, 3, 3)]
+
+    for tables in ([earlier, resumed], [resumed, earlier]):
+        merged = merge_tables(tables)
+        assert merged["count"].tolist() == [1, 3, 0, 4]
+        assert merged["epoch"].tolist() == [4, 4, 0, 3]
+        assert merged["loss"].tolist() == pytest.approx([0.5, 0.1, 0.0, 1.25])
+        assert merged["false_positives"].tolist() == pytest.approx([0.0, 0.1, 0.0, 0.75])
+
+
+def test_weights_favour_hard_polygons_and_their_region(tmp_path):
+    table = HardExampleTable(str(tmp_path / "table-0.npy"), 10)
+    assert np.allclose(sampling_weights(table.rows, polygon_cells(FEATURES)), 0.1)
+
+    seen = np.array([0, 1, 5, 6])
+    table.record(seen, np.array([2.0, 0.1, 0.1, 0.1]), np.array([0.5, 0.0, 0.0, 0.0]))
+    weights = sampling_weights(table.rows, polygon_cells(FEATURES), uniform=0.2)
+    assert weights.sum() == pytest.approx(1.0)
+    assert weights.argmax() == 0
+    assert weights.min() > 0.2 / 10
+    # unseen polygons next to the hard one are drawn more than unseen ones elsewhere
+    assert weights[2] > weights[7]
+
+
+def test_dataset_draws_by_the_weights(dataset, tmp_path):
+    uniform = [int(sample["polygon"]) for sample in dataset]
+    assert len(set(uniform)) == 10
+
+    weights = np.full(10, 0.01)
+    weights[4] = 0.91
+    write_sampling_weights(str(tmp_path), weights)
+    assert np.array_equal(load_sampling_weights(str(tmp_path)), weights)
+    mined = [int(sample["polygon"]) for sample in dataset]
+    assert 0.8 < mined.count(4) / len(mined) < 0.97
+
+
+def test_callback_writes_weights_from_training_errors(dataset, tmp_path):
+    trainer = SimpleNamespace(
+        datamodule=SimpleNamespace(mining_dir=str(tmp_path), data_train=dataset),
+        global_rank=0,
+        is_global_zero=True,
+        current_epoch=0,
+        strategy=SimpleNamespace(barrier=lambda: None),
+    )
+    callback = HardExampleMining(uniform=0.1)
+    callback.setup(trainer, None, stage="fit")
+
+    batch = {"mask": torch.zeros(4, 1, 2, 2, dtype=torch.uint8), "polygon": torch.arange(4)}
+    logits = torch.full((4, 1, 2, 2), -5.0)
+    # false positives all over the chip of polygon 2
+    logits[2] = 5.0
+    callback.on_train_batch_end(trainer, None, {"loss": None, "logits": logits}, batch, 0)
+    callback.on_train_epoch_end(trainer, None)
+
+    weights = load_sampling_weights(str(tmp_path))
+    assert weights.argmax() == 2
+    assert callback.table.rows["false_positives"][2] == 1.0
+    assert (tmp_path / "table-0.npy").exists()
+
+    with pytest.raises(ValueError):
+        trainer.datamodule.mining_dir = None
+        HardExampleMining().setup(trainer, None, stage="fit")
@@ -0,0 +1,164 @@
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import pystac
+import pytest
+import torch
+from shapely.geometry import Point, box, shape
+from torch.utils.data import DataLoader
+
+from solar_mapper.datamodules.components.sentinel2_dataset import Sentinel2PolygonDataset
+from solar_mapper.datamodules.sentinel2_datamodule import Sentinel2DataModule
+from solar_mapper.dataset.negatives import NegativeSampler, cell_strata
+
+
+def _square(x: float, y: float, size: float, **properties) -> dict:
+    return {
+        "type": "Feature",
+        "properties": properties,
+        "geometry": box(x, y, x + size, y + size).__geo_interface__,
+    }
+
+
+PV = [_square(10.5, 45.5, 0.001), _square(10.2, 45.2, 0.001), _square(-60.5, -3.5, 0.001)]
+
+
+def _load_sample(example, rng):
+    return {"mask": torch.ones(1, 2, 2, dtype=torch.uint8), "x": torch.tensor(rng.random())}
+
+
+def _load_negative(point, items, s1_items, rng):
+    if not items:
+        raise ValueError("No imagery")
+    return {"mask": torch.zeros(1, 2, 2, dtype=torch.uint8), "x": torch.tensor(rng.random())}
+
+
+@pytest.fixture
+def dataset(polygon_dataset):
+    def make(**kwargs) -> Sentinel2PolygonDataset:
+        return polygon_dataset(
+            PV,
+            _load_sample,
+            _load_negative,
+            samples_per_epoch=40,
+            seed=3,
+            negative_fraction=0.5,
+            negative_block=8,
+            **kwargs,
+        )
+
+    return make
+
+
+def _search(features, period, collection="sentinel-2-l2a", num_samples=1):
+    # no imagery west of 0°
+    return [["scene"] if f["geometry"]["coordinates"][0] > 0 else [] for f in features]
+
+
+def test_sampler_keeps_away_from_pv():
+    sampler = NegativeSampler(PV, exclusion_m=2_000)
+    rng = np.random.default_rng(0)
+    points = [sampler.draw(rng) for _ in range(200)]
+    cells = [shape(f["geometry"]) for f in cell_strata(PV)]
+    assert len(cells) == 2
+    for point in points:
+        geometry = shape(point["geometry"])
+        assert cells[point["properties"]["stratum"]].contains(geometry)
+        assert all(shape(f["geometry"]).distance(geometry) > 0.015 for f in PV)
+    assert not sampler.is_negative(10.5, 45.5)
+
+
+def test_sampler_follows_stratum_weights():
+    strata = [
+        _square(0, 0, 1, weight=3.0),
+        _square(5, 5, 1, weight=1.0),
+        _square(9, 9, 1, weight=0),
+    ]
+    sampler = NegativeSampler(PV, strata)
+    rng = np.random.default_rng(0)
+    drawn = [sampler.draw(rng)["properties"]["stratum"] for _ in range(400)]
+    assert 0.68 < drawn.count(0) / 400 < 0.82
+    assert 2 not in drawn
+
+    # the whole stratum is next to PV
+    sampler = NegativeSampler(PV, [_square(10.5, 45.5, 0.001)], max_attempts=10)
+    with pytest.raises(ValueError):
+        sampler.draw(rng)
+
+
+def test_search_items_per_point_searches_once():
+    from solar_mapper.dataset import sentinel_2
+
+    items = [
+        SimpleNamespace(id="wide", geometry=box(0, 0, 2, 2).__geo_interface__),
+        SimpleNamespace(id="east", geometry=box(1, 0, 2, 1).__geo_interface__),
+    ]
+    catalog = mock.Mock()
+    catalog.search.return_value.pages.return_value = [items]
+    points = [{"geometry": Point(x, 0.5).__geo_interface__} for x in (0.5, 1.5, 3.0)]
+
+    per_point = sentinel_2.search_items_per_point(
+        points, "2020-01-01/2020-03-01", num_samples=5, catalog=catalog
+    )
+    assert [[item.id for item in found] for found in per_point] == [["wide"], ["wide", "east"], []]
+    assert catalog.search.call_count == 1
+    assert catalog.search.call_args.kwargs["intersects"]["type"] == "MultiPoint"
+    per_point = sentinel_2.search_items_per_point(points, "2020-01-01/2020-03-01", catalog=catalog)
+    assert [len(found) for found in per_point] == [1, 1, 0]
+
+
+def test_sign_items_replaces_expired_tokens():
+    from planetary_computer import sas
+
+    from solar_mapper.dataset.sentinel_2 import sign_items
+
+    href = "https://sentinel2l2a01.blob.core.windows.net/sentinel2-l2/B04.tif"
+    item = pystac.Item("scene", box(0, 0, 1, 1).__geo_interface__, None, datetime(2020, 1, 1), {})
+    item.add_asset("B04", pystac.Asset(f"{href}?st=old&se=old&sp=rl&sig=old"))
+    token = sas.SASToken(
+        token="st=new&se=new&sp=rl&sig=new", expiry=datetime.now(timezone.utc) + timedelta(hours=1)
+    )
+    with mock.patch.object(sas, "get_token", return_value=token):
+        (signed,) = sign_items([item])
+    assert signed.assets["B04"].href == f"{href}?st=new&se=new&sp=rl&sig=new"
+    # the scenes of the block stay as they were found
+    assert item.assets["B04"].href.endswith("sig=old")
+
+
+def test_dataset_mixes_in_negatives_with_one_search_per_block(dataset, tmp_path):
+    from solar_mapper.dataset import sentinel_2
+
+    with mock.patch.object(sentinel_2, "search_items_per_point", side_effect=_search) as search:
+        samples = list(dataset())
+    assert len(samples) == 40
+    # blocks of 8 samples
+    assert search.call_count == 5
+    negatives = [sample for sample in samples if sample["polygon"] == -1]
+    assert 8 < len(negatives) < 32
+    assert all(sample["mask"].sum() == 0 for sample in negatives)
+    assert all(sample["mask"].sum() == 4 for sample in samples if sample["polygon"] >= 0)
+
+    with pytest.raises(ValueError):
+        dataset(chip_cache="prepared")
+    datamodule = Sentinel2DataModule(
+        data_dir=str(tmp_path), chip_cache={"train": "prepared"}, negatives={"fraction": 0.2}
+    )
+    with pytest.raises(ValueError):
+        datamodule.setup()
+
+
+def test_resumed_pass_draws_the_same_negatives(dataset):
+    from solar_mapper.dataset import sentinel_2
+
+    def batches(dataset):
+        loader = DataLoader(dataset, batch_size=3, num_workers=2)
+        return [(batch["polygon"].tolist(), batch["x"].tolist()) for batch in loader]
+
+    with mock.patch.object(sentinel_2, "search_items_per_point", side_effect=_search):
+        epoch = batches(dataset())
+        resumed = dataset()
+        # in the middle of the blocks of both workers
+        resumed.set_progress(0, batches=5, batch_size=3)
+        assert batches(resumed) == epoch[5:]
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import hydra
+import pyrootutils
+import pytest
+import torch
+from hydra import compose, initialize
+from hydra.core.hydra_config import HydraConfig
+from omegaconf import open_dict
+
+from solar_mapper.callbacks.optuna_pruning import OptunaPruning, find_running_trial
+
+optuna = pytest.importorskip("optuna")
+
+
+def _trainer(epoch: int, value: float):
+    return SimpleNamespace(
+        sanity_checking=False,
+        callback_metrics={"val/iou": torch.tensor(value)},
+        current_epoch=epoch,
+        strategy=SimpleNamespace(broadcast=lambda obj: obj),
+        should_stop=False,
+    )
+
+
+def test_pruning_reports_to_the_trial_of_the_job():
+    # stands in for the SQLite storage shared by the sweeper and its jobs
+    storage = optuna.storages.InMemoryStorage()
+    study = optuna.create_study(study_name="sweep", storage=storage, direction="maximize")
+    # trials run in parallel, as asked by the sweeper
+    trials = [study.ask() for _ in range(2)]
+    for trial in trials:
+        trial.suggest_float("model.optimizer.lr", 0.0001, 0.1)
+    lr = trials[1].params["model.optimizer.lr"]
+
+    callback = OptunaPruning(storage, "sweep", pruner=optuna.pruners.ThresholdPruner(lower=0.5))
+    job_study = optuna.load_study(study_name="sweep", storage=storage, pruner=callback.pruner)
+    callback.trial = find_running_trial(job_study, [f"model.optimizer.lr={lr}", "seed=1"])
+    assert callback.trial.number == trials[1].number
+
+    trainer = _trainer(0, 0.6)
+    callback.on_validation_end(trainer, None)
+    assert not trainer.should_stop
+    trainer = _trainer(1, 0.4)
+    callback.on_validation_end(trainer, None)
+    assert trainer.should_stop
+
+    stored = optuna.load_study(study_name="sweep", storage=storage).trials[1]
+    assert stored.intermediate_values == {0: pytest.approx(0.6), 1: pytest.approx(0.4)}
+    assert stored.user_attrs == {"pruned_epoch": 1}
+    assert find_running_trial(job_study, ["model.optimizer.lr=0.5"]) is None
+
+
+def test_sentinel2_optuna_config():
+    with initialize(version_base="1.2", config_path="../configs"):
+        cfg = compose(
+            config_name="train.yaml",
+            return_hydra_config=True,
+            # the joblib launcher plugin isn't needed to compose the rest
+            overrides=["hparams_search=sentinel2_optuna", "hydra/launcher=basic"],
+        )
+    with open_dict(cfg):
+        cfg.paths.root_dir = str(pyrootutils.find_root())
+    HydraConfig().set_config(cfg)
+
+    assert cfg.hydra.sweeper.storage.startswith("sqlite:///")
+    assert cfg.callbacks.optuna_pruning.storage == cfg.hydra.sweeper.storage
+    assert cfg.callbacks.optuna_pruning.study_name == "sentinel2_segmentation"
+    assert cfg.datamodule.chip_cache.train.endswith("prepared")
+    callback = hydra.utils.instantiate(cfg.callbacks.optuna_pruning)
+    assert isinstance(callback.pruner, optuna.pruners.MedianPruner)
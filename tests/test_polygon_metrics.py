@@ -0,0 +1,97 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import Point, box
+
+from solar_mapper.evaluation.polygon_metrics import (
+    EQUAL_AREA_CRS,
+    assign_regions,
+    evaluate_polygons,
+    match_polygons,
+)
+
+
+def _frame(geometries, **columns):
+    return gpd.GeoDataFrame(columns, geometry=geometries, crs=EQUAL_AREA_CRS)
+
+
+@pytest.fixture
+def inventories():
+    reference = _frame(
+        [box(0, 0, 100, 100), box(1000, 0, 1100, 100), box(5000, 0, 5100, 100)],
+        country=["A", "A", "B"],
+    )
+    predicted = _frame(
+        [
+            box(10, 0, 110, 100),  # IoU 90 / 110 with the first reference
+            box(1000, 0, 1100, 50),  # IoU 0.5 with the second reference
+            box(1000, 50, 1100, 80),  # overlaps the second reference, too small
+            box(9000, 0, 9100, 100),  # false positive
+        ],
+        country=["A", "A", "A", "B"],
+    )
+    return predicted, reference
+
+
+def test_match_polygons_one_to_one(inventories):
+    predicted, reference = inventories
+    matches = match_polygons(np.asarray(predicted.geometry), np.asarray(reference.geometry))
+    assert matches.pred_index.tolist() == [0, 1]
+    assert matches.ref_index.tolist() == [0, 1]
+    np.testing.assert_allclose(matches.iou, [90 / 110, 0.5])
+    np.testing.assert_allclose(matches.pred_overlap, [9000, 5000, 3000, 0])
+
+
+def test_evaluate_polygons(inventories):
+    summary, groups = evaluate_polygons(*inventories, group_by="country")
+    assert summary["num_predicted"] == 4 and summary["num_reference"] == 3
+    assert summary["precision"] == pytest.approx(0.5)
+    assert summary["recall"] == pytest.approx(2 / 3)
+    assert summary["mean_iou"] == pytest.approx((90 / 110 + 0.5) / 2)
+    assert summary["mean_area_error"] == pytest.approx(-0.25)
+    assert summary["area_iou"] == pytest.approx(17_000 / (28_000 + 30_000 - 17_000))
+
+    assert groups.loc["A", "precision"] == pytest.approx(2 / 3)
+    assert groups.loc["A", "recall"] == 1.0
+    assert groups.loc["B", "precision"] == 0.0 and groups.loc["B", "recall"] == 0.0
+    assert np.isnan(groups.loc["B", "mean_iou"])
+
+    _, tiles = evaluate_polygons(*inventories, tile_size_m=2000)
+    assert tiles.loc["0_0", "recall"] == 1.0 and len(tiles) == 3
+
+
+def test_point_references_and_regions(inventories):
+    predicted, _ = inventories
+    points = _frame([Point(50, 50), Point(1050, 60), Point(3000, 3000)])
+    summary, _ = evaluate_polygons(predicted, points)
+    # each point is matched to one of the polygons containing it
+    assert summary["recall"] == pytest.approx(2 / 3)
+    assert summary["precision"] == pytest.approx(0.5)
+    assert np.isnan(summary["mean_iou"])
+
+    regions = _frame([box(-10, -10, 2000, 200), box(2000, -10, 10_000, 200)], name=["A", "B"])
+    assigned = assign_regions(points, regions, "name", "region")
+    assert assigned.region.tolist()[:2] == ["A", "A"] and assigned.region.isna().tolist()[2]
+
+
+def test_matches_all_pairs_on_random_inventory():
+    rng = np.random.default_rng(0)
+    corners = rng.uniform(0, 20_000, (2000, 2))
+    sizes = rng.uniform(20, 200, (2000, 1))
+    reference = [box(x, y, x + s, y + s) for (x, y), (s,) in zip(corners[:1000], sizes[:1000])]
+    shifted = corners[:1000] + rng.normal(0, 10, (1000, 2))
+    predicted = [box(x, y, x + s, y + s) for (x, y), (s,) in zip(shifted, sizes[:1000])]
+    predicted += [box(x, y, x + s, y + s) for (x, y), (s,) in zip(corners[1000:], sizes[1000:])]
+
+    matches = match_polygons(np.asarray(predicted), np.asarray(reference))
+    # brute force: every predicted polygon against every reference
+    ious = np.asarray(
+        [[p.intersection(r).area / p.union(r).area for r in reference] for p in predicted[:200]]
+    )
+    best = ious.argmax(axis=1)
+    matched = dict(zip(matches.pred_index.tolist(), matches.ref_index.tolist()))
+    for index in range(200):
+        if ious[index, best[index]] > 0.5:
+            assert matched[index] == best[index]
+        else:
+            assert index not in matched
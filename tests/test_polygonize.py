@@ -0,0 +1,119 @@
+import geopandas as gpd
+import numpy as np
+import pytest
+from affine import Affine
+
+from solar_mapper.inference.polygonize import (
+    GridTile,
+    StreamingPolygonizer,
+    open_writer,
+    polygonize_predictions,
+    polygonize_tile,
+)
+
+CRS = "EPSG:32633"
+ORIGIN = Affine.translation(500_000, 4_000_000) * Affine.scale(10, -10)
+
+
+def _split(probs, tile_size):
+    """Splits a raster into grid tiles with their own transforms."""
+    tiles = []
+    for row in range(probs.shape[0] // tile_size):
+        for col in range(probs.shape[1] // tile_size):
+            transform = ORIGIN * Affine.translation(col * tile_size, row * tile_size)
+            window = probs[
+                row * tile_size : (row + 1) * tile_size, col * tile_size : (col + 1) * tile_size
+            ]
+            tiles.append((GridTile(row, col, transform, CRS), window))
+    return tiles
+
+
+def _raster():
+    probs = np.zeros((64, 64), dtype=np.float32)
+    probs[5:10, 5:10] = 0.9  # inside the first tile
+    probs[28:36, 28:36] = 0.8  # across the corner of all four tiles
+    probs[10:12, 30:40] = 0.7  # across the border of the top tiles
+    probs[50:52, 50:51] = 0.9  # small
+    return probs
+
+
+def test_polygonize_tile_sides():
+    probs = np.zeros((16, 16), dtype=np.float32)
+    probs[4:8, 4:8] = 1.0
+    probs[0:3, 13:16] = 0.6
+    components = sorted(polygonize_tile(probs, ORIGIN), key=lambda c: c.pixel_count)
+    assert [c.pixel_count for c in components] == [9, 16]
+    assert components[0].sides == {(-1, 0), (0, 1), (-1, 1)}
+    assert components[1].sides == set()
+    assert components[1].geometry.area == 16 * 100
+    assert components[1].probability_sum == pytest.approx(16.0)
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_polygons_merge_across_tiles_in_any_order(tmp_path, seed):
+    probs = _raster()
+    tiles = _split(probs, 32)
+    order = np.random.default_rng(seed).permutation(len(tiles))
+    path = str(tmp_path / "pv.geojson")
+    kwargs = {"min_area_m2": 300, "simplify_tolerance": 0}
+    written = polygonize_predictions([tiles[i] for i in order], path, **kwargs)
+
+    whole = str(tmp_path / "whole.geojson")
+    polygonize_predictions([(GridTile(0, 0, ORIGIN, CRS), probs)], whole, **kwargs)
+
+    polygons = gpd.read_file(path).sort_values("area_m2")
+    expected = gpd.read_file(whole).sort_values("area_m2")
+    assert written == len(polygons) == len(expected) == 3
+    np.testing.assert_allclose(polygons.area_m2, [2000, 2500, 6400])
+    np.testing.assert_allclose(polygons.area_m2, expected.area_m2)
+    np.testing.assert_allclose(polygons.mean_probability, [0.7, 0.9, 0.8], rtol=1e-6)
+    for merged, single in zip(polygons.to_crs(CRS).geometry, expected.to_crs(CRS).geometry):
+        assert merged.symmetric_difference(single).area < 1.0
+
+
+@pytest.mark.parametrize("connectivity, expected", [(4, 4), (8, 2)])
+def test_corners_join_across_tiles_like_inside_them(tmp_path, connectivity, expected):
+    probs = np.zeros((32, 32), dtype=np.float32)
+    # squares touching diagonally across a border, and across the corner of four tiles
+    probs[14:16, 4:6] = probs[16:18, 6:8] = 0.9
+    probs[14:16, 14:16] = probs[16:18, 16:18] = 0.9
+    kwargs = {"min_area_m2": 0, "simplify_tolerance": 0, "connectivity": connectivity}
+    tiled = polygonize_predictions(_split(probs, 16), str(tmp_path / "tiled.geojson"), **kwargs)
+    whole = [(GridTile(0, 0, ORIGIN, CRS), probs)]
+    assert tiled == polygonize_predictions(whole, str(tmp_path / "whole.geojson"), **kwargs)
+    assert tiled == expected
+
+
+def test_geoparquet_output(tmp_path):
+    pytest.importorskip("pyarrow")
+    path = str(tmp_path / "pv.parquet")
+    written = polygonize_predictions(_split(_raster(), 32), path, min_area_m2=0)
+    polygons = gpd.read_parquet(path)
+    assert len(polygons) == written == 4
+    assert polygons.crs.to_epsg() == 4326
+    assert polygons.geometry.is_valid.all()
+
+
+def test_memory_stays_flat_on_large_grids(tmp_path):
+    rng = np.random.default_rng(0)
+    polygonizer = StreamingPolygonizer(open_writer(str(tmp_path / "pv.geojson")), min_area_m2=0)
+    grid = 30
+    max_pending = max_tracked = 0
+    for row in range(grid):
+        for col in range(grid):
+            probs = np.zeros((16, 16), dtype=np.float32)
+            probs[:, 7:9] = 0.9  # vertical strip through every tile of a column
+            # random pixels, not touching the strip, may merge across tiles with each other
+            probs[rng.integers(16), rng.choice([*range(0, 5), *range(11, 16)])] = 0.9
+            transform = ORIGIN * Affine.translation(col * 16, row * 16)
+            polygonizer.add_tile(probs, GridTile(row, col, transform, CRS))
+            max_pending = max(max_pending, polygonizer.num_pending)
+            max_tracked = max(max_tracked, polygonizer.num_tracked_tiles)
+    polygonizer.close()
+
+    # only about one row of tiles is kept, plus the tiles along the edge of the grid
+    assert max_pending <= 3 * grid
+    assert max_tracked <= 2 * grid + 4 * grid
+    # each column strip was merged into one polygon
+    polygons = gpd.read_file(tmp_path / "pv.geojson")
+    assert (polygons.area_m2 == grid * 16 * 2 * 100).sum() == grid
@@ -0,0 +1,205 @@
+import json
+import os
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+import pyrootutils
+import pytest
+import torch
+from hydra import compose, initialize
+from omegaconf import open_dict
+
+from solar_mapper.preprocessing.launchers import Launcher, MultiprocessingLauncher
+from solar_mapper.dataset.acquisitions import AcquisitionCalendar
+from solar_mapper.preprocessing.stages import (
+    chip_path,
+    index_shard,
+    load_chip,
+    materialize_shard,
+    seed_calendar,
+    shard_features,
+    split_mask_tasks,
+)
+
+
+def _feature(lon: float, lat: float, size: float = 0.001):
+    coordinates = [[lon, lat], [lon + size, lat], [lon + size, lat + size], [lon, lat + size]]
+    return {
+        "type": "Feature",
+        "properties": {"Date": "2019-01-01"},
+        "geometry": {"type": "Polygon", "coordinates": [coordinates + [[lon, lat]]]},
+    }
+
+
+FEATURES = [_feature(15.1, 36.1), _feature(-70.5, 10.5), _feature(15.2, 36.2), _feature(15.3, 36.9)]
+
+
+class FakeCatalog:
+    """Catalog with the same two scenes everywhere."""
+
+    def search(self, collections, intersects, datetime):
+        items = [
+            {"properties": {"datetime": d}}
+            for d in ("2019-02-01T10:00:00Z", "2019-03-03T10:00:00Z")
+        ]
+        return mock.Mock(items_as_dicts=lambda: iter(items))
+
+
+class FakeDataset:
+    """Loads a chip filled with the first random number, fails for polygons west of 0°."""
+
+    def load_sample(self, feature, rng):
+        if feature["geometry"]["coordinates"][0][0][0] < 0:
+            raise ValueError("No imagery")
+        return {"s2": torch.full((2, 4, 4), int(rng.integers(1000)), dtype=torch.int16)}
+
+
+def square(x: int) -> int:
+    return x * x
+
+
+def test_shard_features_groups_neighbours():
+    shards = shard_features(FEATURES, shard_size=2)
+    assert [shard.index for shard in shards] == [0, 1]
+    polygons = [[polygon for polygon, _ in shard.features] for shard in shards]
+    # ordered by 1° cell, the three polygons around (15°E, 36°N) follow each other
+    assert polygons == [[1, 0], [2, 3]]
+
+
+@pytest.mark.parametrize("launcher", [Launcher(), MultiprocessingLauncher(2, "fork")])
+def test_launchers_keep_task_order(launcher):
+    assert launcher.map(square, list(range(7))) == [x * x for x in range(7)]
+
+
+def test_split_mask_tasks_gives_each_chunk_to_one_task():
+    buckets = {32633: {(r, c): [] for r in range(3) for c in range(3)}, 32634: {(0, 0): []}}
+    tasks = split_mask_tasks("labels.zarr", buckets, num_tasks=4)
+    written = [(task.epsg, key) for task in tasks for key in task.chunks]
+    assert len(written) == len(set(written)) == 10
+    assert max(len(task.chunks) for task in tasks) == 3
+
+
+def test_materialize_shard_resumes(tmp_path):
+    shard = shard_features(FEATURES, shard_size=4)[0]
+    counts = materialize_shard(shard, FakeDataset(), str(tmp_path), seed=7)
+    assert counts == {"written": 3, "skipped": 0, "failed": 1}
+    chip = load_chip(chip_path(str(tmp_path), 2))
+    assert chip["s2"].dtype == torch.int16 and chip["s2"].shape == (2, 4, 4)
+    rng = np.random.default_rng(7 + 2)
+    rng.integers(2**32)  # the seed of the global generator
+    assert chip["s2"][0, 0, 0] == rng.integers(1000)
+    assert not [name for name in os.listdir(tmp_path / "chips") if name.endswith(".tmp")]
+    # chips of an earlier run are kept
+    counts = materialize_shard(shard, FakeDataset(), str(tmp_path), seed=7)
+    assert counts == {"written": 0, "skipped": 3, "failed": 1}
+
+
+def test_materialize_shard_is_reproducible(tmp_path):
+    class GlobalRandomDataset(FakeDataset):
+        """Draws the chip from the global generator, like the time window search."""
+
+        def load_sample(self, feature, rng):
+            return {"s2": torch.from_numpy(np.random.randint(1000, size=(2, 4, 4)))}
+
+    shard = shard_features(FEATURES, shard_size=4)[0]
+    chips = []
+    for run in ("first", "second"):
+        np.random.seed(None)
+        materialize_shard(shard, GlobalRandomDataset(), str(tmp_path / run), seed=7)
+        chips.append([load_chip(chip_path(str(tmp_path / run), p))["s2"] for p in range(4)])
+    for first, second in zip(*chips):
+        assert torch.equal(first, second)
+    assert not torch.equal(chips[0][0], chips[0][2])
+
+
+def test_chips_stage_reads_the_index(tmp_path):
+    from solar_mapper.dataset import sentinel_2
+
+    class CalendarDataset(FakeDataset):
+        def load_sample(self, feature, rng):
+            # a search would fail, the dates must come from the index
+            dates = sentinel_2.ACQUISITION_CALENDAR.dates(
+                feature, datetime(2019, 1, 1), datetime(2019, 12, 31), catalog=None
+            )
+            return {"s2": torch.tensor(len(dates))}
+
+    shard = shard_features(FEATURES, shard_size=4)[0]
+    with mock.patch.object(sentinel_2, "_DEFAULT_CATALOG", FakeCatalog()):
+        index_shard(shard, str(tmp_path), "2019-01-01", "2019-12-31")
+    assert seed_calendar(AcquisitionCalendar(), str(tmp_path), polygons={0, 1}) == 2
+    assert seed_calendar(AcquisitionCalendar(max_cloud_cover=10), str(tmp_path)) == 0
+
+    with mock.patch.object(sentinel_2, "ACQUISITION_CALENDAR", AcquisitionCalendar()):
+        counts = materialize_shard(shard, CalendarDataset(), str(tmp_path))
+        assert sentinel_2.ACQUISITION_CALENDAR.num_searches == 0
+    assert counts == {"written": 4, "skipped": 0, "failed": 0}
+    assert load_chip(chip_path(str(tmp_path), 1))["s2"] == 2
+
+    from solar_mapper.datamodules.components.sentinel2_dataset import Sentinel2PolygonDataset
+
+    dataset = Sentinel2PolygonDataset(
+        "polygons.geojson", "2019-01-01", "2019-12-31", acquisition_index=str(tmp_path)
+    )
+    dataset._features = FEATURES
+    with mock.patch.object(sentinel_2, "ACQUISITION_CALENDAR", AcquisitionCalendar()):
+        dataset._seed_calendar()
+        assert len(sentinel_2.ACQUISITION_CALENDAR._indexed) == 4
+
+
+def test_prepare_task(tmp_path):
+    pytest.importorskip("zarr")
+    polygons = tmp_path / "polygons.geojson"
+    polygons.write_text(json.dumps({"type": "FeatureCollection", "features": FEATURES}))
+    with initialize(version_base="1.2", config_path="../configs"):
+        cfg = compose(config_name="prepare.yaml", return_hydra_config=True)
+    with open_dict(cfg):
+        cfg.paths.root_dir = str(pyrootutils.find_root())
+        cfg.paths.output_dir = str(tmp_path)
+        cfg.extras.print_config = False
+        cfg.extras.enforce_tags = False
+        cfg.prepare.polygons = str(polygons)
+        cfg.prepare.output_dir = str(tmp_path / "prepared")
+        cfg.prepare.stages = ["index", "masks"]
+        cfg.prepare.shard_size = 3
+        cfg.prepare.launcher = {"_target_": "solar_mapper.preprocessing.launchers.Launcher"}
+
+    from solar_mapper.dataset import sentinel_2
+    from solar_mapper.tasks.prepare_task import prepare
+
+    with mock.patch.object(sentinel_2, "_DEFAULT_CATALOG", FakeCatalog()):
+        metric_dict, _ = prepare(cfg)
+
+    assert metric_dict["index/polygons"] == 4
+    assert metric_dict["index/acquisitions"] == 8
+    assert metric_dict["masks/labelled"] >= 4
+    index = json.loads((tmp_path / "prepared" / "index" / "shard-00001.json").read_text())
+    assert len(index["dates"]) == 1
+    assert next(iter(index["dates"].values())) == ["2019-02-01T10:00:00", "2019-03-03T10:00:00"]
+    assert (tmp_path / "prepared" / "labels.zarr").exists()
+
+
+def test_dataset_reads_the_chip_cache(tmp_path):
+    from solar_mapper.datamodules.components.sentinel2_dataset import Sentinel2PolygonDataset
+    from solar_mapper.preprocessing.stages import write_chip_manifest
+
+    def dataset(**kwargs):
+        return Sentinel2PolygonDataset(
+            "polygons.geojson", "2019-01-01", "2019-12-31", samples_per_epoch=6, **kwargs
+        )
+
+    materialize_shard(shard_features(FEATURES, shard_size=4)[0], FakeDataset(), str(tmp_path))
+    write_chip_manifest(str(tmp_path), dataset().chip_manifest())
+
+    cached = dataset(chip_cache=str(tmp_path), seed=1)
+    with mock.patch.object(cached, "load_sample", side_effect=AssertionError("loaded")):
+        samples = list(cached)
+    assert len(samples) == 6
+    # polygon 1 failed to load, only chips of the others are drawn
+    chips = {int(load_chip(chip_path(str(tmp_path), p))["s2"][0, 0, 0]) for p in (0, 2, 3)}
+    assert {int(sample["s2"][0, 0, 0]) for sample in samples} <= chips
+
+    with pytest.raises(ValueError, match="prepared with"):
+        dataset(chip_cache=str(tmp_path), chip_size=128)
+    with pytest.raises(ValueError, match="No chips prepared"):
+        dataset(chip_cache=str(tmp_path / "missing"))
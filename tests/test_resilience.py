@@ -0,0 +1,141 @@
+import time
+
+import pytest
+
+from solar_mapper.dataset import resilience
+from solar_mapper.dataset.resilience import (
+    CircuitOpenError,
+    RateLimiter,
+    RemoteIO,
+    RemoteReadError,
+    is_transient,
+    skip_failed_example,
+    status_code,
+)
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status_code = status
+
+
+def _flaky(failures, error):
+    calls = []
+
+    def function(value):
+        calls.append(value)
+        if len(calls) <= failures:
+            raise error
+        return value
+
+    return function, calls
+
+
+def test_error_classification():
+    assert status_code(HTTPError(503)) == 503
+    assert status_code(OSError("HTTP response code: 429 - Too Many Requests")) == 429
+    assert is_transient(HTTPError(503)) and not is_transient(HTTPError(404))
+    assert is_transient(ConnectionResetError()) and is_transient(OSError("Read timed out"))
+    assert not is_transient(ValueError("No items found"))
+
+
+def test_retries_with_jittered_backoff():
+    delays = []
+    remote_io = RemoteIO(max_attempts=4, base_delay=1.0, sleep=delays.append)
+    function, calls = _flaky(3, HTTPError(503))
+    assert remote_io.call("cog", function, 7) == 7
+    assert len(calls) == 4 and len(delays) == 3
+    assert all(0 <= delay <= 2**i for i, delay in enumerate(delays))
+    metrics = remote_io.metrics.snapshot()
+    assert metrics["cog/retries"] == 3 and metrics["cog/successes"] == 1
+
+    function, calls = _flaky(10, HTTPError(503))
+    with pytest.raises(RemoteReadError):
+        remote_io.call("cog", function, 7)
+    assert len(calls) == 4 and remote_io.metrics.snapshot()["cog/failures"] == 1
+
+    # other errors, e.g. no imagery, are not retried
+    function, calls = _flaky(1, ValueError("no items"))
+    with pytest.raises(ValueError):
+        remote_io.call("cog", function, 7)
+    assert len(calls) == 1
+
+
+def test_token_refresh_on_forbidden(monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(resilience, "refresh_sas_tokens", lambda: refreshes.append(1))
+    remote_io = RemoteIO(sleep=lambda _: None)
+    function, calls = _flaky(1, HTTPError(403))
+    assert remote_io.call("cog", function, 1) == 1
+    assert refreshes == [1] and remote_io.metrics.snapshot()["cog/token_refreshes"] == 1
+    # a second 403 right after a refresh is not retried again
+    function, calls = _flaky(2, HTTPError(403))
+    with pytest.raises(HTTPError):
+        remote_io.call("cog", function, 1)
+
+
+def test_circuit_breaker_opens_and_recovers():
+    remote_io = RemoteIO(
+        max_attempts=1, failure_threshold=3, reset_timeout=0.2, sleep=lambda _: None
+    )
+    function, calls = _flaky(3, HTTPError(502))
+    for _ in range(3):
+        with pytest.raises(RemoteReadError):
+            remote_io.call("stac", function, 1)
+    assert remote_io.breaker("stac").state == "open"
+    with pytest.raises(CircuitOpenError) as error:
+        remote_io.call("stac", function, 1)
+    assert 0 < error.value.retry_after <= 0.2 and len(calls) == 3
+    # other hosts are not affected
+    assert remote_io.call("cog", lambda: 1) == 1
+
+    time.sleep(0.25)
+    assert remote_io.call("stac", function, 1) == 1
+    assert remote_io.breaker("stac").state == "closed"
+    metrics = remote_io.metrics.snapshot()
+    assert metrics["stac/circuit_opened"] == 1 and metrics["stac/circuit_rejected"] == 1
+
+    start = time.monotonic()
+    skip_failed_example(CircuitOpenError("stac", 0.1))
+    assert 0.1 <= time.monotonic() - start < 0.5
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(rate=50, burst=1)
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - start >= 0.09
+
+
+def test_configure_remote_io():
+    remote_io = resilience.configure_remote_io({"max_attempts": 2, "rate_limits": {"cog": 5}})
+    assert resilience.get_remote_io() is remote_io and remote_io.max_attempts == 2
+    assert set(remote_io.limiters) == {"cog"}
+    with pytest.raises(ValueError):
+        resilience.configure_remote_io({"retries": 2})
+    resilience.configure_remote_io()
+
+
+def test_dataset_skips_failed_examples(monkeypatch):
+    from solar_mapper.datamodules.components.sentinel2_dataset import Sentinel2PolygonDataset
+
+    resilience.configure_remote_io({"max_attempts": 2, "base_delay": 0.0})
+    dataset = Sentinel2PolygonDataset("polygons.geojson", "2020-01-01", "2021-01-01", seed=0)
+    dataset._features = [{"properties": {}, "geometry": None}]
+    dataset.samples_per_epoch = 2
+    outcomes = [HTTPError(503), HTTPError(503), HTTPError(503), {"s2": 1}, {"s2": 2}]
+
+    def load_sample(example, rng):
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    monkeypatch.setattr(dataset, "load_sample", load_sample)
+    # the first example fails twice and is skipped, the next one is retried once
+    assert [sample["s2"] for sample in dataset] == [1, 2]
+    metrics = resilience.get_remote_io().metrics.snapshot()
+    assert metrics["cog/failures"] == 1 and metrics["cog/retries"] == 2
+    resilience.configure_remote_io()
@@ -0,0 +1,91 @@
+from functools import partial
+
+import pytest
+import torch
+from pytorch_lightning import Trainer
+from torch.utils.data import DataLoader, Dataset
+
+from solar_mapper.models.benchmark import measure_throughput
+from solar_mapper.models.components.segmentation_loss import IoUFromCounts, bce_dice_loss
+from solar_mapper.models.components.unet import ConvEncoder, ResNetEncoder, UNet
+from solar_mapper.models.segmentation_module import SegmentationLitModule
+
+
+class ChipDataset(Dataset):
+    """Random chips in the layout of `Sentinel2PolygonDataset`, PV where band 0 is bright."""
+
+    def __len__(self):
+        return 8
+
+    def __getitem__(self, idx):
+        generator = torch.Generator().manual_seed(idx)
+        s2 = torch.randint(0, 3000, (4, 32, 32), generator=generator, dtype=torch.int16)
+        s2[0, 8:24, 8:24] = 9000
+        s1 = torch.full((2, 32, 32), -15.0, dtype=torch.float16)
+        s1[0, 0] = float("nan")
+        mask = (s2[:1] > 5000).to(torch.uint8)
+        return {"s2": s2, "s1": s1, "mask": mask}
+
+
+@pytest.mark.parametrize(
+    "encoder", [ConvEncoder(5, widths=(8, 16, 32)), ResNetEncoder(5, name="resnet18")]
+)
+def test_unet_output_matches_input_size(encoder):
+    net = UNet(encoder)
+    assert net(torch.randn(2, 5, 64, 48)).shape == (2, 1, 64, 48)
+
+
+def test_bce_dice_loss_counts():
+    target = torch.zeros(1, 1, 4, 4)
+    target[..., :2, :] = 1
+    logits = torch.full((1, 1, 4, 4), -5.0)
+    logits[..., :3, :2] = 5.0
+
+    loss, counts = bce_dice_loss(logits, target)
+    assert loss > 0
+    assert counts.tolist() == [4, 2, 4]
+
+    iou = IoUFromCounts()
+    iou.update(counts)
+    assert iou.compute() == pytest.approx(0.4)
+
+
+def test_segmentation_module_fits_channels_last():
+    model = SegmentationLitModule(
+        net=UNet(ConvEncoder(in_channels=6, widths=(8, 16, 32))),
+        optimizer=partial(torch.optim.Adam, lr=0.01),
+        channels_last=True,
+    )
+    batch = next(iter(DataLoader(ChipDataset(), batch_size=4)))
+    x = model.inputs(batch)
+    assert x.shape == (4, 6, 32, 32)
+    assert x.is_contiguous(memory_format=torch.channels_last)
+    assert torch.isfinite(x).all()
+
+    trainer = Trainer(
+        max_epochs=3,
+        accelerator="cpu",
+        devices=1,
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    loader = DataLoader(ChipDataset(), batch_size=4)
+    trainer.fit(model, train_dataloaders=loader, val_dataloaders=loader)
+    metrics = trainer.callback_metrics
+    for name in ("train/loss", "train/iou", "val/loss", "val/iou", "val/iou_best"):
+        assert name in metrics
+    assert 0.0 <= metrics["val/iou"] <= 1.0
+
+    probs = trainer.predict(model, dataloaders=loader)
+    assert probs[0].shape == (4, 1, 32, 32)
+
+
+def test_measure_throughput_on_cpu():
+    net = UNet(ConvEncoder(in_channels=6, widths=(8, 16)))
+    for train in (False, True):
+        chips_per_sec = measure_throughput(
+            net, in_channels=6, chip_size=32, batch_size=2, steps=2, warmup=1, train=train
+        )
+        assert chips_per_sec > 0
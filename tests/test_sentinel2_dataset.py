@@ -0,0 +1,141 @@
+from unittest import mock
+
+import numpy as np
+import pystac_client
+import pytest
+import torch
+import xarray as xr
+
+from solar_mapper.datamodules.components.sentinel2_dataset import (
+    Sentinel2PolygonDataset,
+    chip_bbox,
+    chip_window,
+    stack_to_chip,
+    time_deltas,
+    to_chip,
+    to_sequence,
+)
+from tests.helpers.stac_items import make_item
+
+
+@pytest.fixture(scope="module")
+def sentinel_2():
+    # the module opens the STAC catalog on import
+    with mock.patch.object(pystac_client.Client, "open"):
+        from solar_mapper.dataset import sentinel_2
+    return sentinel_2
+
+
+def test_chip_bbox_covers_chip():
+    feature = {"geometry": {"type": "Point", "coordinates": [15.0, 60.0]}}
+    minx, miny, maxx, maxy = chip_bbox(feature, chip_size=256, margin=1.0)
+    assert minx < 15.0 < maxx and miny < 60.0 < maxy
+    # 2.56km across, wider in degrees of longitude at high latitude
+    assert (maxy - miny) == pytest.approx(2560 / 111_320)
+    assert (maxx - minx) == pytest.approx(2 * (maxy - miny), rel=1e-3)
+
+
+def test_chip_window_centres_on_mask():
+    mask = np.zeros((100, 100), dtype=np.uint8)
+    mask[70:80, 20:30] = 1
+    window_y, window_x = chip_window(mask, chip_size=32)
+    assert (window_y.start, window_y.stop) == (58, 90)
+    assert (window_x.start, window_x.stop) == (8, 40)
+    # clipped to the stack
+    window_y, _ = chip_window(mask, chip_size=64)
+    assert window_y.stop == 100
+
+
+def test_to_chip_pads():
+    chip = to_chip(np.ones((2, 10, 12)), chip_size=16)
+    assert chip.shape == (2, 16, 16)
+    assert chip[:, 10:].sum() == 0 and chip[:, :, 12:].sum() == 0
+
+
+def test_load_s2_bands_native_resolution(sentinel_2, tmp_path):
+    fine = np.arange(1, 512 * 512 + 1, dtype=np.uint16).reshape(512, 512)
+    coarse = np.arange(1, 256 * 256 + 1, dtype=np.uint16).reshape(256, 256)
+    item = make_item(str(tmp_path), {"B04": (10, fine), "B11": (20, coarse)})
+
+    chunks = {"x": 128, "y": 128}
+    native = sentinel_2.load_s2_bands(
+        [item], bands=["B04", "B11"], native_resolution=True, chunks=chunks
+    )
+    resampled = sentinel_2.load_s2_bands(
+        [item], bands=["B04", "B11"], native_resolution=False, chunks=chunks
+    )
+
+    assert native.odc.geobox == resampled.odc.geobox
+    assert list(native.data_vars) == ["B04", "B11"]
+    np.testing.assert_array_equal(native.B04.values, resampled.B04.values)
+    np.testing.assert_array_equal(native.B11.values, resampled.B11.values)
+    np.testing.assert_array_equal(native.B11.values[0, :2, :2], coarse[0, 0])
+
+    window = (slice(0, 64), slice(0, 64))
+    chip = stack_to_chip(native, ["B04", "B11"], window, chip_size=64, dtype=np.int16)
+    assert chip.shape == (2, 64, 64) and chip.dtype == np.int16
+
+
+def test_to_sequence_pads_and_masks():
+    sequence, valid = to_sequence(np.ones((2, 3, 5, 6), dtype=np.int16), length=4, chip_size=8)
+    assert sequence.shape == (4, 3, 8, 8) and sequence.dtype == np.int16
+    assert valid.tolist() == [True, True, False, False]
+    assert sequence[:2, :, :5, :6].all() and sequence.sum() == 2 * 3 * 5 * 6
+    # longer stacks are cut
+    _, valid = to_sequence(np.ones((5, 1, 8, 8)), length=4, chip_size=8)
+    assert valid.all()
+
+    times = np.array(["2020-06-01T10:00", "2020-06-11T09:59", "2020-05-30T10:00"], "datetime64")
+    days = time_deltas(times, times[0], length=4)
+    assert days.dtype == np.int16 and days.tolist() == [0, 10, -2, 0]
+
+
+def test_dataset_sequence_mode(sentinel_2):
+    size, dims = 20, ("time", "y", "x")
+    s2_times = np.array(["2020-06-01", "2020-06-06", "2020-06-21"], dtype="datetime64[ns]")
+    s1_times = np.array(["2020-05-30", "2020-06-11"], dtype="datetime64[ns]")
+    band = np.arange(1, 4, dtype=np.uint16)[:, None, None] * np.ones((size, size), np.uint16)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    mask[8:12, 8:12] = 1
+    grid = {"y": np.arange(size), "x": np.arange(size)}
+    stack_s2 = xr.Dataset(
+        {"B04": (dims, band), "B08": (dims, band * 10), "segmentation_map": (("y", "x"), mask)},
+        coords={"time": s2_times, **grid},
+    )
+    stack_s1 = xr.Dataset(
+        {"vv": (dims, np.full((2, size, size), -12.0))}, coords={"time": s1_times, **grid}
+    )
+    dataset = Sentinel2PolygonDataset(
+        "polygons.json",
+        "2020-01-01",
+        "2020-12-31",
+        bands=["B04", "B08"],
+        s1_bands=["vv"],
+        chip_size=16,
+        jitter=False,
+        sequence_length=4,
+    )
+    feature = {"geometry": {"type": "Point", "coordinates": [15.0, 60.0]}}
+    with mock.patch.object(
+        sentinel_2, "get_example_with_segmentation_map", return_value=(stack_s2, stack_s1)
+    ) as load:
+        sample = dataset.load_sample(feature, np.random.default_rng(0))
+
+    # as many scenes as time steps are loaded
+    assert load.call_args.args[4] == 4
+    assert sample["s2"].shape == (4, 2, 16, 16) and sample["s2"].dtype == torch.int16
+    assert sample["s2"][:, 1, 0, 0].tolist() == [10, 20, 30, 0]
+    assert sample["s2_valid"].tolist() == [True, True, True, False]
+    assert sample["s2_days"].tolist() == [0, 5, 20, 0]
+    assert sample["s1"].shape == (4, 1, 16, 16) and sample["s1"].dtype == torch.float16
+    assert sample["s1_valid"].tolist() == [True, True, False, False]
+    assert sample["s1_days"].tolist() == [-2, 10, 0, 0]
+    assert sample["mask"].shape == (1, 16, 16) and sample["mask"].sum() == 16
+
+    from solar_mapper.datamodules.sentinel2_datamodule import Sentinel2DataModule
+
+    spec = Sentinel2DataModule(
+        bands=("B04", "B08"), s1_bands=("vv",), chip_size=16, sequence_length=4
+    ).sample_spec()
+    for key, tensor in sample.items():
+        assert spec[key] == (tuple(tensor.shape), tensor.dtype)
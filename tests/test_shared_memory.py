@@ -0,0 +1,105 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pystac_client
+import pytest
+import torch
+from torch.utils.data import DataLoader
+
+from solar_mapper.datamodules.benchmark import SyntheticChips
+from solar_mapper.datamodules.components import shared_memory
+from solar_mapper.datamodules.components.shared_memory import (
+    SharedBatch,
+    SharedMemoryDataLoader,
+    SharedMemoryRing,
+)
+
+SPEC = {"s2": ((3, 4, 4), torch.int16), "mask": ((1, 4, 4), torch.uint8)}
+
+
+class NumberedChips(SyntheticChips):
+    """Chips filled with their index, to check order and content."""
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        for index in range(worker_info.id, self.num_samples, worker_info.num_workers):
+            yield {
+                "s2": torch.full((3, 4, 4), index, dtype=torch.int16),
+                "mask": torch.full((1, 4, 4), index % 2, dtype=torch.uint8),
+            }
+
+
+def sample(value: int):
+    return {"s2": torch.full((3, 4, 4), value, dtype=torch.int16), "mask": torch.ones(1, 4, 4)}
+
+
+def test_loader_matches_default_collate():
+    dataset = NumberedChips(SPEC, num_samples=22)
+    expected = list(DataLoader(dataset, batch_size=4, num_workers=2))
+    batches = [
+        {key: tensor.clone() for key, tensor in batch.items()}
+        for batch in SharedMemoryDataLoader(dataset, spec=SPEC, batch_size=4, num_workers=2)
+    ]
+    assert len(batches) == len(expected) == 6
+    for batch, reference in zip(batches, expected):
+        assert batch.keys() == reference.keys()
+        for key in batch:
+            assert batch[key].dtype == reference[key].dtype
+            assert torch.equal(batch[key], reference[key])
+    # a second epoch reuses the slots
+    assert sum(len(batch["s2"]) for batch in SharedMemoryDataLoader(dataset, SPEC, 4, 2)) == 22
+
+
+def test_held_batches_are_not_overwritten():
+    dataset = NumberedChips(SPEC, num_samples=64)
+    loader = SharedMemoryDataLoader(dataset, spec=SPEC, batch_size=2, num_workers=2)
+    held = []
+    for batch in loader:
+        held.append((batch, batch["s2"].clone()))
+        # the views of the last `hold_batches` batches are still intact
+        for view, copy in held[-loader.hold_batches :]:
+            assert torch.equal(view["s2"], copy)
+    assert len(held) == 32
+
+
+def test_ring_falls_back_while_a_slot_is_in_use():
+    ring = SharedMemoryRing(
+        {"s2": ((3, 4, 4), torch.int16), "mask": ((1, 4, 4), torch.float32)},
+        batch_size=2,
+        num_workers=1,
+        slots_per_worker=1,
+    )
+    with mock.patch.object(shared_memory, "get_worker_info", return_value=SimpleNamespace(id=0)):
+        first = ring.collate([sample(1), sample(2)])
+        assert first == SharedBatch(slot=0, generation=1, size=2)
+        assert ring.read(first)["s2"][:, 0, 0, 0].tolist() == [1, 2]
+        # the slot wasn't released, the batch goes through the default path
+        second = ring.collate([sample(3)])
+        assert isinstance(second, dict) and second["s2"][0, 0, 0, 0] == 3
+        ring.release(first)
+        assert ring.collate([sample(4)]) == SharedBatch(slot=0, generation=2, size=1)
+
+        ring.reset()
+        with pytest.raises(ValueError):
+            ring.collate([{"s2": torch.zeros(3, 8, 8, dtype=torch.int16), "mask": None}])
+    with pytest.raises(RuntimeError):
+        ring.collate([sample(5)])
+
+
+def test_datamodule_uses_ring_with_workers():
+    with mock.patch.object(pystac_client.Client, "open"):
+        from solar_mapper.datamodules.sentinel2_datamodule import Sentinel2DataModule
+
+    datamodule = Sentinel2DataModule(
+        bands=("B02", "B03"), s1_bands=("vv",), chip_size=8, num_workers=1, shared_memory=True
+    )
+    assert datamodule.sample_spec() == {
+        "s2": ((2, 8, 8), torch.int16),
+        "mask": ((1, 8, 8), torch.uint8),
+        "polygon": ((), torch.int64),
+        "s1": ((1, 8, 8), torch.float16),
+    }
+    dataset = NumberedChips(SPEC, num_samples=1)
+    assert isinstance(datamodule._dataloader(dataset, shuffle=False), SharedMemoryDataLoader)
+    datamodule.hparams.num_workers = 0
+    assert not isinstance(datamodule._dataloader(dataset, shuffle=False), SharedMemoryDataLoader)
@@ -0,0 +1,123 @@
+from unittest import mock
+
+import numpy as np
+import pystac_client
+import pytest
+import torch
+import xarray as xr
+from torch import nn
+
+from solar_mapper.datamodules.components.sentinel2_dataset import Sentinel2PolygonDataset
+from solar_mapper.models.components.super_resolution import (
+    ReferenceSRNet,
+    SuperResolutionStage,
+    tile_starts,
+)
+
+
+class CountingUpsample(nn.Module):
+    """Nearest-neighbour upsampling that counts the tiles it sees."""
+
+    def __init__(self, scale: int = 2):
+        super().__init__()
+        self.scale = scale
+        self.tiles = 0
+
+    def forward(self, x):
+        self.tiles += len(x)
+        return x.repeat_interleave(self.scale, dim=-2).repeat_interleave(self.scale, dim=-1)
+
+
+def test_tile_starts_cover_with_overlap():
+    assert tile_starts(100, 128, 16) == [0]
+    starts = tile_starts(300, 128, 16)
+    assert starts[0] == 0 and starts[-1] == 300 - 128
+    assert all(b - a <= 128 - 16 for a, b in zip(starts, starts[1:]))
+
+
+def test_stage_tiles_and_blends_exactly():
+    stage = SuperResolutionStage(CountingUpsample(), scale=2, tile_size=64, overlap=8)
+    chips = np.random.default_rng(0).integers(0, 10_000, (2, 3, 150, 90)).astype(np.int16)
+
+    output = stage(chips)
+    assert output.shape == (2, 3, 300, 180) and output.dtype == np.int16
+    np.testing.assert_array_equal(output, chips.repeat(2, axis=-2).repeat(2, axis=-1))
+    # tiles of both chips are batched through the network together
+    assert stage.net.tiles == 2 * len(tile_starts(150, 64, 8)) * len(tile_starts(90, 64, 8))
+
+
+def test_stage_pads_small_inputs():
+    stage = SuperResolutionStage(ReferenceSRNet(in_channels=4), tile_size=32, overlap=4)
+    output = stage(np.ones((1, 4, 20, 24), dtype=np.int16))
+    assert output.shape == (1, 4, 40, 48)
+
+
+def test_stage_caches_outputs(tmp_path):
+    chips = np.random.default_rng(0).integers(0, 10_000, (2, 3, 40, 40)).astype(np.int16)
+    stage = SuperResolutionStage(
+        CountingUpsample(), tile_size=32, overlap=4, cache_dir=str(tmp_path)
+    )
+    first = stage(chips)
+    tiles = stage.net.tiles
+    np.testing.assert_array_equal(stage(chips), first)
+    assert stage.net.tiles == tiles
+
+    # a new process reads the outputs from disk, only the new chip is computed
+    other = SuperResolutionStage(
+        CountingUpsample(), tile_size=32, overlap=4, cache_dir=str(tmp_path)
+    )
+    np.testing.assert_array_equal(other(chips[:1]), first[:1])
+    assert other.net.tiles == 0
+    other(np.concatenate([chips[:1], chips[:1] + 1]))
+    assert other.net.tiles == tiles // 2
+
+
+def test_stage_cache_depends_on_weights():
+    torch.manual_seed(0)
+    first = SuperResolutionStage(ReferenceSRNet(in_channels=3))
+    torch.manual_seed(1)
+    second = SuperResolutionStage(ReferenceSRNet(in_channels=3))
+    chip = np.ones((3, 8, 8), dtype=np.int16)
+    assert first.cache_key(chip) != second.cache_key(chip)
+
+
+def test_dataset_super_resolves_before_chipping():
+    with mock.patch.object(pystac_client.Client, "open"):
+        from solar_mapper.dataset import sentinel_2
+
+    size = 48
+    mask = np.zeros((size, size), dtype=bool)
+    mask[20:28, 20:28] = True
+    coords = {"time": [np.datetime64("2020-06-01")], "y": np.arange(size), "x": np.arange(size)}
+    dims = ("time", "y", "x")
+    band = np.full((1, size, size), 1000, dtype=np.uint16)
+    stack_s2 = xr.Dataset(
+        {"B04": (dims, band), "B08": (dims, band + 1000), "segmentation_map": (("y", "x"), mask)},
+        coords=coords,
+    )
+    stack_s1 = xr.Dataset({"vv": (dims, np.full((1, size, size), -12.0))}, coords=coords)
+
+    stage = SuperResolutionStage(CountingUpsample(), tile_size=32, overlap=4)
+    dataset = Sentinel2PolygonDataset(
+        "polygons.json",
+        "2020-01-01",
+        "2020-12-31",
+        bands=["B04", "B08"],
+        s1_bands=["vv"],
+        chip_size=64,
+        jitter=False,
+        super_resolution=stage,
+    )
+    feature = {"geometry": {"type": "Point", "coordinates": [15.0, 60.0]}}
+    with mock.patch.object(
+        sentinel_2, "get_example_with_segmentation_map", return_value=(stack_s2, stack_s1)
+    ) as load:
+        sample = dataset.load_sample(feature, np.random.default_rng(0))
+
+    # half the area is loaded for a 2x stage
+    minx, miny, maxx, maxy = load.call_args.kwargs["bbox"]
+    assert (maxy - miny) == pytest.approx(64 * 5 * 1.5 / 111_320)
+    assert sample["s2"].shape == (2, 64, 64) and sample["s2"].dtype == torch.int16
+    assert sample["s1"].shape == (1, 64, 64) and sample["s1"].dtype == torch.float16
+    assert sample["mask"].shape == (1, 64, 64) and sample["mask"].sum() == 16 * 16
+    assert (sample["s2"][1] == 2000).all()